@@ -14,6 +14,8 @@ import matplotlib.dates as mdates
 import pandas as pd
 import re
 import os
+import concurrent.futures
+from multiprocessing import shared_memory
 from AtmoScripts import atmosplots
 
 
@@ -340,14 +342,94 @@ def _nan_curve_fit():
     a_cov[:] = np.NaN
     return a_opt, a_cov
 
+def _nan_idxmax(s):
+    '''
+    Returns the index of the maximum of s, or nan if s is all nan (newer
+    versions of pandas raise a ValueError instead)
+    '''
+    if s.isnull().all():
+        return np.nan
+    return s.idxmax(skipna=True)
+
+def _curve_fit_mode(x, y, p0 = None):
+    '''
+    Fits gaussian to one mode of a size distribution with curve_fit and
+    returns the fitted parameters, their covariance and the number of function
+    evaluations used.
+
+    Without p0 the fit starts from scipy's default guess of ones. If p0 holds
+    the parameters of a previous fit, the fit starts from there instead. The
+    previous fit also sets bounds: the amplitude must be positive, the width
+    within a factor of 5 of the previous width, and the centre within one
+    window length of the fitted bins. Bounded fits are much slower in
+    curve_fit, so the bounds are only imposed if the unbounded fit from p0
+    fails or leaves them. A centre outside the bins still fails the quality
+    checks. A previous fit with a zero or non-finite parameter can't set the
+    bounds, so the fit starts cold instead.
+    '''
+    if (p0 is not None) and not (np.all(np.isfinite(p0)) and p0[2] != 0):
+        p0 = None
+    if p0 is None:
+        popt, pcov, infodict, mesg, ier = curve_fit(gaussian, x, y,
+                                                    full_output = True)
+        return popt, pcov, infodict['nfev']
+
+    width = abs(p0[2])
+    lower = [0, x.min() - len(x), width / 5]
+    upper = [np.inf, x.max() + len(x), width * 5]
+    p0 = np.clip([p0[0], p0[1], width], lower, upper)
+
+    nfev = 0
+    try:
+        popt, pcov, infodict, mesg, ier = curve_fit(gaussian, x, y, p0 = p0,
+                                                    full_output = True)
+        nfev = infodict['nfev']
+        popt[2] = abs(popt[2])
+        if np.all((popt > lower) & (popt < upper)):
+            return popt, pcov, nfev
+    except RuntimeError:
+        pass
+
+    popt, pcov, infodict, mesg, ier = curve_fit(gaussian, x, y, p0 = p0,
+                                                bounds = (lower, upper),
+                                                full_output = True)
+    return popt, pcov, nfev + infodict['nfev']
+
 def mode_max_from_dist_fit(d_mtx, 
                            HR_fit = True,
                            print_fit_params = False, 
-                           plot_fit = False):
+                           plot_fit = False,
+                           batch = False,
+                           n_jobs = None,
+                           progress = None,
+                           warm_start = False,
+                           fit_info = None):
     '''
     Works through the data matrix and fits lognormal distributions to the 3 
     modes of the size distribution. Returns the maximum of each fitted mode as
     a time series
+
+    With batch = True, every time step is fitted at once by
+    _mode_max_from_dist_fit_batch. Printing or plotting the fits still goes
+    through _mode_max_from_dist_fit_worker one time step at a time. The batch
+    fit can settle in a different local minimum than curve_fit for weak modes
+    or modes at the edge of their bins, and gives nan where the fitted
+    amplitude isn't positive, so it has to be asked for.
+
+    If n_jobs is an integer greater than 1, the time steps are split into
+    blocks which are fitted in a pool of that many processes. progress can be
+    a function, which is called as progress(rows_done, total_rows) as the
+    fitting goes along.
+
+    With warm_start = True, the time steps are fitted one after another with
+    curve_fit, and each mode's fit starts from that mode's last successful fit
+    (see _curve_fit_mode). After a failed fit, the next one starts cold.
+    This ignores batch and n_jobs. With print_fit_params, the total number of
+    function evaluations is printed at the end.
+
+    If fit_info is a dictionary, fits made with curve_fit (warm_start = True
+    or batch = False without n_jobs) add the number of function evaluations
+    used by each fit, as a dataframe under 'nfev'. Failed fits have nan.
     '''
     d_mtx = d_mtx.dropna(axis=1, how='any') #Drop any columns where a nan exists so that curve_fit doesn't crash
     
@@ -360,18 +442,244 @@ def mode_max_from_dist_fit(d_mtx,
                                                          'm3max','m4max'
 #                                                         ,'mnmax'
                                                          ])
+    if warm_start:
+        batch = False
+        n_jobs = None
+    nfev = pd.DataFrame(np.nan, index=time, columns=mode_max.columns)
+
+    if (n_jobs is not None) and (n_jobs > 1) and (len(time) > 1) \
+        and not (print_fit_params or plot_fit):
+        mode_max[:] = _mode_max_from_dist_fit_parallel(z, size_arr, HR_fit,
+                                                       batch, n_jobs, progress)
+        return mode_max
+
+    if batch and not (print_fit_params or plot_fit):
+        mode_max[:] = _mode_max_from_dist_fit_batch(z, size_arr,
+                                                    HR_fit = HR_fit)
+        if progress is not None:
+            progress(len(time), len(time))
+        return mode_max
+
+    p0 = None
     for i in np.arange(0,len(time)):
+        fit = {}
         mode_max.iloc[i] = _mode_max_from_dist_fit_worker(
                                         dist_arr = z[i,:],
                                         size_arr = size_arr,
                                         print_fit_params = print_fit_params,
                                         plot=plot_fit,
-                                        HR_fit = HR_fit) 
+                                        HR_fit = HR_fit,
+                                        p0 = p0,
+                                        fit_info = fit) 
+        nfev.iloc[i] = fit['nfev']
+        if warm_start:
+            # Seed each mode from its last successful fit, cold after a failure
+            p0 = [None if np.isnan(popt[0]) else popt for popt in fit['popt']]
+        if progress is not None:
+            progress(i+1, len(time))
+
+    if fit_info is not None:
+        fit_info['nfev'] = nfev
+    if warm_start and print_fit_params:
+        print('Mode fits used ' + str(int(np.nansum(nfev.values))) +
+              ' function evaluations, ' + str(int(mode_max.isnull().values.sum())) +
+              ' mode maxima are nan')
     
     return mode_max
 
+def _mode_max_from_dist_fit_parallel(z, size_arr, HR_fit, batch, n_jobs,
+                                     progress = None):
+    '''
+    Fits the mode maxima of the data matrix z in a pool of n_jobs processes.
+    z is put in shared memory once, and each process fits a block of rows
+    from it. Returns an array with a row for each time step, in order.
+    '''
+    z = np.ascontiguousarray(z, dtype=np.float64)
+    n_rows = len(z)
+    # A few blocks per process, so that slow blocks don't hold up the rest
+    block_size = int(np.ceil(n_rows / (n_jobs * 4)))
+    mode_max = np.full((n_rows, 4), np.nan)
+
+    shm = shared_memory.SharedMemory(create=True, size=max(z.nbytes, 1))
+    try:
+        np.ndarray(z.shape, dtype=np.float64, buffer=shm.buf)[:] = z
+        print("Fitting " + str(n_rows) + " size distributions with " +
+              str(n_jobs) + " worker processes")
+        with concurrent.futures.ProcessPoolExecutor(max_workers=n_jobs) as pool:
+            futures = [pool.submit(_mode_max_from_dist_fit_block, shm.name,
+                                   z.shape, i0, min(i0 + block_size, n_rows),
+                                   size_arr, HR_fit, batch)
+                       for i0 in range(0, n_rows, block_size)]
+            rows_done = 0
+            for future in concurrent.futures.as_completed(futures):
+                i0, block_max = future.result()
+                mode_max[i0:i0 + len(block_max)] = block_max
+                rows_done += len(block_max)
+                if progress is not None:
+                    progress(rows_done, n_rows)
+    finally:
+        shm.close()
+        shm.unlink()
+
+    return mode_max
+
+def _mode_max_from_dist_fit_block(shm_name, shape, i0, i1, size_arr,
+                                  HR_fit = True, batch = True):
+    '''
+    Process pool worker for _mode_max_from_dist_fit_parallel. Copies rows
+    i0 to i1 of the data matrix out of shared memory and fits them. Returns
+    i0 and the mode maxima of the block.
+    '''
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        z = np.ndarray(shape, dtype=np.float64, buffer=shm.buf)[i0:i1].copy()
+    finally:
+        shm.close()
+
+    if batch:
+        return i0, _mode_max_from_dist_fit_batch(z, size_arr, HR_fit = HR_fit)
+
+    block_max = np.full((len(z), 4), np.nan)
+    for i in range(len(z)):
+        # A failed fit leaves its own time step as nan, not the whole block
+        try:
+            fit_max = _mode_max_from_dist_fit_worker(dist_arr = z[i,:],
+                                                     size_arr = size_arr,
+                                                     plot = False,
+                                                     HR_fit = HR_fit)
+        except (RuntimeError, ValueError):
+            continue
+        block_max[i, :len(fit_max)] = fit_max
+    return i0, block_max
+
+# First and last (exclusive) size bin of each mode fitted by
+# _mode_max_from_dist_fit_worker
+_mode_fit_bins = [(0, 40), (50, 85), (85, None), (20, 70)]
+
+def gaussian_fit_batch(y, max_iter = 50):
+    '''
+    Fits gaussian(x, a, b, c) to every row of y at once, where x is the bin
+    number within the row (0, 1, 2, ...). Returns the arrays a, b and c, which
+    are nan for rows that couldn't be fitted.
+
+    The initial guess for each row comes from a least squares parabola through
+    log(y), weighted by y**2 so the peak dominates. It is then refined with
+    Levenberg-Marquardt steps applied to all rows together.
+    '''
+    y = np.asarray(y, dtype=float)
+    x = np.arange(y.shape[1], dtype=float)
+
+    # Initial guess from a weighted parabola through log(y)
+    w = np.where(y > 0, y**2, 0)
+    logy = np.log(np.where(y > 0, y, 1))
+    A = np.stack([np.ones_like(x), x, x**2], axis=1)
+    AtWA = np.einsum('ij,ki,il->kjl', A, w, A)
+    AtWy = np.einsum('ij,ki->kj', A, w * logy)
+    solvable = np.abs(np.linalg.det(AtWA)) > 1e-12
+    q = np.zeros((len(y), 3))
+    q[solvable] = np.linalg.solve(AtWA[solvable],
+                                  AtWy[solvable][..., None])[..., 0]
+    with np.errstate(all='ignore'):
+        peaked = solvable & (q[:,2] < 0)
+        a = np.where(peaked, np.exp(q[:,0] - q[:,1]**2 / (4*q[:,2])), np.nan)
+        b = np.where(peaked, -q[:,1] / (2*q[:,2]), np.nan)
+        c = np.where(peaked, np.sqrt(-1 / q[:,2]), np.nan)
+    # Fall back to the largest bin where the log parabola doesn't peak in range
+    guess = ~np.isfinite(a + b + c) | (b < x[0]) | (b > x[-1])
+    a[guess] = y.max(axis=1)[guess]
+    b[guess] = y.argmax(axis=1)[guess]
+    c[guess] = len(x) / 4.
+
+    def cost(rows, a, b, c):
+        fit = gaussian(x, a[:,None], b[:,None], c[:,None])
+        return np.square(y[rows] - fit).sum(axis=1)
+
+    # Levenberg-Marquardt refinement of all rows together
+    lam = np.full(len(y), 1e-3)
+    current = cost(slice(None), a, b, c)
+    active = np.isfinite(current)
+    for _ in range(max_iter):
+        if not active.any():
+            break
+        ai, bi, ci = a[active,None], b[active,None], c[active,None]
+        d = x - bi
+        e = np.exp(-d**2 / ci**2)
+        J = np.stack([e, 2*ai*e*d / ci**2, 2*ai*e*d**2 / ci**3], axis=2)
+        r = y[active] - ai*e
+        JtJ = np.einsum('kij,kil->kjl', J, J)
+        Jtr = np.einsum('kij,ki->kj', J, r)
+        diag = JtJ[:, [0,1,2], [0,1,2]]
+        JtJ[:, [0,1,2], [0,1,2]] += lam[active,None] * diag + 1e-12
+        step = np.linalg.solve(JtJ, Jtr[..., None])[..., 0]
+
+        idx = np.flatnonzero(active)
+        with np.errstate(all='ignore'):
+            trial = cost(idx, a[idx] + step[:,0], b[idx] + step[:,1],
+                         c[idx] + step[:,2])
+        better = np.isfinite(trial) & (trial <= current[idx])
+        converged = better & (current[idx] - trial <= 1e-10 * current[idx])
+        up = idx[better]
+        a[up] += step[better,0]
+        b[up] += step[better,1]
+        c[up] += step[better,2]
+        current[up] = trial[better]
+        lam[up] /= 10
+        lam[idx[~better]] *= 10
+        active[idx[converged | (lam[idx] > 1e10)]] = False
+
+    failed = ~np.isfinite(a + b + c) | (a <= 0) | (c == 0)
+    a[failed] = b[failed] = c[failed] = np.nan
+    return a, b, c
+
+def _mode_max_from_dist_fit_batch(z, size_arr, HR_fit = True):
+    '''
+    Fits the same modes as _mode_max_from_dist_fit_worker to every row of the
+    data matrix z at once (see gaussian_fit_batch), with the same quality
+    checks. The maximum of each mode is the fitted centre, converted
+    to a diameter analytically rather than by resampling the fitted curve.
+    Returns an array with a column for each mode.
+    '''
+    n = z.shape[1]
+    centres = []
+    for i, (first, last) in enumerate(_mode_fit_bins):
+        y = z[:, first:last]
+        x = np.arange(y.shape[1])
+        a, b, c = gaussian_fit_batch(y)
+        bad = ~((b >= x.min()) & (b <= x.max())) # Quality check, includes nan
+        if i == 3:
+            # Only use if the first mode fit doesn't work and fits well
+            with np.errstate(all='ignore'):
+                ymax = y.max(axis=1)[:,None]
+                yf = gaussian(x, a[:,None], b[:,None], c[:,None])
+                fit_err = np.sqrt(np.square(yf/ymax - y/ymax).sum(axis=1))
+            bad |= ~(fit_err <= 0.6) | ~np.isnan(centres[0])
+        centres.append(np.where(bad, np.nan, b + first))
+    centres = np.stack(centres, axis=1)
+
+    if HR_fit:
+        # Position on the 0.1 bin grid, interpolated logarithmically in size
+        pos = np.round(centres * 10) / 10
+        sizes = size_arr[0] * (size_arr[-1] / size_arr[0])**(pos / (n - 1))
+    else:
+        # Nearest size bin
+        pos = np.where(np.isnan(centres), 0, np.round(centres)).astype(int)
+        sizes = np.where(np.isnan(centres), np.nan, size_arr[pos])
+    return np.round(sizes, 1)
+
 def _mode_max_from_dist_fit_worker(dist_arr, size_arr, 
-                  print_fit_params = False,plot=True, HR_fit = True):
+                  print_fit_params = False,plot=True, HR_fit = True,
+                  p0 = None, fit_info = None):
+    '''
+    Fits each mode of a single size distribution and returns the maximum of
+    each fitted mode. p0 can be a list with the starting parameters for each
+    mode's fit, or None for a cold start (see _curve_fit_mode). If fit_info
+    is a dictionary, the fitted parameters of each mode ('popt', nan where
+    the fit failed its quality checks) and the function evaluations used
+    ('nfev') are added.
+    '''
+    if p0 is None:
+        p0 = [None] * 4
+    nfev = [np.nan] * 4
     
     # Define data
     y = dist_arr
@@ -395,35 +703,37 @@ def _mode_max_from_dist_fit_worker(dist_arr, size_arr,
     
     #Fit and check for a valid distribution by comparing the fitted mean to input x range
     try:
-        popt0, pcov0 = curve_fit(gaussian, x0, y0)
+        popt0, pcov0, nfev[0] = _curve_fit_mode(x0, y0, p0[0])
         if (popt0[1] < x0.min()) or (popt0[1] > x0.max()): # Quality check
             popt0, pcov0 = _nan_curve_fit()
     except RuntimeError:
         popt0, pcov0 = _nan_curve_fit()
     
     try:
-        popt1, pcov1 = curve_fit(gaussian, x1, y1)
+        popt1, pcov1, nfev[1] = _curve_fit_mode(x1, y1, p0[1])
         if (popt1[1] < x1.min()) or (popt1[1] > x1.max()):
             popt1, pcov1 = _nan_curve_fit()
     except RuntimeError:
         popt1, pcov1 = _nan_curve_fit()
     
     try:
-        popt2, pcov2 = curve_fit(gaussian, x2, y2)
+        popt2, pcov2, nfev[2] = _curve_fit_mode(x2, y2, p0[2])
         if (popt2[1] < x2.min()) or (popt2[1] > x2.max()):
             popt2, pcov2 = _nan_curve_fit()
     except RuntimeError:
         popt2, pcov2 = _nan_curve_fit()
         
     try:
-        popt3, pcov3 = curve_fit(gaussian, x3, y3)
+        popt3, pcov3, nfev[3] = _curve_fit_mode(x3, y3, p0[3])
         yf3 = gaussian(x3, popt3[0], popt3[1], popt3[2])
         fit3_err = np.sqrt(np.square(yf3/y3.max()-y3/y3.max()).sum())
-        if (popt3[1] < x3.min()) or (popt3[1] > x3.max()) or (fit3_err > 0.6) \
-            or (not np.isnan(popt0[0])): # Only use if the first mode fit doesn't work
+        if (popt3[1] < x3.min()) or (popt3[1] > x3.max()) or (fit3_err > 0.6):
             popt3, pcov3 = _nan_curve_fit()            
     except RuntimeError:
         popt3, pcov3 = _nan_curve_fit()
+    fit3 = popt3
+    if not np.isnan(popt0[0]): # Only use if the first mode fit doesn't work
+        popt3, pcov3 = _nan_curve_fit()
         
 #    try:
 #        poptn, pcovn = curve_fit(gaussian, xn, yn)
@@ -434,6 +744,10 @@ def _mode_max_from_dist_fit_worker(dist_arr, size_arr,
 #    except RuntimeError:
 #        poptn, pcovn = _nan_curve_fit()
 
+    if fit_info is not None:
+        fit_info['popt'] = [popt0, popt1, popt2, fit3]
+        fit_info['nfev'] = nfev
+
     if print_fit_params:
         # Print results
         print("First mode")
@@ -484,11 +798,11 @@ def _mode_max_from_dist_fit_worker(dist_arr, size_arr,
         
     
         # Extract the mode size from each mode
-        yf0_HR_max = round(df_HR['yf0_HR'].idxmax(skipna=True),1)
-        yf1_HR_max = round(df_HR['yf1_HR'].idxmax(skipna=True),1)
-        yf2_HR_max = round(df_HR['yf2_HR'].idxmax(skipna=True),1)
-        yf3_HR_max = round(df_HR['yf3_HR'].idxmax(skipna=True),1)
-#        yfn_HR_max = round(df_HR['yfn_HR'].idxmax(skipna=True),1)
+        yf0_HR_max = round(_nan_idxmax(df_HR['yf0_HR']),1)
+        yf1_HR_max = round(_nan_idxmax(df_HR['yf1_HR']),1)
+        yf2_HR_max = round(_nan_idxmax(df_HR['yf2_HR']),1)
+        yf3_HR_max = round(_nan_idxmax(df_HR['yf3_HR']),1)
+#        yfn_HR_max = round(_nan_idxmax(df_HR['yfn_HR']),1)
         
         
         if plot:            
@@ -524,9 +838,9 @@ def _mode_max_from_dist_fit_worker(dist_arr, size_arr,
         df = dff.loc[0:106].set_index(x_data)
     
         # Extract the mode size from each mode
-        yf0_max = round(df['yf0'].idxmax(skipna=True),1)
-        yf1_max = round(df['yf1'].idxmax(skipna=True),1)
-        yf2_max = round(df['yf2'].idxmax(skipna=True),1)
+        yf0_max = round(_nan_idxmax(df['yf0']),1)
+        yf1_max = round(_nan_idxmax(df['yf1']),1)
+        yf2_max = round(_nan_idxmax(df['yf2']),1)
         
         if plot:
             # Plot data
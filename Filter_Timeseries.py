@@ -10,7 +10,7 @@ def linearFit_filt(df,
                    subset_span_period_units = 'sec'):
     ''' Input data formats explained:
         df:                         the dataframe containing the data you want to filter
-        dfColumn:                   the column within the dataframe you want to filter
+        dfColumn:                   the column within the dataframe you want to filter, or a list of columns
         data_time_resolution_val:   the value of the time resolution (e.g. "5" if resolution is 5 seconds)
         data_time_resolution_units: the unit of the time resolution. Options of sec, min, hr, day
         subset_span_period:         the period over which the linear fit is calculated. MUST be in the same units as time resolution and a multiple of val
@@ -18,20 +18,16 @@ def linearFit_filt(df,
     
     Function removes outliers based on values being outside the residual of a linear regression to the 
     data from the previous subset_span_period (forward in time)
+
+    Each column is filtered separately (see _linearFit_filt_column) and
+    appended to the dataframe as <column>_filt.
     '''
                    
 
     import numpy as np
-    import matplotlib.pyplot as plt
-    import pandas as pd
-    
-    # Define MAD calculation
-    mad = lambda x: np.median(np.abs(x - np.median(x)))
     
-        
-    # Extract x and y vectors to fit
-    y = df[dfColumn].values.copy()
-    x = np.arange(len(y))
+    if isinstance(dfColumn, str):
+        dfColumn = [dfColumn]
     
     
     # Calculate the span
@@ -51,75 +47,176 @@ def linearFit_filt(df,
     else:
         return print("span period must be a multiple of the time resolution")
         
+    for col in dfColumn:
+        # Append data to original data frame
+        df[col+'_filt'] = _linearFit_filt_column(df[col].values, span)
+    return df
+
+def _linearFit_filt_column(y, span):
+    '''
+    Runs the linearFit_filt outlier test over the array y and returns a copy
+    with the outliers set to nan.
+
+    Going forward in time, the point y[i-1] is tested against a weighted
+    linear fit to the span points y[i-span:i]. The fit weights are 1 over the
+    first half of the window, 0.5 over the rest and 0 on the point itself.
+    The point is an outlier when its residual lies outside the median +/- 4
+    MADs of the other residuals. With 10 or fewer finite points in the window,
+    the last fit and its residual stats are reused, if there are more than 20
+    finite points between 1.5 and 0.5 spans back. The first span points aren't
+    tested, and neither is the final point.
 
+    Outliers are removed as they are found, so later windows don't see them.
+    The windows of a block of points are evaluated together, assuming no new
+    outliers. The block is kept up to its first outlier, which is removed,
+    and the next block starts after it.
+    '''
+    import numpy as np
+    
+    y = np.array(y, dtype=float)
+    n = len(y)
+    S = int(span)
+    
     # Weighting - more towards first half of fitting set, none on final point in question
-    w1 = np.ones(span/2)
-    w2 = np.ones(span/2-1)/2
-    w3 = np.zeros(1)
+    # (polyfit weights multiply the residuals, so least squares weights are their square)
+    weights = np.concatenate((np.ones(S//2), np.ones(S-S//2-1)/2, np.zeros(1)))
+    ls_weights = weights**2
+    
+    # Last fit: the step it was made at, its coefficients (in window bins)
+    # and the median and MAD of its residuals
+    fit = None
+    i0 = S
+    block = 64
+    while i0 < n:
+        i1 = min(i0 + block, n)
+        flagged, fit = _linearFit_filt_block(y, i0, i1, span, ls_weights, fit)
+        if flagged is None:
+            i0 = i1
+            block = min(block*2, 4096)
+        else:
+            # Later windows in the block saw the outlier, so start again after it
+            y[flagged-1] = np.nan
+            i0 = flagged + 1
+            block = 64
+    return y
+
+def _linearFit_filt_block(y, i0, i1, span, ls_weights, fit):
+    '''
+    Evaluates the _linearFit_filt_column test for steps i0 <= i < i1
+    together. Returns the first step whose point is an outlier (None if
+    there isn't one) and the last fit made up to that step.
+    '''
+    import numpy as np
+    from numpy.lib.stride_tricks import sliding_window_view
     
+    S = len(ls_weights)
+    steps = np.arange(i0, i1)
+    t = np.arange(S, dtype=float)
     
-    for i in range(len(y)):
-    #for i in range(0,6920):
-    #i = 5900 # 5928
-        weights = np.concatenate((w1,w2,w3),axis=0)
-        
-        ysub = y[i-int(span):i].copy()
-        xsub = x[i-int(span):i].copy()
-        
-        if np.isfinite(y[i-1]):    
-            if np.isfinite(ysub).sum() > 10: # only continue if there is sufficient data!
-                # Remove nan's since poly fitting doesn't work on them!
-                idx = np.isfinite(ysub)
+    win = sliding_window_view(y[i0-S:i1-1], S)
+    fin = np.isfinite(win)
+    point = win[:,-1]
     
-                ysub = ysub[idx]
-                xsub = xsub[idx]
-                weights = weights[idx]
-                
-                # Calculate polynomial
-                z = np.polyfit(xsub,ysub,1,w=weights)
-                f = np.poly1d(z)
-                
-                #Calculate new x's and y's
-                xfit = xsub
-                yfit = f(xfit)
-                
-                #print(i)
-                
-                # Calculate and get stats on residual 
-                res = ysub - yfit
-                med_val = np.median(res[0:-1])
-                mad_val = mad(res[0:-1])
-                
-                # Set values outside the range to nan
-                if ~(med_val - 4*mad_val < res[-1] < med_val + 4*mad_val):
-                    y[i-1] = np.nan
-            
-            elif ('z' in locals()) & (np.isfinite(y[i-int(1.5*span):i-int(0.5*span)]).sum() > 20): 
-            # if there is a previous fit, use it when there is some data recently, but not enough for a good fit
-                #Calculate new x's and y's using the previous z and f
-                xfit = xsub
-                yfit = f(xfit)
-                
-                #print(i)
-                
-    #            plt.plot(xsub,ysub,'o',xfit,yfit)
-    #            plt.xlim([xsub[0],xsub[-1]])
-    #            plt.show()
-    #            plt.close()            
-                
-                idx = np.isfinite(ysub)
-                
-                res = ysub[idx] - yfit[idx]
-                #med_val = np.median(res[0:-1])
-                #mad_val = mad(res[0:-1])
-                
-                if ~(med_val - 4*mad_val < res[-1] < med_val + 4*mad_val):
-                    y[i-1] = np.nan
-                    
-                
-    # Append data to original data frame
-    df[dfColumn+'_filt'] = y
-    return df
+    # Steps with enough data for a new fit
+    new_fit = np.isfinite(point) & (fin.sum(axis=1) > 10)
+    
+    # Weighted linear fit of each window, through its finite points
+    wf = fin[new_fit] * ls_weights
+    yf = np.where(fin[new_fit], win[new_fit], 0)
+    sw = wf.sum(axis=1)
+    st = wf @ t
+    stt = wf @ t**2
+    sy = (wf*yf).sum(axis=1)
+    sty = (wf*yf) @ t
+    slope = (sw*sty - st*sy) / (sw*stt - st**2)
+    intercept = (sy - slope*st) / sw
+    
+    # Median and MAD of the residuals, leaving out the point in question
+    res = win[new_fit,:-1] - (intercept[:,None] + slope[:,None]*t[:-1])
+    med_val = _row_nanmedian(res)
+    mad_val = _row_nanmedian(np.abs(res - med_val[:,None]))
+    res_point = point[new_fit] - (intercept + slope*(S-1))
+    
+    outlier = np.zeros(len(steps), dtype=bool)
+    outlier[new_fit] = ~((med_val - 4*mad_val < res_point) & 
+                         (res_point < med_val + 4*mad_val))
+    
+    # The last fit made before each step, as an index into the new fits
+    k_fit = np.cumsum(new_fit) - 1
+    
+    # Steps reusing an earlier fit, when there's some data recently
+    reuse = np.isfinite(point) & ~new_fit & ((k_fit >= 0) | (fit is not None))
+    if reuse.any():
+        recent = _finite_count_in_slices(y, steps - int(1.5*span), 
+                                         steps - int(0.5*span))
+        reuse &= recent > 20
+    if reuse.any():
+        k = k_fit[reuse]
+        earlier = k >= 0
+        k = np.maximum(k, 0)
+        if len(intercept) > 0:
+            fit_step = np.where(earlier, steps[new_fit][k], 0)
+            fit_int = np.where(earlier, intercept[k], 0.)
+            fit_slope = np.where(earlier, slope[k], 0.)
+            fit_med = np.where(earlier, med_val[k], 0.)
+            fit_mad = np.where(earlier, mad_val[k], 0.)
+        else:
+            fit_step = fit_int = fit_slope = fit_med = fit_mad = 0
+        if fit is not None:
+            fit_step = np.where(earlier, fit_step, fit[0])
+            fit_int = np.where(earlier, fit_int, fit[1])
+            fit_slope = np.where(earlier, fit_slope, fit[2])
+            fit_med = np.where(earlier, fit_med, fit[3])
+            fit_mad = np.where(earlier, fit_mad, fit[4])
+        # Previous fit evaluated at the point in question, in its window's bins
+        res_point = point[reuse] - (fit_int + fit_slope*
+                                    (steps[reuse] - 1 - (fit_step - S)))
+        outlier[reuse] = ~((fit_med - 4*fit_mad < res_point) & 
+                           (res_point < fit_med + 4*fit_mad))
+    
+    if outlier.any():
+        last = np.flatnonzero(outlier)[0]
+    else:
+        last = len(steps) - 1
+    
+    k = k_fit[last]
+    if k >= 0:
+        fit = (steps[new_fit][k], intercept[k], slope[k], med_val[k], mad_val[k])
+    
+    if outlier.any():
+        return steps[last], fit
+    return None, fit
+
+def _row_nanmedian(a):
+    '''
+    Returns the median of the finite values in each row of a (nan for rows
+    without any), the same as np.median of each row's finite values.
+    '''
+    import numpy as np
+    
+    a = np.sort(a, axis=1) # nan's are sorted to the end
+    count = np.isfinite(a).sum(axis=1)
+    rows = np.arange(len(a))
+    # The middle value, or the mean of the middle two, of the finite values
+    med = (a[rows, np.maximum(count-1, 0)//2] + a[rows, count//2])/2
+    med[count == 0] = np.nan
+    return med
+
+def _finite_count_in_slices(y, starts, ends):
+    '''
+    Returns the number of finite values in y[start:end] for each start and end,
+    following python's slicing rules for negative indices.
+    '''
+    import numpy as np
+    
+    n = len(y)
+    starts = np.clip(np.where(starts < 0, starts + n, starts), 0, n)
+    ends = np.clip(np.where(ends < 0, ends + n, ends), 0, n)
+    ends = np.maximum(starts, ends)
+    
+    lo = starts.min()
+    cum = np.concatenate(([0], np.cumsum(np.isfinite(y[lo:ends.max()]))))
+    return cum[ends-lo] - cum[starts-lo]
     
     
     
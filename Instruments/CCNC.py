@@ -26,10 +26,13 @@ import sys
 import pandas as pd
 import numpy as np
 import glob
+import io
 import pickle
 import importlib.util
 import datetime
 import argparse
+import time as systime
+import concurrent.futures
 import scipy
 from itertools import compress
 from scipy.interpolate import interp1d
@@ -45,6 +48,17 @@ sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')
 import atmoscripts
 pd.set_option('io.hdf.default_format', 'table')
 
+# Minutes of data removed after each change in supersaturation
+SS_SETTLE_TIME = 3
+
+# Processing stages which LoadAndProcess can save, in processing order
+CCN_STAGES = ['QC', 'flowCal', 'ssCal', 'logFilt', 'ssSplit']
+
+# Columns which the stages change, besides setting rows to nan and adding
+# columns, which are all the stage diffs need to be taken from
+CCN_STAGE_COLUMNS = ['Flow Ratio', 'CCN Number Conc', 'ccn_sigma',
+                     'Current SS', atmoscripts.QC_FLAG_COLUMN]
+
 def main():
     '''
     Collection of scripts to concatenate, QA/QC and perform flow calibrations
@@ -58,7 +72,7 @@ def main():
     where:
         raw_path (str) - path where raw data files exist
         output_path (str) - path where output data files are written
-        output_filetype (str) - either 'hdf', 'h5' or 'netcdf'
+        output_filetype (str) - either 'hdf', 'h5', 'netcdf' or 'parquet'
         output_time_resolution (str) - resolution of output data. Must be in
             the form '--#U' where # is a numeral and U is replaced with either
             "S" for seconds, "M" for minutes, "H" for hours, or "D" for days
@@ -81,7 +95,7 @@ def main():
                         files are written")
     parser.add_argument("-ext", "--output_file_extension", help="Extension of \
                         the output filetype. Options include 'hdf', \
-                        'h5' or 'netcdf'", default='hdf')
+                        'h5', 'netcdf' or 'parquet'", default='hdf')
     parser.add_argument("-res", "--output_time_resolution", help="time  \
                         resolution of output data. Default 1 second",
                         default='1S')
@@ -107,6 +121,12 @@ def main():
     parser.add_argument("--log_filt_file", help="file containing datetimes for\
                         removal. This file must be in the same folder as the \
                         raw data.")
+    parser.add_argument("--follow", help="follow the raw files as they are \
+                        written, processing new data until interrupted",
+                        action="store_true")
+    parser.add_argument("--poll_interval", help="seconds between checks for \
+                        new data when following the raw files. Default 5",
+                        default=5, type=float)
 
     args = parser.parse_args()
 
@@ -124,6 +144,8 @@ def main():
     atmos_press = args.atmos_press
     cal_press = args.cal_press
     log_filt_file = args.log_filt_file
+    follow = args.follow
+    poll_interval = args.poll_interval
 
     # Test that the inputs are the correct format
     if not os.path.exists(ccn_raw_data_path):
@@ -135,8 +157,8 @@ def main():
         print('Output data path does not exist. Creating new folder in:')
         print(ccn_output_data_path)
 
-    assert ccn_output_filetype.lower() in ['netcdf', 'h5', 'hdf'], \
-        "output filetype invalid! Please use either 'netcdf', 'h5', or 'hdf'"
+    assert ccn_output_filetype.lower() in ['netcdf', 'h5', 'hdf', 'parquet'], \
+        "output filetype invalid! Please use either 'netcdf', 'h5', 'hdf' or 'parquet'"
 
     if output_time_resolution not in ['--1S', '--5S', '--10S', '--15S', '--30S',
                                       '--1M', '--2M', '--5M', '--10M', '--15M',
@@ -164,7 +186,9 @@ def main():
                    log_filt_file=log_filt_file,
                    reload_from_source=reload_from_source,
                    atmos_press=atmos_press,
-                   cal_press=cal_press)
+                   cal_press=cal_press,
+                   follow=follow,
+                   poll_interval=poll_interval)
 
     return
 # end main
@@ -177,6 +201,8 @@ def LoadAndProcess(ccn_raw_path=None,
                    filename_base='CCN',
                    force_reload_from_source=False,
                    QC=False,
+                   ss_settle_time=SS_SETTLE_TIME,
+                   qc_counts=False,
                    output_time_resolution='1S',
                    concat_file_frequency='all',
                    mask_period_file=None,
@@ -189,12 +215,28 @@ def LoadAndProcess(ccn_raw_path=None,
                    press_cal=1010,
                    press_meas=1010,
                    split_by_supersaturation=True,
+                   ss_layout='wide',
+                   cascade_resample=False,
+                   cascade_exact=None,
                    input_filelist=None,
+                   workers=None,
+                   compact=False,
+                   stream_chunk=None,
+                   background_writes=True,
+                   persist_stages='all',
+                   stage_format='full',
+                   resume=False,
+                   report_memory=False,
+                   follow=False,
+                   poll_interval=5,
                    gui_mode=False,
                    gui_mainloop=None):
     '''
     Loads CCNC data from raw csv files, concatenates, then saved to output
-    files of either hdf or netcdf format.
+    files of either hdf or netcdf format, or to a parquet dataset. With
+    parquet, the concatenated raw data is kept in hdf files and the processed
+    data of each step is saved to the dataset in the output path (see
+    atmoscripts.df_to_parquet).
     Data can then be quality controlled using parameters output by the
     instrument.
     If a file containing flow calibration values is provided, it will then do a
@@ -202,16 +244,127 @@ def LoadAndProcess(ccn_raw_path=None,
     If a file is provided containing logged events for filtering, it will
     remove these periods
     If requested, it will perform exhaust removal (assuming its on the RVI)
+
+    ss_settle_time is the number of minutes removed by QC after each change in
+    supersaturation, or a dict of minutes keyed by the new supersaturation.
+    If qc_counts is True (along with QC), the resampled data has a
+    qc_<rule> column for each rule of ccn_qc_rules, counting the rows which
+    failed it in each period (see atmoscripts.qc_flag_counts). The counts
+    aren't made with the long layout or when processing in chunks.
+
+    If workers is an integer greater than 1, the raw csv files are parsed in
+    a pool of that many processes.
+
+    If compact is True, the raw data is parsed to float32 and small integer
+    columns, and the date and time strings aren't kept, which about halves
+    its size in memory and on disk. The SS setpoints and concentrations keep
+    full precision. See _parse_ccn_rows for the precision kept. The
+    uncertainties are stored as float32 too (see uncertainty_calc). The raw
+    files are only loaded again with force_reload_from_source.
+
+    ss_layout is the layout of the data split by supersaturation, 'wide'
+    (a column for each supersaturation) or 'long' (a row for each timestamp
+    and, once resampled, for each supersaturation in each period, with the
+    supersaturation in the 'ss' column). See ss_split. The long layout can't
+    be used when processing in chunks or following the raw files.
+
+    If cascade_resample is True, the longer time resampling intervals are
+    merged from the statistics of the shorter ones (see timebase_resampler).
+    This isn't used when processing in chunks or with the long layout.
+    cascade_exact is a list of the intervals whose median and MAD are still
+    calculated exactly from the data, or True for all of them.
+
+    If stream_chunk is given as a time period (e.g. '1D'), each concatenated
+    file is pushed through the processing in chunks of that period rather
+    than being loaded into memory whole. See process_ccn_stream.
+
+    If background_writes is True, the output of each step is written in a
+    background thread while the next step is processed (see
+    atmoscripts.start_writer). Each file's output is finished before the
+    next file is loaded, and errors from the writes are raised as usual.
+
+    persist_stages is 'all', 'none' or a list of the stages in CCN_STAGES
+    whose output is saved. With stage_format 'diff', only the rows each
+    saved stage set to nan and the columns it changed are saved, rather than
+    a full copy of the data (see save_stage). load_stage rebuilds a stage
+    from the concatenated raw file and the diffs.
+
+    The stages completed for each concatenated raw file are recorded in
+    checkpoints.jsonl in the output path, along with the parameters they were
+    run with and where their output was saved (see
+    atmoscripts.read_checkpoints). If resume is True, a file which has been
+    processed before with the same parameters is skipped, and one whose
+    processing was cut short carries on from the output of the last stage
+    that was saved, rather than starting over. Only saved stages can be
+    resumed from, so with persist_stages 'none' a file is either skipped or
+    processed from the start. Files processed in chunks aren't checkpointed.
+
+    The stages work on the data in place rather than on copies of it. If
+    report_memory is True, the memory each stage allocates is printed (see
+    atmoscripts.report_memory).
+
+    If follow is True, the raw csv files in ccn_raw_path are followed as the
+    instrument writes them instead, processing the new rows every
+    poll_interval seconds until interrupted. See follow_ccn. Following
+    can't be combined with the options of the batch processing which it
+    doesn't support: load_from_filetype, input_filelist, workers,
+    cascade_resample, cascade_exact, stream_chunk, persist_stages,
+    stage_format, resume and report_memory.
     '''
     print('ccn_raw_path is ', ccn_raw_path)
 
     if ccn_output_path is None:
         ccn_output_path = ccn_raw_path
 
+    assert ss_layout in SS_LAYOUTS, "ss_layout must be one of " + str(SS_LAYOUTS)
+    assert ss_layout == 'wide' or not (follow or stream_chunk), \
+        "The long ss_layout can't be used with follow or stream_chunk"
+
+    if follow:
+        unsupported = {'load_from_filetype': load_from_filetype != 'csv',
+                       'input_filelist': input_filelist is not None,
+                       'workers': (workers or 1) > 1,
+                       'cascade_resample': cascade_resample,
+                       'cascade_exact': cascade_exact is not None,
+                       'stream_chunk': stream_chunk is not None,
+                       'persist_stages': persist_stages != 'all',
+                       'stage_format': stage_format != 'full',
+                       'resume': resume,
+                       'report_memory': report_memory}
+        assert not any(unsupported.values()), "follow can't be used with " + \
+            ', '.join(name for name, used in unsupported.items() if used)
+
+        follow_ccn(ccn_raw_path,
+                   ccn_output_path=ccn_output_path,
+                   ccn_output_filetype=ccn_output_filetype,
+                   filename_base=filename_base,
+                   poll_interval=poll_interval,
+                   QC=QC,
+                   ss_settle_time=ss_settle_time,
+                   qc_counts=qc_counts,
+                   output_time_resolution=output_time_resolution,
+                   mask_period_file=mask_period_file,
+                   mask_period_timestamp_df=mask_period_timestamp_df,
+                   flow_cal_file=flow_cal_file,
+                   flow_cal_df=flow_cal_df,
+                   flow_setpt=flow_setpt,
+                   flow_polyDeg=flow_polyDeg,
+                   press_cal=press_cal,
+                   press_meas=press_meas,
+                   split_by_supersaturation=split_by_supersaturation,
+                   compact=compact)
+        return
+
     if ccn_raw_path is None:
         input_str_list = input_filelist[0].split('/')
         ccn_raw_path = '/'.join(input_str_list[:-1])+'/'
 
+    # The raw data is concatenated to hdf when saving to parquet
+    if ccn_output_filetype == 'parquet':
+        raw_filetype = 'h5'
+    else:
+        raw_filetype = ccn_output_filetype
+
     if load_from_filetype == "csv":
         # Concatenate csv files
         concatenate_from_csv(ccn_raw_path,
@@ -222,11 +375,13 @@ def LoadAndProcess(ccn_raw_path=None,
                              ccn_output_filetype,
                              force_reload_from_source,
                              input_filelist=input_filelist,
+                             workers=workers,
+                             compact=compact,
                              gui_mode=gui_mode,
                              gui_mainloop=gui_mainloop)
 
         raw_filelist = get_raw_filelist(ccn_output_path,
-                                        ccn_output_filetype,
+                                        raw_filetype,
                                         substring='raw')
 
     elif load_from_filetype in ['h5', 'hdf']:
@@ -237,95 +392,843 @@ def LoadAndProcess(ccn_raw_path=None,
         else:
             raw_filelist = list(input_filelist)
 
-    for file in raw_filelist:
-        # Load data
-        if os.path.isfile(file):
-            ccn_data = load_ccn(ccn_raw_path,
-                                load_from_filetype,
-                                filepath=file)
-        else:
-            if load_from_filetype == "csv":
-                ccn_data = load_ccn(ccn_output_path,
-                                    ccn_output_filetype,
-                                    substring=file)
+    writer = atmoscripts.start_writer() if background_writes else None
+    report = atmoscripts.start_memory_report() if report_memory else None
+    persist = atmoscripts.persisted_stages(persist_stages, CCN_STAGES)
+    assert stage_format in ['full', 'diff'], "stage_format must be 'full' or 'diff'"
+
+    # The parameters that go into the output of each stage, for checkpointing.
+    # The data frames are copied, as the processing can modify them.
+    settings = {'output_filetype': ccn_output_filetype,
+                'stage_format': stage_format,
+                'persist': persist if stage_format == 'diff' else None}
+    stage_params = []
+    if QC:
+        stage_params.append(('QC', {'ss_settle_time': ss_settle_time}))
+    if flow_cal_file is not None:
+        stage_params.append(('flowCal', {
+                'flow_cal': atmoscripts.checkpoint_file(ccn_raw_path, flow_cal_file),
+                'flow_setpt': flow_setpt,
+                'flow_polyDeg': flow_polyDeg}))
+    elif flow_cal_df is not None:
+        stage_params.append(('flowCal', {'flow_cal': flow_cal_df.copy(),
+                                         'flow_setpt': flow_setpt,
+                                         'flow_polyDeg': flow_polyDeg}))
+    stage_params.append(('ssCal', {'press_meas': press_meas,
+                                   'press_cal': press_cal}))
+    if mask_period_file is not None:
+        stage_params.append(('logFilt', {
+                'mask': atmoscripts.checkpoint_file(ccn_raw_path, mask_period_file)}))
+    elif mask_period_timestamp_df is not None:
+        stage_params.append(('logFilt', {'mask': mask_period_timestamp_df.copy()}))
+    qc_counts = qc_counts and QC
+    stage_params.append(('ssSplit', {'split_by_supersaturation':
+                                     split_by_supersaturation,
+                                     'ss_layout': ss_layout,
+                                     'qc_counts': qc_counts}))
+    stage_params.append(('resample', {'time_int': output_time_resolution,
+                                      'cascade': cascade_resample,
+                                      'cascade_exact': cascade_exact,
+                                      'qc_counts': qc_counts}))
+    checkpoints = atmoscripts.read_checkpoints(ccn_output_path) if resume else {}
+
+    # The writes already queued are finished if the processing stops part
+    # way (e.g. on Ctrl-C), so the stages saved before then are checkpointed
+    try:
+        for file in raw_filelist:
+            # Find the data file
+            if os.path.isfile(file):
+                fname, filetype = find_ccn_file(ccn_raw_path,
+                                                load_from_filetype,
+                                                filepath=file)
+            elif load_from_filetype == "csv":
+                fname, filetype = find_ccn_file(ccn_output_path,
+                                                raw_filetype,
+                                                substring=file)
             else:
+                fname, filetype = find_ccn_file(ccn_raw_path,
+                                                load_from_filetype,
+                                                substring=file)
+            fname = os.path.abspath(fname)
+
+            if stream_chunk is not None:
+                process_ccn_stream(fname, filetype, file,
+                                   ccn_raw_path=ccn_raw_path,
+                                   ccn_output_path=ccn_output_path,
+                                   ccn_output_filetype=ccn_output_filetype,
+                                   stream_chunk=stream_chunk,
+                                   QC=QC,
+                                   ss_settle_time=ss_settle_time,
+                                   output_time_resolution=output_time_resolution,
+                                   mask_period_file=mask_period_file,
+                                   mask_period_timestamp_df=mask_period_timestamp_df,
+                                   flow_cal_file=flow_cal_file,
+                                   flow_cal_df=flow_cal_df,
+                                   flow_setpt=flow_setpt,
+                                   flow_polyDeg=flow_polyDeg,
+                                   press_cal=press_cal,
+                                   press_meas=press_meas,
+                                   split_by_supersaturation=split_by_supersaturation,
+                                   compact=compact,
+                                   gui_mode=gui_mode,
+                                   gui_mainloop=gui_mainloop)
+                continue
+
+            # Find the stages already done
+            checkpoint = {'path': fname,
+                          'output_path': ccn_output_path,
+                          'settings': settings,
+                          'stage_params': stage_params}
+            resumed = None
+            if resume:
+                resumed = atmoscripts.resume_checkpoint(checkpoints, fname,
+                                                        settings, stage_params)
+            done = atmoscripts.resumed_stages(resumed, stage_params)
+            if 'resample' in done:
+                print(file + ' has already been processed, skipping')
+                continue
+
+            # Load data
+            if resumed is not None:
+                print('Resuming ' + file + ' from its ' + resumed['stage'] + ' output')
+                ccn_data = load_checkpoint(resumed, ccn_output_path, fname,
+                                           ccn_output_filetype, stage_format,
+                                           persist_stages, split_by_supersaturation,
+                                           ss_layout, qc_counts)
+            elif os.path.isfile(file):
                 ccn_data = load_ccn(ccn_raw_path,
                                     load_from_filetype,
-                                    substring=file)
-            # plot_me(ccn_data, plot_each_step, 'CCN Number Conc', 'raw')
+                                    filepath=file)
+            else:
+                if load_from_filetype == "csv":
+                    ccn_data = load_ccn(ccn_output_path,
+                                        raw_filetype,
+                                        substring=file)
+                else:
+                    ccn_data = load_ccn(ccn_raw_path,
+                                        load_from_filetype,
+                                        substring=file)
+                # plot_me(ccn_data, plot_each_step, 'CCN Number Conc', 'raw')
+            atmoscripts.report_memory(report, 'load')
+
+            # The data as last saved, which the diffs are taken from
+            diff_base = None
+            if stage_format == 'diff':
+                diff_base = atmoscripts.stage_snapshot(ccn_data, CCN_STAGE_COLUMNS)
+
+            # Calculate CCN counting uncertainty
+            if resumed is None:
+                ccn_data = uncertainty_calc(ccn_data, 1, np.sqrt(ccn_data['CCN Number Conc']),
+                                            sigma_dtype=np.float32 if compact else None)
+
+            # Hold the data in one block, which the stages below modify in place.
+            # Data resumed after the split is already held as ss_split left it.
+            if 'ssSplit' not in done:
+                ccn_data = atmoscripts.column_store(ccn_data,
+                                                    ['Flow Ratio']
+                                                    if QC and 'QC' not in done
+                                                    else None)
+            atmoscripts.report_memory(report, 'uncertainty')
+
+            # QC data for internal parameters and for changes in SS
+            if QC and 'QC' not in done:
+                ccn_data = DataQC(ccn_data, ss_settle_time=ss_settle_time)
+                diff_base = save_stage(ccn_data, ccn_output_path, 'QC',
+                                       ccn_output_filetype, file, persist,
+                                       stage_format, diff_base, writer,
+                                       checkpoint)
+                atmoscripts.report_memory(report, 'QC')
+                # plot_me(ccn_data, plot_each_step,'CCN Number Conc', 'QC')
+
+            # The saved data is written as it is rather than copied, so each
+            # stage waits for the writes before modifying it
+            atmoscripts.wait_for_writes(writer)
+
+            # Perform flow calibration if data is provided
+            if 'flowCal' in done:
+                pass
+            elif flow_cal_file is not None:
+                ccn_data = flow_cal(ccn_data,
+                                    flow_cal_file,
+                                    ccn_raw_path,
+                                    set_flow_rate=flow_setpt,
+                                    polydeg=flow_polyDeg)
+                diff_base = save_stage(ccn_data, ccn_output_path, 'flowCal',
+                                       ccn_output_filetype, file, persist,
+                                       stage_format, diff_base, writer,
+                                       checkpoint)
+                atmoscripts.report_memory(report, 'flowCal')
+                # plot_me(ccn_data, plot_each_step,'CCN Number Conc','flow cal')
+
+            elif flow_cal_df is not None:
+                ccn_data = flow_cal(ccn_data,
+                                    measured_flows_df=flow_cal_df,
+                                    set_flow_rate=flow_setpt,
+                                    polydeg=flow_polyDeg)
+
+                diff_base = save_stage(ccn_data, ccn_output_path, 'flowCal',
+                                       ccn_output_filetype, file, persist,
+                                       stage_format, diff_base, writer,
+                                       checkpoint)
+                atmoscripts.report_memory(report, 'flowCal')
+                # plot_me(ccn_data, plot_each_step,'CCN Number Conc','flow cal')
+
+            # Calibrate supersaturation
+            atmoscripts.wait_for_writes(writer)
+            if 'ssCal' not in done:
+                ccn_data = ss_cal(ccn_data, press_meas, press_cal)
+                diff_base = save_stage(ccn_data, ccn_output_path, 'ssCal',
+                                       ccn_output_filetype, file, persist,
+                                       stage_format, diff_base, writer,
+                                       checkpoint)
+                atmoscripts.report_memory(report, 'ssCal')
+
+
+            # Correct for inlet losses #xkcd
+        #    ccn_data = inlet_corrections(ccn_data, IE)
+        #    save_as(ccn_data,ccn_output_data_path,'IE',ccn_output_filetype)
+        #   plot_me(ccn_data, plot_each_step,'CCN Number Conc', 'IE')
+
+            # Filter for logged events
+            atmoscripts.wait_for_writes(writer)
+            if 'logFilt' in done:
+                pass
+            elif mask_period_file is not None:
+                ccn_data = atmoscripts.log_filter(ccn_data, ccn_raw_path, mask_period_file)
+                diff_base = save_stage(ccn_data, ccn_output_path, 'logFilt',
+                                       ccn_output_filetype, file, persist,
+                                       stage_format, diff_base, writer,
+                                       checkpoint)
+                atmoscripts.report_memory(report, 'logFilt')
+                # plot_me(ccn_data, plot_each_step,'CCN Number Conc','log filter')
+
+            elif mask_period_timestamp_df is not None:
+                ccn_data = atmoscripts.log_filter(ccn_data, log_mask_df=mask_period_timestamp_df)
+                diff_base = save_stage(ccn_data, ccn_output_path, 'logFilt',
+                                       ccn_output_filetype, file, persist,
+                                       stage_format, diff_base, writer,
+                                       checkpoint)
+                atmoscripts.report_memory(report, 'logFilt')
+                # plot_me(ccn_data, plot_each_step,'CCN Number Conc','log filter')
+
+            # Filter for exhaust #xkcd
+        #    save_as(ccn_data,ccn_output_path,'exhaustfilt',ccn_output_filetype)
+
+            # Separate into different supersaturations. As a diff, the changes
+            # up to the split are saved, and load_stage splits the data again.
+            # The QC flags are carried through the split if they're counted.
+            if 'ssSplit' not in done:
+                if stage_format == 'diff':
+                    save_stage(ccn_data, ccn_output_path, 'ssSplit',
+                               ccn_output_filetype, file, persist,
+                               stage_format, diff_base, writer, checkpoint)
+                ccn_data = ss_split(ccn_data, split_by_supersaturation, ss_layout,
+                                    qc_counts)
+                if stage_format == 'full':
+                    save_stage(ccn_data, ccn_output_path, 'ssSplit',
+                               ccn_output_filetype, file, persist,
+                               writer=writer, checkpoint=checkpoint)
+                atmoscripts.report_memory(report, 'ssSplit')
+            # plot_me(ccn_data, plot_each_step,None,'SS Split')
+
+            # Resample timebase and calculate uncertainties
+            resampled = []
+            ccn_data = timebase_resampler(ccn_data,
+                                          time_int=output_time_resolution,
+                                          split_by_supersaturation=split_by_supersaturation,
+                                          ss_layout=ss_layout,
+                                          input_h5_filename=file,
+                                          output_filetype=ccn_output_filetype,
+                                          cascade=cascade_resample,
+                                          cascade_exact=cascade_exact,
+                                          qc_rules=ccn_qc_rules() if qc_counts
+                                                   else None,
+                                          writer=writer,
+                                          outputs=resampled,
+                                          gui_mode=gui_mode,
+                                          gui_mainloop=gui_mainloop)
+            atmoscripts.submit_checkpoint(writer, checkpoint, 'resample',
+                                          resampled)
+
+            # Finish writing before the next file is loaded
+            atmoscripts.wait_for_writes(writer)
+            atmoscripts.report_memory(report, 'resample')
+    finally:
+        atmoscripts.stop_writer(writer)
+        atmoscripts.stop_memory_report(report)
+
+    if os.path.isfile('netcdf_global_attributes.temp'):
+        os.remove('netcdf_global_attributes.temp')
+
+    return
+
+# end LoadAndProcess
+
+def process_ccn_stream(fname,
+                       filetype,
+                       file,
+                       ccn_raw_path=None,
+                       ccn_output_path=None,
+                       ccn_output_filetype='hdf',
+                       stream_chunk='1D',
+                       QC=False,
+                       ss_settle_time=SS_SETTLE_TIME,
+                       output_time_resolution='1S',
+                       mask_period_file=None,
+                       mask_period_timestamp_df=None,
+                       flow_cal_file=None,
+                       flow_cal_df=None,
+                       flow_setpt=500,
+                       flow_polyDeg=2,
+                       press_cal=1010,
+                       press_meas=1010,
+                       split_by_supersaturation=True,
+                       compact=False,
+                       gui_mode=False,
+                       gui_mainloop=None):
+    '''
+    Does the processing of LoadAndProcess for a single concatenated file, fname,
+    reading it in chunks of stream_chunk (e.g. '1D') so that only one chunk is
+    held in memory at a time. file is the name of the file in the raw file
+    list, which the output filenames are based on.
+
+    Each chunk goes through the same steps as in LoadAndProcess and is
+    appended to the output file of each step. The only state carried between
+    chunks is the SS transition period being removed by DataQC and the rows of
+    the last, possibly incomplete, time resampling period. Splitting by
+    supersaturation needs the full list of supersaturations before any output
+    can be written, so the data needed for it is stored for each chunk in a
+    temporary file and split in a second pass.
+
+    The output is the same as when processing the whole file at once, except
+    that integer columns are always stored as floats from the steps which
+    remove data (QC and the log filter). This is also the case when the
+    whole file is processed, as long as at least one row is removed.
+    The resampled data is saved when the whole file has been processed.
+    Time resampling intervals must divide a day evenly, so that the periods
+    line up with those of the whole file. If compact is True, the
+    uncertainties are stored as float32 (see uncertainty_calc).
+    '''
+    print('Processing ' + fname + ' in chunks of ' + stream_chunk)
+    os.chdir(ccn_output_path)
+
+    time_int = [t for t in get_time_intervals(output_time_resolution)
+                if t != '1S']
+    for time in time_int:
+        assert pd.Timedelta('1D') % pd.Timedelta(time) == pd.Timedelta(0), \
+            'Time resampling intervals must divide a day evenly when processing in chunks'
+
+    # Load the calibration and mask files once, rather than for each chunk
+    if (flow_cal_file is not None):
+        flow_cal_df = load_flow_cals(flow_cal_file, ccn_raw_path)
+    if mask_period_file is not None:
+        mask_period_timestamp_df = atmoscripts.load_mask_periods(ccn_raw_path,
+                                                                 mask_period_file)
+        os.chdir(ccn_output_path)
+    elif mask_period_timestamp_df is not None:
+        mask_period_timestamp_df = atmoscripts.merge_mask_periods(mask_period_timestamp_df)
+
+    ss_carry = {}          # SS transition state for DataQC
+    resample_carry = {}    # Rows held back for each time resampling interval
+    resampled = {time: [] for time in time_int}
+    stage_files = {}       # Output file of each processing step
+
+    # Temporary file holding the data needed to split by supersaturation
+    split_store_name = os.path.join(ccn_output_path,
+                                    os.path.basename(fname).split('.')[0] + '_stream.tmp')
+    split_store = None
+    ss_list = []
+    nchunks = 0
+
+    for ccn_data in iter_ccn_chunks(fname, filetype, stream_chunk):
+        print('Processing chunk starting ' + str(ccn_data.index[0]))
 
         # Calculate CCN counting uncertainty
-        ccn_data = uncertainty_calc(ccn_data, 1, np.sqrt(ccn_data['CCN Number Conc']))
+        ccn_data = uncertainty_calc(ccn_data, 1, np.sqrt(ccn_data['CCN Number Conc']),
+                                    sigma_dtype=np.float32 if compact else None)
 
         # QC data for internal parameters and for changes in SS
         if QC:
-            ccn_data = DataQC(ccn_data)
-            save_as(ccn_data, ccn_output_path, 'QC', ccn_output_filetype, file)
-            # plot_me(ccn_data, plot_each_step,'CCN Number Conc', 'QC')
+            ccn_data = _float_int_columns(DataQC(ccn_data,
+                                                    ss_carry=ss_carry,
+                                                    ss_settle_time=ss_settle_time))
+            _append_stage(ccn_data, ccn_output_path, 'QC',
+                          ccn_output_filetype, file, stage_files)
 
         # Perform flow calibration if data is provided
-        if flow_cal_file is not None:
-            ccn_data = flow_cal(ccn_data,
-                                flow_cal_file,
-                                ccn_raw_path,
-                                set_flow_rate=flow_setpt,
-                                polydeg=flow_polyDeg)
-            save_as(ccn_data, ccn_output_path, 'flowCal', ccn_output_filetype, file)
-            # plot_me(ccn_data, plot_each_step,'CCN Number Conc','flow cal')
-
-        elif flow_cal_df is not None:
+        if flow_cal_df is not None:
             ccn_data = flow_cal(ccn_data,
                                 measured_flows_df=flow_cal_df,
                                 set_flow_rate=flow_setpt,
                                 polydeg=flow_polyDeg)
-
-            save_as(ccn_data, ccn_output_path, 'flowCal', ccn_output_filetype, file)
-            # plot_me(ccn_data, plot_each_step,'CCN Number Conc','flow cal')
+            _append_stage(ccn_data, ccn_output_path, 'flowCal',
+                          ccn_output_filetype, file, stage_files)
 
         # Calibrate supersaturation
         ccn_data = ss_cal(ccn_data, press_meas, press_cal)
-        save_as(ccn_data, ccn_output_path, 'ssCal', ccn_output_filetype, file)
+        _append_stage(ccn_data, ccn_output_path, 'ssCal',
+                      ccn_output_filetype, file, stage_files)
 
+        # Filter for logged events
+        if mask_period_timestamp_df is not None:
+            ccn_data = atmoscripts.log_filter(ccn_data, log_mask_df=mask_period_timestamp_df)
+            if len(mask_period_timestamp_df) > 0:
+                ccn_data = _float_int_columns(ccn_data)
+            _append_stage(ccn_data, ccn_output_path, 'logFilt',
+                          ccn_output_filetype, file, stage_files)
+
+        if split_by_supersaturation:
+            # Keep track of the supersaturations in the order they appear
+            for ss in ccn_data['Current SS'].unique():
+                if (not np.isnan(ss)) and (ss not in ss_list):
+                    ss_list.append(ss)
+
+            # Store what is needed to split by supersaturation
+            split_cols = ['Current SS', 'CCN Number Conc'] + \
+                         [col for col in SS_SPLIT_UNCERT_COLS if col in ccn_data]
+            if split_store is None:
+                split_store = pd.HDFStore(split_store_name, mode='w')
+            split_store.put('chunk' + str(nchunks), ccn_data[split_cols],
+                            format='fixed')
+        else:
+            # The data isn't changed by splitting
+            _append_stage(ccn_data, ccn_output_path, 'ssSplit',
+                          ccn_output_filetype, file, stage_files)
+            for time in time_int:
+                resampled[time].append(
+                        _resample_chunk(ccn_data, time,
+                                        split_by_supersaturation,
+                                        resample_carry))
+        nchunks = nchunks + 1
+
+    if split_by_supersaturation and (split_store is not None):
+        # Second pass: split by supersaturation with the full list of
+        # supersaturations, then resample
+        print('Splitting ' + str(nchunks) + ' chunks by supersaturation')
+        split_columns = ss_split_columns(ss_list)
+        for n in range(nchunks):
+            split_data = split_store.get('chunk' + str(n))
+            split_data = _ss_split_chunk(split_data, ss_list, split_columns)
+            if len(split_data) == 0:
+                continue
+            _append_stage(split_data, ccn_output_path, 'ssSplit',
+                          ccn_output_filetype, file, stage_files)
+            for time in time_int:
+                resampled[time].append(
+                        _resample_chunk(split_data, time,
+                                        split_by_supersaturation,
+                                        resample_carry))
+        split_store.close()
+        os.remove(split_store_name)
+
+    # Resample the last rows held back, and save the resampled data
+    os.chdir(ccn_output_path)
+    for time in time_int:
+        resampled[time].append(
+                _resample_chunk(None, time, split_by_supersaturation,
+                                resample_carry))
+        resampled_list = [d for d in resampled[time] if (d is not None) and (len(d) > 0)]
+        if len(resampled_list) == 0:
+            continue
+        data_resamp = pd.concat(resampled_list).asfreq(time)
+        save_resampled_data(None, data_resamp, time,
+                            'ccn', file,
+                            ccn_output_filetype,
+                            gui_mode,
+                            gui_mainloop)
 
-        # Correct for inlet losses #xkcd
-    #    ccn_data = inlet_corrections(ccn_data, IE)
-    #    save_as(ccn_data,ccn_output_data_path,'IE',ccn_output_filetype)
-    #   plot_me(ccn_data, plot_each_step,'CCN Number Conc', 'IE')
+    return
 
-        # Filter for logged events
-        if mask_period_file is not None:
-            ccn_data = atmoscripts.log_filter(ccn_data, ccn_raw_path, mask_period_file)
-            save_as(ccn_data, ccn_output_path, 'logFilt', ccn_output_filetype, file)
-            # plot_me(ccn_data, plot_each_step,'CCN Number Conc','log filter')
+def iter_ccn_chunks(fname, filetype, stream_chunk='1D', read_rows=100000):
+    '''
+    Generator which reads a concatenated CCN data file read_rows at a time and
+    yields it in consecutive chunks covering one period of stream_chunk each
+    (e.g. '1D'). The file must be in time order, as written by
+    save_ccn_to_hdf.
+    '''
+    if filetype in ['hdf', 'h5']:
+        try:
+            reader = pd.read_hdf(fname, key='ccn', chunksize=read_rows)
+        except TypeError:
+            # Only hdf files in table format can be read in pieces
+            reader = [pd.read_hdf(fname, key='ccn')]
+    elif filetype == 'csv':
+        reader = pd.read_csv(fname,
+                             skipinitialspace=True,
+                             index_col=0,
+                             parse_dates=True,
+                             infer_datetime_format=True,
+                             chunksize=read_rows)
+    else:
+        reader = [load_ccn(filetype=filetype, filepath=fname)]
+
+    pending = None
+    for rows in reader:
+        if pending is not None:
+            rows = pd.concat([pending, rows])
+        period = rows.index.floor(stream_chunk)
+        # Yield each period which is complete, i.e. all except the last
+        starts = np.flatnonzero(period[1:] != period[:-1]) + 1
+        i0 = 0
+        for i1 in starts:
+            yield rows.iloc[i0:i1].copy()
+            i0 = i1
+        pending = rows.iloc[i0:]
+    if (pending is not None) and (len(pending) > 0):
+        yield pending.copy()
+
+def _append_stage(data, save_path, filename_appendage, filetype,
+                  fname_current, stage_files):
+    '''
+    Appends a chunk of data to the output file of a processing step, creating
+    it for the first chunk. Files are named as in save_as, and the names are
+    kept in stage_files for the following chunks.
+    '''
+    os.chdir(save_path)
+    first = filename_appendage not in stage_files
 
-        elif mask_period_timestamp_df is not None:
-            ccn_data = atmoscripts.log_filter(ccn_data, log_mask_df=mask_period_timestamp_df)
-            save_as(ccn_data, ccn_output_path, 'logFilt', ccn_output_filetype, file)
-            # plot_me(ccn_data, plot_each_step,'CCN Number Conc','log filter')
-
-        # Filter for exhaust #xkcd
-    #    save_as(ccn_data,ccn_output_path,'exhaustfilt',ccn_output_filetype)
-
-        # Separate into different supersaturations
-        ccn_data = ss_split(ccn_data, split_by_supersaturation)
-        save_as(ccn_data, ccn_output_path, 'ssSplit', ccn_output_filetype, file)
-        # plot_me(ccn_data, plot_each_step,None,'SS Split')
-
-        # Resample timebase and calculate uncertainties
-        ccn_data = timebase_resampler(ccn_data,
-                                      time_int=output_time_resolution,
-                                      split_by_supersaturation=split_by_supersaturation,
-                                      input_h5_filename=file,
-                                      output_filetype=ccn_output_filetype,
-                                      gui_mode=gui_mode,
-                                      gui_mainloop=gui_mainloop)
+    if filetype in ['hdf', 'h5']:
+        if first:
+            stage_files[filename_appendage] = os.path.abspath(
+                    get_ccn_filenamebase('h5', filename_appendage, fname_current))
+        # Strings are given the width of the date and time strings, so that
+        # later chunks always fit
+        min_itemsize = {col: 8 for col in data.columns
+                        if data[col].dtype == object}
+        data.to_hdf(stage_files[filename_appendage], key='ccn',
+                    format='table', append=not first,
+                    min_itemsize=min_itemsize if first else None)
 
-    if os.path.isfile('netcdf_global_attributes.temp'):
-        os.remove('netcdf_global_attributes.temp')
+    elif filetype in ['netcdf', 'nc']:
+        # Not saved, as in save_as
+        stage_files[filename_appendage] = None
 
+    elif filetype == 'parquet':
+        # The dates written so far, which later chunks are added to
+        if first:
+            stage_files[filename_appendage] = set()
+        atmoscripts.df_to_parquet(data, save_path, 'CCN', filename_appendage,
+                                  append_dates=stage_files[filename_appendage])
+
+    elif filetype == 'csv':
+        if first:
+            stage_files[filename_appendage] = os.path.abspath(
+                    get_ccn_filenamebase('csv', filename_appendage, fname_current))
+        data.to_csv(stage_files[filename_appendage],
+                    mode='w' if first else 'a', header=first,
+                    date_format='%Y-%m-%d %H:%M:%S')
     return
 
-# end LoadAndProcess
+def _float_int_columns(data):
+    '''
+    Converts integer columns to floats. Setting any row to nan does this to
+    the whole dataset, so chunks are converted regardless of whether they
+    had rows removed. The QC flags are never set to nan, so stay integers.
+    '''
+    for col in data.columns:
+        if data[col].dtype.kind in 'iub' and col != atmoscripts.QC_FLAG_COLUMN:
+            data[col] = data[col].astype(
+                    atmoscripts.exact_float_dtype(data[col].dtype))
+    return data
+
+def _resample_chunk(data, time, split_by_supersaturation, carry,
+                    qc_rules=None):
+    '''
+    Resamples a chunk of data to a single time interval for process_ccn_stream
+    and follow_ccn. The rows of the last period may continue into the next
+    chunk, so they are held back in carry and resampled along with the next
+    chunk. Pass None as the data to resample what is held back after the last
+    chunk. qc_rules are passed to resample_interval.
+    '''
+    held = carry.pop(time, None)
+    if data is None:
+        data = held
+    elif held is not None:
+        data = pd.concat([held, data])
+    if (data is None) or (len(data) == 0):
+        return None
+
+    data_resamp = resample_interval(data, time, split_by_supersaturation,
+                                    qc_rules=qc_rules)
+
+    if held is not data:
+        # Hold back the last period, which may not be complete
+        carry[time] = data[data.index >= data_resamp.index[-1]]
+        data_resamp = data_resamp.iloc[:-1]
+    return data_resamp
+
+def follow_ccn(ccn_raw_path,
+               ccn_output_path=None,
+               ccn_output_filetype='hdf',
+               filename_base='CCN',
+               poll_interval=5,
+               from_start=False,
+               QC=False,
+               ss_settle_time=SS_SETTLE_TIME,
+               qc_counts=False,
+               output_time_resolution='default',
+               mask_period_file=None,
+               mask_period_timestamp_df=None,
+               flow_cal_file=None,
+               flow_cal_df=None,
+               flow_setpt=500,
+               flow_polyDeg=2,
+               press_cal=1010,
+               press_meas=1010,
+               split_by_supersaturation=True,
+               compact=False,
+               max_polls=None):
+    '''
+    Real-time mode: follows the raw csv files being written by the CCN-100 in
+    ccn_raw_path, and every poll_interval seconds pushes the rows appended
+    since the last poll through the processing of LoadAndProcess. Only the
+    new part of each file is read, so the cost of a poll depends on the new
+    data rather than the size of the files. Runs until interrupted (Ctrl-C),
+    or for max_polls polls if it's given.
+
+    The output of each step is appended to files named as in
+    atmoscripts.live_output_filename (e.g. CCN_live_raw_QC.h5), and the
+    periods of each time resampling interval are appended as soon as they
+    are complete. The output filetype must be hdf, h5, csv or parquet.
+    When a supersaturation is seen for the first time, the output of the
+    SS split and the resampled data is rewritten with its new column.
+
+    Files which exist when following starts are read from their current end,
+    unless from_start is True, while files created later are read from the
+    start. The offset reached in each file is kept in the output path, so
+    following can be stopped and started again without losing data. The
+    offsets are saved after the output of each poll, so rows may be repeated
+    in the output if it's stopped while writing.
+
+    The mask period file is checked for changes on each poll. If compact is
+    True, the new rows are parsed to compact dtypes (see _parse_ccn_rows).
+    qc_counts is as for LoadAndProcess.
+    '''
+    if ccn_output_path is None:
+        ccn_output_path = ccn_raw_path
+    qc_counts = qc_counts and QC
+    qc_rules = ccn_qc_rules() if qc_counts else None
+    ccn_raw_path = os.path.abspath(ccn_raw_path)
+    ccn_output_path = os.path.abspath(ccn_output_path)
+
+    time_int = [t for t in get_time_intervals(output_time_resolution)
+                if t != '1S']
+    for time in time_int:
+        assert pd.Timedelta('1D') % pd.Timedelta(time) == pd.Timedelta(0), \
+            'Time resampling intervals must divide a day evenly when following files'
+
+    if flow_cal_file is not None:
+        flow_cal_df = load_flow_cals(flow_cal_file, ccn_raw_path)
+    if mask_period_timestamp_df is not None:
+        mask_period_timestamp_df = atmoscripts.merge_mask_periods(mask_period_timestamp_df)
+
+    # Offset reached in each raw file, compacted to one record per file
+    state_file = os.path.join(ccn_output_path,
+                              filename_base + '_' + atmoscripts.TAIL_STATE)
+    tail = atmoscripts.read_manifest(state_file, legacy_filename=None)
+    if len(tail) > 0:
+        atmoscripts.write_manifest(tail.values(), state_file + '.tmp')
+        os.replace(state_file + '.tmp', state_file)
+
+    # Files to read from their end
+    if from_start:
+        skip_existing = set()
+    else:
+        skip_existing = set(_ccn_raw_files(ccn_raw_path)).difference(tail)
+
+    # Pick up from the output of the last run
+    ss_carry = {}
+    resample_carry = {}
+    written = {}
+    ss_list = []
+    ends = [pd.Timestamp(r['end']) for r in tail.values() if r['end'] is not None]
+    last_time = max(ends) if len(ends) > 0 else None
+    if last_time is not None:
+        saved = atmoscripts.read_live_output(ccn_output_path, filename_base,
+                                             'CCN', 'ssSplit',
+                                             ccn_output_filetype,
+                                             start=last_time.floor('1D'))
+        if saved is not None:
+            if split_by_supersaturation:
+                ss_list = [float(col[4:]) for col in saved.columns
+                           if col.startswith('ccn_')
+                           and col not in SS_SPLIT_UNCERT_COLS]
+            # The rows of the periods which were still incomplete
+            for time in time_int:
+                held = saved[saved.index >= last_time.floor(time)]
+                if len(held) > 0:
+                    resample_carry[time] = held
+
+    print('Following CCN files in ' + ccn_raw_path)
+    npolls = 0
+    try:
+        while (max_polls is None) or (npolls < max_polls):
+            poll_start = systime.time()
+            npolls = npolls + 1
+
+            frames, updated = _read_new_ccn_rows(ccn_raw_path, tail,
+                                                 skip_existing, compact)
+            skip_existing = set()
+            ccn_data = None
+            if len(frames) > 0:
+                ccn_data = atmoscripts.merge_timestamped(frames)
+                if last_time is not None:
+                    ccn_data = ccn_data[ccn_data.index > last_time]
+
+            if (ccn_data is not None) and (len(ccn_data) > 0):
+                print('Processing ' + str(len(ccn_data)) + ' new rows up to ' +
+                      str(ccn_data.index[-1]))
+                last_time = ccn_data.index[-1]
+                atmoscripts.append_live_output(ccn_data, ccn_output_path,
+                                               filename_base, 'CCN', 'raw',
+                                               ccn_output_filetype, written)
+
+                # Calculate CCN counting uncertainty
+                ccn_data = uncertainty_calc(ccn_data, 1, np.sqrt(ccn_data['CCN Number Conc']),
+                                            sigma_dtype=np.float32 if compact else None)
+
+                # QC data for internal parameters and for changes in SS
+                if QC:
+                    ccn_data = _float_int_columns(DataQC(ccn_data,
+                                                         ss_carry=ss_carry,
+                                                         ss_settle_time=ss_settle_time))
+                    atmoscripts.append_live_output(ccn_data, ccn_output_path,
+                                                   filename_base, 'CCN', 'QC',
+                                                   ccn_output_filetype, written)
+
+                # Perform flow calibration if data is provided
+                if flow_cal_df is not None:
+                    ccn_data = flow_cal(ccn_data,
+                                        measured_flows_df=flow_cal_df,
+                                        set_flow_rate=flow_setpt,
+                                        polydeg=flow_polyDeg)
+                    atmoscripts.append_live_output(ccn_data, ccn_output_path,
+                                                   filename_base, 'CCN', 'flowCal',
+                                                   ccn_output_filetype, written)
+
+                # Calibrate supersaturation
+                ccn_data = ss_cal(ccn_data, press_meas, press_cal)
+                atmoscripts.append_live_output(ccn_data, ccn_output_path,
+                                               filename_base, 'CCN', 'ssCal',
+                                               ccn_output_filetype, written)
+
+                # Filter for logged events
+                if (mask_period_file is not None) or (mask_period_timestamp_df is not None):
+                    if mask_period_file is not None:
+                        ccn_data = atmoscripts.log_filter(ccn_data, ccn_raw_path,
+                                                          mask_period_file)
+                    else:
+                        ccn_data = atmoscripts.log_filter(ccn_data,
+                                                          log_mask_df=mask_period_timestamp_df)
+                    ccn_data = _float_int_columns(ccn_data)
+                    atmoscripts.append_live_output(ccn_data, ccn_output_path,
+                                                   filename_base, 'CCN', 'logFilt',
+                                                   ccn_output_filetype, written)
+
+                # Separate into different supersaturations
+                split_data = ccn_data
+                if split_by_supersaturation:
+                    for ss in ccn_data['Current SS'].unique():
+                        if (not np.isnan(ss)) and (ss not in ss_list):
+                            ss_list.append(ss)
+                    if len(ss_list) > 0:
+                        split_data = _ss_split_chunk(ccn_data, ss_list,
+                                                     ss_split_columns(ss_list),
+                                                     qc_counts)
+                    else:
+                        # Nothing to split until there is valid data
+                        split_data = None
+                if (split_data is not None) and (len(split_data) > 0):
+                    atmoscripts.append_live_output(split_data, ccn_output_path,
+                                                   filename_base, 'CCN', 'ssSplit',
+                                                   ccn_output_filetype, written)
+
+                    # Resample the periods which are complete
+                    for time in time_int:
+                        data_resamp = _resample_chunk(split_data, time,
+                                                      split_by_supersaturation,
+                                                      resample_carry, qc_rules)
+                        if (data_resamp is not None) and (len(data_resamp) > 0):
+                            atmoscripts.append_live_output(data_resamp,
+                                                           ccn_output_path,
+                                                           filename_base, 'CCN',
+                                                           time,
+                                                           ccn_output_filetype,
+                                                           written)
+
+            # Save the offsets once the output is written
+            if len(updated) > 0:
+                atmoscripts.write_manifest(updated, state_file)
+
+            if (max_polls is None) or (npolls < max_polls):
+                systime.sleep(max(0, poll_interval - (systime.time() - poll_start)))
+    except KeyboardInterrupt:
+        print('Stopped following CCN files')
+
+    return
+
+def _ccn_raw_files(ccn_raw_path):
+    '''
+    Returns the absolute paths of the raw CCN-100 csv files in ccn_raw_path
+    '''
+    filelist = check_ccn_filelist(sorted(glob.glob(os.path.join(ccn_raw_path, '*.csv'))))
+    return [os.path.abspath(f) for f in filelist]
+
+def _read_new_ccn_rows(ccn_raw_path, tail, skip_existing, compact=False):
+    '''
+    Reads the rows appended to the raw CCN-100 csv files since the offsets in
+    tail, a dict of records keyed by file (see follow_ccn). Returns the data
+    from each file and the records which have changed, which are updated in
+    tail. Files in skip_existing are read from their current end.
+    '''
+    frames = []
+    updated = []
+    for path in _ccn_raw_files(ccn_raw_path):
+        record = tail.get(path)
+        if (record is None) or (os.path.getsize(path) < record['offset']):
+            # A new file, or one which has been replaced
+            record = _ccn_tail_record(path, path in skip_existing)
+            if record is None:
+                continue
+            tail[path] = record
+            updated.append(record)
+
+        offset = record['offset']
+        text = atmoscripts.read_new_lines(path, record)
+        if record['offset'] == offset:
+            continue
+        if record not in updated:
+            updated.append(record)
+        if text.strip() == '':
+            continue
+
+        rows = _parse_ccn_rows(io.StringIO(text), record['date'],
+                               compact=compact)
+        if len(rows) > 0:
+            frames.append(rows)
+            record['end'] = str(rows.index.max())
+    return frames, updated
+
+def _ccn_tail_record(path, skip_existing=False):
+    '''
+    Returns the record used by follow_ccn to follow a raw CCN-100 csv file,
+    starting after its header, or at the end of the file if skip_existing.
+    Returns None if the header hasn't been written yet.
+    '''
+    with open(path, 'rb') as f:
+        header = [f.readline() for i in range(6)]
+        header_end = f.tell()
+    if not header[-1].endswith(b'\n'):
+        return None
+
+    record = {'path': path,
+              'date': _ccn_header_date([h.decode('utf-8', errors='replace')
+                                        for h in header]),
+              'offset': header_end,
+              'end': None}
+    if skip_existing:
+        record['offset'] = max(header_end, atmoscripts.tail_end_offset(path))
+    return record
 
 #  unused
 def plot_me(ccn_data, plot_each_step, var=None, title = ''):
@@ -368,13 +1271,82 @@ def check_file(fname):
 def load_ccn(data_path=None,
              filetype=None,
              substring=None,
-             filepath=None):
+             filepath=None,
+             stage=None,
+             columns=None,
+             start=None,
+             end=None):
     '''
     Loads data from concatenated data file.
 
     if substring is not none, I select only those files which contain the
     specific subsstring in the folder. This helps deal with processing when the
     data file is split into monthly, weekly or daily files.
+
+    Only the given columns are returned if columns isn't None, and only the
+    data from start up to (but not including) end if they are given. For a
+    parquet dataset, the processing stage (e.g. 'QC', 'ssSplit' or a
+    resampling interval such as '5S') is loaded from the dataset at filepath,
+    or at data_path if there's no filepath. The columns and time range are
+    then used to read only the parts of the dataset needed.
+    '''
+    if filetype == 'parquet':
+        assert stage is not None, 'specify the processing stage to load!'
+        if filepath is None:
+            filepath = data_path
+        return atmoscripts.read_parquet(filepath, 'CCN', stage,
+                                        columns, start, end)
+
+    fname, filetype = find_ccn_file(data_path, filetype, substring, filepath)
+
+
+    if filetype in ['hdf', 'h5']:
+        data = pd.read_hdf(fname, key='ccn')
+
+    elif filetype in ['netcdf', 'nc']:
+        # xkcd
+        data = atmoscripts.read_netcdf(fname, data_path)
+
+    elif filetype == 'csv':
+        data = pd.read_csv(fname,
+                           skipinitialspace=True,
+                           index_col=0,
+                           parse_dates=True,
+                           infer_datetime_format=True)
+
+    if columns is not None:
+        data = data[columns]
+    if start is not None:
+        data = data[data.index >= pd.Timestamp(start)]
+    if end is not None:
+        data = data[data.index < pd.Timestamp(end)]
+    return data
+
+def query(data_path,
+          stage='raw',
+          start=None,
+          end=None,
+          columns=None,
+          resolution=None,
+          filetype='h5'):
+    '''
+    Returns the CCN data of a processing stage (e.g. 'raw', 'QC' or
+    'ssSplit'), or resampled to a time resolution (e.g. '1Min'), from start
+    up to (but not including) end, with only the given columns if columns
+    isn't None. Only the files in data_path which overlap the time range are
+    read, and only the rows in the range are read from hdf tables and parquet
+    datasets. See atmoscripts.query.
+    '''
+    return atmoscripts.query(data_path, 'CCN', stage, start, end,
+                             columns, resolution, filetype)
+
+def find_ccn_file(data_path=None,
+                  filetype=None,
+                  substring=None,
+                  filepath=None):
+    '''
+    Finds the concatenated data file to load, as described in load_ccn, and
+    returns its filename along with its filetype
     '''
     if filepath is not None:
         if os.path.isfile(filepath):
@@ -395,21 +1367,7 @@ def load_ccn(data_path=None,
         filetype = ftype
         print('Load filetype coerced in load_ccn function')
 
-
-    if filetype in ['hdf', 'h5']:
-        data = pd.read_hdf(fname, key='ccn')
-
-    elif filetype in ['netcdf', 'nc']:
-        # xkcd
-        data = atmoscripts.read_netcdf(fname, data_path)
-
-    elif filetype == 'csv':
-        data = pd.read_csv(fname,
-                           skipinitialspace=True,
-                           index_col=0,
-                           parse_dates=True,
-                           infer_datetime_format=True)
-    return data
+    return fname, filetype
 
 def Load_to_HDF(RawDataPath=None,
                 DestDataPath=None,
@@ -418,10 +1376,16 @@ def Load_to_HDF(RawDataPath=None,
                 concat_file_frequency='all',
                 input_filelist=None,
                 output_filetype='h5',
+                workers=None,
+                compact=False,
                 gui_mode=False,
                 gui_mainloop=None):
     '''
 	Load data from CSV files, concatenate and write to h5 file
+
+    If workers is an integer greater than 1, the csv files are parsed in a
+    pool of that many processes. If compact is True, the data is parsed to
+    compact dtypes (see _parse_ccn_rows).
     '''
     if DestDataPath is None:
         os.chdir(RawDataPath)
@@ -433,6 +1397,11 @@ def Load_to_HDF(RawDataPath=None,
 
     output_h5_filename = output_h5_filename + '_raw'
 
+    # The files loaded are recorded next to the output rather than the raw data
+    manifest_filename = atmoscripts.manifest_path(RawDataPath
+                                                  if DestDataPath is None
+                                                  else DestDataPath)
+
 ############################################
 #    if not glob.glob('*.h5'):
     if input_filelist is None:
@@ -480,11 +1449,17 @@ def Load_to_HDF(RawDataPath=None,
             save_ccn_to_hdf(filelist_, output_h5_filename_,
                             resample_timebase,
                             output_filetype=output_filetype,
+                            workers=workers,
+                            compact=compact,
+                            manifest_filename=manifest_filename,
                             gui_mode=gui_mode,
                             gui_mainloop=gui_mainloop)
     else:
         save_ccn_to_hdf(filelist, output_h5_filename, resample_timebase,
                         output_filetype=output_filetype,
+                        workers=workers,
+                        compact=compact,
+                        manifest_filename=manifest_filename,
                         gui_mode=gui_mode,
                         gui_mainloop=gui_mainloop)
 ############################################
@@ -502,6 +1477,8 @@ def Load_to_NonHDF(RawDataPath,
                    concat_file_frequency='all',
                    input_filelist=None,
                    output_file_format='csv',
+                   workers=None,
+                   compact=False,
                    gui_mode=True,
                    gui_mainloop=None):
     '''
@@ -517,6 +1494,8 @@ def Load_to_NonHDF(RawDataPath,
                              concat_file_frequency=concat_file_frequency,
                              input_filelist=input_filelist,
                              output_filetype=output_file_format,
+                             workers=workers,
+                             compact=compact,
                              gui_mode=gui_mode,
                              gui_mainloop=gui_mainloop)
 
@@ -563,7 +1542,8 @@ def save_as(data,
             save_path,
             filename_appendage='',
             filetype='hdf',
-            fname_current=None):
+            fname_current=None,
+            writer=None):
 
     '''
     Saves data to file, reading the original filename, and appending informative
@@ -571,23 +1551,30 @@ def save_as(data,
     For example
     CCN.h5 becomes CCN_QC.h5
     CCN.netcdf becomes CCN_QC_flowcal.netcdf
+    With parquet, the data is saved to the dataset in save_path as the
+    processing stage filename_appendage.
+
+    If writer is given (see atmoscripts.start_writer), the data is queued to
+    be written in the background rather than copied, so it mustn't be
+    modified until atmoscripts.wait_for_writes has been called.
+
+    Returns the name of the file, or the path of the parquet stage, that the
+    data is saved to.
     '''
-    assert filetype in ['hdf', 'h5', 'netcdf', 'nc', 'csv'], "Don't recognise \
-                        filetype to save to. Please use hdf, h5, netcdf or csv"
+    assert filetype in ['hdf', 'h5', 'netcdf', 'nc', 'csv', 'parquet'], "Don't recognise \
+                        filetype to save to. Please use hdf, h5, netcdf, csv or parquet"
     assert save_path is not None, 'You must specify the directory where you \
                         want to save!'
     os.chdir(save_path)
 
-
     if filetype in ['hdf', 'h5']:
-        fname = get_ccn_filenamebase('h5', filename_appendage, fname_current)
+        fname = get_ccn_filenamebase('h5', filename_appendage, fname_current,
+                                     atmoscripts.queued_files(writer, 'h5'))
         if data is None:
             print("CHECK HERE!")
         # Save data to file
-        try:
-            data.to_hdf(fname, key='ccn')
-        except:
-            print("NO! CHECK HERE!")
+        atmoscripts.submit_write(writer, fname, _save_hdf, data,
+                                 os.path.abspath(fname))
 
     elif filetype in ['netcdf', 'nc']:
         # Get the filename of the most recently created file
@@ -597,63 +1584,236 @@ def save_as(data,
         # xkcd
 
     elif filetype == 'csv':
-        fname = get_ccn_filenamebase('csv', filename_appendage, fname_current)
+        fname = get_ccn_filenamebase('csv', filename_appendage, fname_current,
+                                     atmoscripts.queued_files(writer, 'csv'))
 
         # Save data to file
-        data.to_csv(fname)
+        atmoscripts.submit_write(writer, fname, data.to_csv,
+                                 os.path.abspath(fname))
 
-    return
+    elif filetype == 'parquet':
+        atmoscripts.submit_write(writer, None, atmoscripts.df_to_parquet,
+                                 data, os.getcwd(), 'CCN', filename_appendage)
+        fname = atmoscripts.parquet_stage_path(os.getcwd(), 'CCN',
+                                               filename_appendage)
+
+    return fname
+
+def _save_hdf(data, fname):
+    '''
+    Writes the data of save_as to an hdf file
+    '''
+    try:
+        data.to_hdf(fname, key='ccn')
+    except:
+        print("NO! CHECK HERE!")
+
+def save_stage(data, save_path, stage, filetype, fname_current, persist,
+               stage_format='full', diff_base=None, writer=None,
+               checkpoint=None):
+    '''
+    Saves the output of a processing stage of LoadAndProcess if the stage is
+    in persist. With stage_format 'full' the data is saved by save_as, and
+    with 'diff' only its changes from diff_base, a snapshot of the data as
+    it was last saved or loaded (see atmoscripts.stage_snapshot), are saved
+    by save_stage_diff. Returns the snapshot to take the next diff from.
+
+    If checkpoint is given, the stage is recorded as completed once it has
+    been saved (see atmoscripts.submit_checkpoint).
+    '''
+    output = None
+    if stage in persist and stage_format == 'diff':
+        output = save_stage_diff(atmoscripts.stage_diff(diff_base, data),
+                                 save_path, stage, filetype, fname_current,
+                                 writer)
+        diff_base = atmoscripts.stage_snapshot(data, CCN_STAGE_COLUMNS)
+    elif stage in persist:
+        output = save_as(data, save_path, stage, filetype, fname_current,
+                         writer=writer)
+    atmoscripts.submit_checkpoint(writer, checkpoint, stage, output, data)
+    return diff_base
+
+def stage_diff_filename(fname_current, stage, ext):
+    '''
+    Returns the name of the file holding the diff of a processing stage of
+    the concatenated raw file fname_current, e.g. CCN_raw_170323_QC_diff.h5
+    '''
+    base = os.path.basename(fname_current).split('.')[0]
+    return base + '_' + stage + '_diff.' + ext
+
+def save_stage_diff(diff, save_path, stage, filetype, fname_current,
+                    writer=None):
+    '''
+    Saves the diff of a processing stage (see atmoscripts.stage_diff) to the
+    file named by stage_diff_filename, or to a parquet dataset as the stage
+    <stage>_diff. As with save_as, nothing is saved for netcdf. Returns the
+    name of the file, or the path of the parquet stage, saved to.
+    '''
+    os.chdir(save_path)
+    fname = None
+    if filetype == 'parquet':
+        atmoscripts.submit_write(writer, None, atmoscripts.df_to_parquet,
+                                 diff, os.getcwd(), 'CCN', stage + '_diff')
+        fname = atmoscripts.parquet_stage_path(os.getcwd(), 'CCN',
+                                               stage + '_diff')
+    elif filetype in ['hdf', 'h5']:
+        fname = os.path.abspath(stage_diff_filename(fname_current, stage, 'h5'))
+        atmoscripts.submit_write(writer, None, diff.to_hdf, fname, key='ccn')
+    elif filetype == 'csv':
+        fname = os.path.abspath(stage_diff_filename(fname_current, stage, 'csv'))
+        atmoscripts.submit_write(writer, None, diff.to_csv, fname)
+    return fname
+
+def load_stage(data_path, stage, fname, filetype='h5', persist_stages='all',
+               split_by_supersaturation=True, ss_layout='wide', stages=None,
+               qc_counts=False):
+    '''
+    Rebuilds the output of a processing stage which LoadAndProcess saved with
+    stage_format='diff', from the concatenated raw file fname in data_path
+    and the diffs of the stages saved up to it. persist_stages,
+    split_by_supersaturation, ss_layout and qc_counts must be as they were
+    for LoadAndProcess.
+
+    Only the diffs of the stages which were run are applied. These are given
+    by stages, or by default are those recorded in the checkpoint of the
+    stage in data_path (see atmoscripts.submit_checkpoint).
+    '''
+    persist = atmoscripts.persisted_stages(persist_stages, CCN_STAGES)
+    assert stage in persist, stage + " wasn't saved"
+    if stages is None:
+        record = atmoscripts.read_checkpoints(data_path).get(
+                (os.path.abspath(os.path.join(data_path, fname)), stage))
+        assert record is not None and 'stages' in record, \
+            "No checkpoint of the stages run for " + fname
+        stages = record['stages']
+
+    os.chdir(data_path)
+    raw_filetype = 'h5' if filetype == 'parquet' else filetype
+    data = load_ccn(data_path, raw_filetype, filepath=fname)
+    # Held as LoadAndProcess holds the data, so the columns match
+    data = atmoscripts.column_store(data)
+
+    for s in persist[:persist.index(stage)+1]:
+        if s not in stages:
+            continue
+        if filetype == 'parquet':
+            diff = atmoscripts.read_parquet(data_path, 'CCN', s + '_diff',
+                                            start=data.index.min(),
+                                            end=data.index.max() + pd.Timedelta(1, 'us'))
+        elif filetype in ['hdf', 'h5']:
+            diff = pd.read_hdf(stage_diff_filename(fname, s, 'h5'), key='ccn')
+        else:
+            diff = pd.read_csv(stage_diff_filename(fname, s, 'csv'),
+                               index_col=0, parse_dates=True)
+        data = atmoscripts.apply_stage_diff(data, diff)
+
+    if stage == 'ssSplit':
+        data = ss_split(data, split_by_supersaturation, ss_layout, qc_counts)
+    return data
+
+def load_checkpoint(record, data_path, fname, filetype='h5',
+                    stage_format='full', persist_stages='all',
+                    split_by_supersaturation=True, ss_layout='wide',
+                    qc_counts=False):
+    '''
+    Loads the output of the stage of a checkpoint record (see
+    atmoscripts.resume_checkpoint) of the concatenated raw file fname, so
+    that LoadAndProcess can carry on from it.
+    '''
+    if stage_format == 'diff':
+        return load_stage(data_path, record['stage'], fname, filetype,
+                          persist_stages, split_by_supersaturation,
+                          ss_layout, record.get('stages'), qc_counts)
+    if filetype == 'parquet':
+        return load_ccn(data_path, filetype, stage=record['stage'],
+                        start=record['start'],
+                        end=pd.Timestamp(record['end']) + pd.Timedelta(1, 'us'))
+    return load_ccn(data_path, filetype, filepath=record['output'])
 
 def save_ccn_to_hdf(filelist, output_h5_filename,
                     resample_timebase=None,
                     output_filetype='h5',
+                    workers=None,
+                    compact=False,
+                    manifest_filename=None,
                     gui_mode=False,
                     gui_mainloop=None):
+    '''
+    Loads the raw csv files in filelist into the hdf file output_h5_filename,
+    recording them in the manifest manifest_filename (which defaults to the
+    one in the directory of the hdf file, see atmoscripts.manifest_path).
+    '''
+    if manifest_filename is None:
+        manifest_filename = atmoscripts.manifest_path(
+                os.path.dirname(os.path.abspath(output_h5_filename)))
 
-    #If previous file exists, append, if not start new
+    # Check the files against the manifest of files loaded previously. A new
+    # output file is loaded from all the files given.
+    manifest = atmoscripts.read_manifest(manifest_filename)
     if os.path.isfile(output_h5_filename +'.h5'):
+        checked = atmoscripts.check_manifest(filelist, manifest)
+    else:
+        checked = atmoscripts.check_manifest(filelist, {})
+
+    # Only the files which are new or have been modified are loaded. Of the
+    # files which have grown, only the new rows are read, along with the last
+    # row loaded previously in case it was only partially written.
+    to_load = [(fname, status, record) for fname, status, record in checked
+               if status in ['new', 'changed', 'grown']]
+    skip_rows = [max(record['rows'] - 1, 0)
+                 if status == 'grown' and record['rows'] is not None else 0
+                 for fname, status, record in to_load]
+    records = [record for fname, status, record in checked
+               if status in ['unchanged', 'moved'] and record is not None]
+
+    if len(to_load) == 0 and os.path.isfile(output_h5_filename +'.h5'):
+        atmoscripts.write_manifest(records, manifest_filename)
+        return
 
-        files_already_loaded = atmoscripts.read_filelist_from_file('files_loaded.txt')
-
-        #with open('files_loaded.txt', 'rb') as f:
-        #    files_already_loaded = pickle.load(f)
-
-        # Get only the new files to be loaded:
-        filelist = list(set(filelist).difference(set(files_already_loaded)))
-        if len(filelist) == 0:
-            return
-
-        data_new, fname_current = read_ccn_csv(filelist)
-
-        data = pd.read_hdf(output_h5_filename +'.h5', key='ccn')
+    frames = read_ccn_csv_files([fname for fname, _, _ in to_load], workers,
+                                skip_rows, compact)
+    for (fname, status, record), skip, frame in zip(to_load, skip_rows, frames):
+        records.append(atmoscripts.set_manifest_rows(record, skip + len(frame),
+                                                     frame.index))
+    if len(frames) > 0:
+        data_new = atmoscripts.merge_timestamped(frames)
+    else:
+        data_new = pd.DataFrame(columns=ccn_raw_columns(compact))
 
-        data = data.append(data_new)
+    #If previous file exists, append, if not start new
+    if os.path.isfile(output_h5_filename +'.h5'):
+        # Only write the new rows (and any stored rows they overlap with) to
+        # the table. If the file can't be updated in place (e.g. it's an old
+        # fixed format file), fall back to rewriting the whole file.
+        if atmoscripts.update_hdf_table(data_new,
+                                        output_h5_filename +'.h5', 'ccn'):
+            print("Appending data to file " + output_h5_filename + ".h5")
+            data = None
+        else:
+            data = pd.read_hdf(output_h5_filename +'.h5', key='ccn')
+            data = pd.concat([data, data_new])
 
     else:
-        data, fname_current = read_ccn_csv(filelist)
+        data = data_new
 
-    # Drop any duplicates which may be there, based only on the Timestamp
-    data = data.reset_index().drop_duplicates(subset='timestamp', keep='last')
-    data = data.set_index('timestamp')
+    if data is not None:
+        # Drop any duplicates which may be there, based only on the Timestamp
+        data = data.reset_index().drop_duplicates(subset='timestamp', keep='last')
+        data = data.set_index('timestamp')
 
-    # Sort data by ascending time
-    data = data.sort_index()
+        # Sort data by ascending time
+        data = data.sort_index()
 
+        # Written as a table, so that later updates can be appended
+        data.to_hdf(output_h5_filename +'.h5', key='ccn', format='table')
+        print("Writing data to file " + output_h5_filename + ".h5")
 
-    data.to_hdf(output_h5_filename +'.h5', key='ccn')
-    print("Writing data to file " + output_h5_filename + ".h5")
-
-    # Save the filenames that have been loaded to file for next update
-    try:
-        files_already_loaded
-    except NameError:
-        filelist = filelist
-    else:
-        filelist = filelist + files_already_loaded
-#        pickle.dump(filelist, f)
-    atmoscripts.write_filelist_to_file(filelist, 'files_loaded.txt')
+    # Record the files that have been loaded for the next update
+    atmoscripts.write_manifest(records, manifest_filename)
 
     if resample_timebase is not None:
+        if data is None:
+            data = pd.read_hdf(output_h5_filename +'.h5', key='ccn')
         timebase_resampler(data, time_int=resample_timebase,
                            output_filetype=output_filetype,
                            gui_mode=gui_mode,
@@ -703,6 +1863,8 @@ def concatenate_from_csv(CCN_raw_path,
                          CCN_output_filetype='hdf',
                          reload_from_source=True,
                          input_filelist=None,
+                         workers=None,
+                         compact=False,
                          gui_mode=False,
                          gui_mainloop=None):
     '''
@@ -721,6 +1883,8 @@ def concatenate_from_csv(CCN_raw_path,
                            concat_file_frequency=concat_file_frequency,
                            input_filelist=input_filelist,
                            output_file_format=CCN_output_filetype,
+                           workers=workers,
+                           compact=compact,
                            gui_mode=gui_mode,
                            gui_mainloop=gui_mainloop)
     else:
@@ -733,14 +1897,14 @@ def concatenate_from_csv(CCN_raw_path,
                         concat_file_frequency=concat_file_frequency,
                         input_filelist=input_filelist,
                         output_filetype=CCN_output_filetype,
+                        workers=workers,
+                        compact=compact,
                         gui_mode=gui_mode,
                         gui_mainloop=gui_mainloop)
     return
 
-def read_ccn_csv(filelist):
-
-    # Specify the column names once.
-    colnames = ['Time', 'Current SS', 'Temps Stabilized', 'Delta T', 'T1 Set',
+# Column names of the 49 columns written by the CCN-100 after its 6-line header
+CCN_COLNAMES = ['Time', 'Current SS', 'Temps Stabilized', 'Delta T', 'T1 Set',
                 'T1 Read', 'T2 Set', 'T2 Read', 'T3 Set', 'T3 Read',
                 'Nafion Set', 'T Nafion', 'Inlet Set', 'T Inlet', 'OPC Set',
                 'T OPC', 'T Sample', 'Sample Flow', 'Sheath Flow',
@@ -751,117 +1915,158 @@ def read_ccn_csv(filelist):
                 'Bin 17', 'Bin 18', 'Bin 19', 'Bin 20', 'CCN Number Conc',
                 'Valve Set', 'Alarm Code', 'Alarm Sum']
 
-    delete_temp_files_manually = False
-    temp_files_to_del = [] #initialise
-    fname_previous = ''
-
-    # If there are LOTS of files, break up into groups
-    # before combining into the final set (to manage RAM)
-    filelim = 50
-    if len(filelist) > filelim:
-        needs_final_grouping = True
-    else:
-        needs_final_grouping = False
-
-    j1 = int(np.ceil(len(filelist)/filelim)) # get the number of group files
-
-    for j in range(0, j1):
+# In compact mode (see _parse_ccn_rows), the raw data is parsed to float32
+# apart from these columns, which keep full precision: the SS setpoints name
+# the columns made by ss_split and are calibrated in ss_cal, and the
+# concentration is the measurement itself.
+CCN_FULL_PRECISION = ['Current SS', 'CCN Number Conc']
 
-        i0 = j*filelim
+# Columns held as small integers in compact mode, unless they have values
+# which don't fit (see _compact_ints)
+CCN_COMPACT_INTS = {'Temps Stabilized': np.int8, 'Bin #': np.int8,
+                    'Valve Set': np.int8, 'Alarm Code': np.int16,
+                    'Alarm Sum': np.int16}
 
-        if j == j1-1: # Last group file has different final limit
-            i1 = len(filelist)
-        else:
-            i1 = (j+1)*filelim
-
-        # Initialise
-        fname_current = None
-        data = pd.read_csv(filelist[0],
-                           names=colnames,
-                           skiprows=range(0, 6),
-                           engine='python',
-                           skipinitialspace=True,
-                           usecols=range(49))
-
-        # Read date from csv file
-        data['date'] = str(pd.read_csv(filelist[0], names=['label', 'date'],
-                                       skiprows=range(2, len(data)+6))['date'][1])
-
-        print("Reading " + str(filelist[0]))
-        for i in range(i0, i1):
-            print("Reading " + str(filelist[i]))
-            # Load csv data
-            data_temp = pd.read_csv(filelist[i],
-                                    names=colnames,
-                                    skiprows=range(0, 6),
-                                    engine='python',
-                                    skipinitialspace=True,
-                                    usecols=range(49))
-
-            # Read date from csv file
-            data_temp['date'] = str(pd.read_csv(filelist[i],
-                                                names=['label', 'date'],
-                                                skiprows=range(2, len(data)+6))['date'][1])
-
-            #Append new csv file data to existing dataframe
-            data = data.append(data_temp)#, ignore_index=True)
-
-            # Save new data to file
-            fname_current = 'CCNC_noIndex_temp_'+str(i0)+'to'+str(i+2)+\
-                            'of'+str(len(filelist)+1)+'.h5'
-            data.to_hdf(fname_current, key='ccn')
-            # Remove the temporary file
-            if os.path.isfile(fname_previous):
-                try:
-                    os.remove(fname_previous)
-                except PermissionError:
-                    delete_temp_files_manually = True
-                    temp_files_to_del.append(fname_previous)
-            fname_previous = fname_current
+def ccn_raw_columns(compact=False):
+    '''
+    Returns the columns of the raw data as parsed by _parse_ccn_rows. The
+    date and time strings aren't kept in compact mode.
+    '''
+    if compact:
+        return CCN_COLNAMES[1:]
+    return CCN_COLNAMES + ['date']
 
-        # Create timstamp from date and time columns
-        data['timestamp'] = pd.to_datetime(data['date']+' '+data['Time'],
-                                           format="%m/%d/%y %H:%M:%S")
+def read_ccn_csv(filelist, workers=None, compact=False):
+    '''
+    Reads a list of raw CCN-100 csv files and returns a single dataframe
+    indexed by timestamp.
+
+    Each file is read once with the C parser: the 6-line header is consumed
+    from the open file handle (the date lives on its second line) and the
+    remaining 49 columns are parsed straight from the same handle. The
+    per-file frames are concatenated once at the end, so the cost grows
+    linearly with the number of files and nothing is written to temporary
+    files along the way.
+
+    If workers is an integer greater than 1, the files are parsed in a pool
+    of that many processes. Either way, the frames are merged in timestamp
+    order and duplicate timestamps keep the row from the last file in the
+    list.
+
+    If compact is True, the data is parsed to compact dtypes (see
+    _parse_ccn_rows).
+    '''
+    if len(filelist) == 0:
+        return pd.DataFrame(columns=ccn_raw_columns(compact)), None
 
+    frames = read_ccn_csv_files(filelist, workers, compact=compact)
+    data = atmoscripts.merge_timestamped(frames)
 
-        # Drop any duplicates which may be there, based only on the Timestamp
-        data = data.drop_duplicates(subset='timestamp', keep='last')
-        # Change the index to the timestamp
-        data = data.set_index('timestamp')
+    return data, filelist[-1]
 
+def read_ccn_csv_files(filelist, workers=None, skip_rows=None, compact=False):
+    '''
+    Reads a list of raw CCN-100 csv files as in read_ccn_csv, returning a
+    list with the data from each file. If skip_rows is given, it's a list
+    with the number of data rows to skip at the start of each file.
+    '''
+    if skip_rows is None:
+        skip_rows = [0]*len(filelist)
+
+    if (workers is not None) and (workers > 1) and (len(filelist) > 1):
+        print("Reading " + str(len(filelist)) + " files with " +
+              str(workers) + " worker processes")
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+            # map returns the frames in the order of the filelist
+            frames = list(pool.map(_read_ccn_csv_file, filelist, skip_rows,
+                                   [compact]*len(filelist)))
+    else:
+        frames = []
+        for fname, skip in zip(filelist, skip_rows):
+            print("Reading " + str(fname))
+            frames.append(_read_ccn_csv_file(fname, skip, compact))
 
-        # Save group file
-        if needs_final_grouping:
-            data.to_hdf('CCN_group_'+str(j+1)+'of'+str(j1)+'.h5', key='ccn')
+    return frames
 
-        # Remove last temporary file
-        try:
-            os.remove(fname_previous)
-        except:
-            continue
+def _read_ccn_csv_file(fname, skip_rows=0, compact=False):
+    '''
+    Reads a single raw CCN-100 csv file in one pass and returns its data
+    indexed by timestamp, skipping the first skip_rows rows of data.
+    '''
+    with open(fname, 'r') as f:
+        header = [f.readline() for i in range(6)]
+        data = _parse_ccn_rows(f, _ccn_header_date(header), skip_rows,
+                               compact)
 
+    return data
 
-    if needs_final_grouping:
-        del data, data_temp
+def _ccn_header_date(header):
+    '''
+    Returns the date of a raw CCN-100 csv file from its 6-line header, where
+    it's on the second line
+    '''
+    return header[1].split(',')[1].strip()
 
-        for j in range(0, j1):
-            data_temp = pd.read_hdf('CCN_group_'+str(j+1)+'of'+str(j1)+'.h5', key='ccn')
-            try:
-                data
-            except NameError:
-                data = data_temp
-            else:
-                data = data.append(data_temp)
-            # Remove the temporary file
-            if os.path.isfile('CCN_group_'+str(j+1)+'of'+str(j1)+'.h5'):
-                os.remove('CCN_group_'+str(j+1)+'of'+str(j1)+'.h5')
+def _parse_ccn_rows(f, date, skip_rows=0, compact=False):
+    '''
+    Parses the data rows of a raw CCN-100 csv file from an open file (or a
+    StringIO of some of the rows), returning them indexed by timestamp
+
+    If compact is True, the columns are parsed straight to float32, apart
+    from those in CCN_FULL_PRECISION, and those in CCN_COMPACT_INTS are then
+    held as small integers where they fit (see _compact_ints). The date and time
+    strings are dropped once the timestamp is made from them. This about
+    halves the size of the data in memory and on disk. float32 keeps about 7
+    significant figures (a relative error of at most 2**-24, e.g. 0.00003 C
+    on a temperature of 300 C), well within the resolution the instrument
+    writes its temperatures, flows and pressures to, and the bin counts,
+    alarm codes, SS setpoints and concentrations are kept exactly.
+    '''
+    dtype = None
+    if compact:
+        dtype = {col: np.float32 for col in CCN_COLNAMES[1:]
+                 if col not in CCN_FULL_PRECISION}
+    data = pd.read_csv(f,
+                       names=CCN_COLNAMES,
+                       header=None,
+                       skiprows=skip_rows,
+                       skipinitialspace=True,
+                       usecols=range(49),
+                       dtype=dtype)
+
+    if compact:
+        timestamp = pd.to_datetime(date+' '+data['Time'],
+                                   format="%m/%d/%y %H:%M:%S")
+        data = data.drop(columns='Time')
+        data.index = pd.DatetimeIndex(timestamp, name='timestamp')
+        return _compact_ints(data, CCN_COMPACT_INTS)
+
+    data['date'] = date
+
+    # Create timestamp from date and time columns
+    data['timestamp'] = pd.to_datetime(data['date']+' '+data['Time'],
+                                       format="%m/%d/%y %H:%M:%S")
+    data = data.set_index('timestamp')
 
-    # Clean up any files that couldnt be deleted due to being locked previously
-    if delete_temp_files_manually:
-        for k in range(0, len(temp_files_to_del)):
-            os.remove(temp_files_to_del[k])
+    return data
 
-    return data, fname_current
+def _compact_ints(data, dtypes):
+    '''
+    Converts the columns in dtypes, a dict of integer dtypes keyed by
+    column, to their dtype if all their values are integers which fit in it.
+    Columns with missing values (e.g. from a partly written row) or values
+    which don't fit are left as float32, which holds them exactly, rather
+    than making up values for them. A raw hdf table holding such a column is
+    rewritten as float32 once, and later files are then appended to it (see
+    atmoscripts.update_hdf_table).
+    '''
+    for col, dtype in dtypes.items():
+        values = data[col].to_numpy()
+        info = np.iinfo(dtype)
+        if np.isfinite(values).all() and (values >= info.min).all() and \
+           (values <= info.max).all() and (values == np.round(values)).all():
+            data[col] = values.astype(dtype)
+    return data
 
 def create_temp_output_directory():
     '''
@@ -1028,13 +2233,22 @@ def check_ccn_filelist(filelist):
     filelist = [f for f in filelist if 'CCN 100 data' in f]
     return filelist
 
-def get_ccn_filenamebase(ext, appendage, fname_current=None):
+def get_ccn_filenamebase(ext, appendage, fname_current=None, queued=None):
     '''
     Get's the filename of the most recently created file and produces the new
     filename
+
+    queued is a list of files queued to be written in the background (see
+    atmoscripts.queued_files), which count as the most recently created in
+    the order they were queued.
     '''
 
     filelist = glob.glob('*.'+ ext)
+    if queued is None:
+        queued = []
+    queued = [os.path.basename(f) for f in queued
+              if os.path.dirname(f) == os.getcwd()]
+    filelist = filelist + [f for f in queued if f not in filelist]
 
     if len(filelist) == 0:
         return 'CCN_unknown' + appendage + '.' + ext
@@ -1048,7 +2262,7 @@ def get_ccn_filenamebase(ext, appendage, fname_current=None):
                 fname_current_base = fname_current.split('.')[0]
             fname_current_list = [f for f in filelist if fname_current_base in f]
             if len(fname_current_list) > 0:
-                fname_old = max(fname_current_list, key=os.path.getctime)
+                fname_old = _newest_file(fname_current_list, queued)
                 fname_old = fname_old.split('.')
             else:
                 try:
@@ -1057,7 +2271,7 @@ def get_ccn_filenamebase(ext, appendage, fname_current=None):
                     print("get_ccn_filenamebase error!")
         else:
             # Get the filename of the most recently created file
-            fname_old = max(filelist, key=os.path.getctime).split('.')
+            fname_old = _newest_file(filelist, queued).split('.')
 
         # if the version of the file is already there, overwrite
         if appendage in fname_old[0]:
@@ -1065,6 +2279,16 @@ def get_ccn_filenamebase(ext, appendage, fname_current=None):
         else:
             return fname_old[0] + '_' + appendage + '.' + fname_old[1]
 
+def _newest_file(filelist, queued):
+    '''
+    Returns the most recently created file in filelist, where files still
+    queued to be written are newer than any on disk
+    '''
+    in_queue = [f for f in queued if f in filelist]
+    if len(in_queue) > 0:
+        return in_queue[-1]
+    return max(filelist, key=os.path.getctime)
+
 ###############################################################################
 ### Calibrations, corrections and quality control
 ###############################################################################
@@ -1075,71 +2299,96 @@ def DataQC(CCN_data,
            T2diffLim=0.25,
            T3diffLim=0.15,
            NafionTdiffLim=0.3,
-           OPCT1diffLim=1):
+           OPCT1diffLim=1,
+           ss_carry=None,
+           ss_settle_time=SS_SETTLE_TIME):
     """
     Filter data that is out of spec.
-    """
 
+    All of the rules of ccn_qc_rules are evaluated on the data at once into a
+    bitmask of the rules each row failed (see atmoscripts.qc_flags), and the
+    rows failing any rule are then removed in one step. The bitmask is kept
+    in the qc_flags column, so the reasons for removing data can be looked at
+    or counted later (see atmoscripts.qc_flag_counts).
 
-    ### Flag data to have a closer look at.
+    The limits are those of ccn_qc_rules. OPCT1diffLim is the limit on the
+    deviation of the OPC temperature from its setpoint, which was fixed at
+    its default of 1 before the rules were declared.
 
-    CCNC_data = CCN_data.copy()
+    ss_settle_time is the time removed after each change in SS (see
+    ss_transition_removal). ss_carry is passed on to ss_transition_removal
+    when the data is being filtered in consecutive chunks.
 
-    # Initialise
+    The data is modified in place.
+    """
 
-#    ReviewData = pd.DataFrame(np.nan,index=CCNC_data.index,columns=['review'])
-#    ReviewData['CCN Number Conc'] = CCNC_data['CCN Number Conc'].copy()
-#    # Concentration lower than 10 /cm3 (as per factory setting)
-#    #Data4CloserLook['check'].loc[CCNC_data['CCN Number Conc'] >= 10] = np.nan
-#    ReviewData.loc[CCNC_data['CCN Number Conc'] < 10] = -999
 
-    # Remove data for 3 minutes after each change in supersaturation.
-    CCNC_data = ss_transition_removal(CCNC_data)
+    ### Flag data to have a closer look at.
+
+    # Remove data for a few minutes after each change in supersaturation.
+    masks = {'ss_transition': ss_transition_mask(CCN_data, ss_carry,
+                                                 ss_settle_time)}
 
-    ### Filter primary dataset
     with np.errstate(invalid='ignore'): # Ignore error warnings caused by
                                           # arithmetic on nans
+        atmoscripts.set_column(CCN_data, 'Flow Ratio',
+                               CCN_data['Sheath Flow'] / CCN_data['Sample Flow'])
+
+    ### Filter primary dataset
+    rules = ccn_qc_rules(FlowRatio, T1diffLim, T2diffLim, T3diffLim,
+                         NafionTdiffLim, OPCT1diffLim)
+    flags = atmoscripts.qc_flags(CCN_data, rules, masks)
+
+    return atmoscripts.apply_qc_flags(CCN_data, flags)
+
+def ccn_qc_rules(FlowRatio=10.0,
+                 T1diffLim=0.25,
+                 T2diffLim=0.25,
+                 T3diffLim=0.15,
+                 NafionTdiffLim=0.3,
+                 OPCT1diffLim=1):
+    """
+    Returns the QC rules of DataQC (see atmoscripts.qc_flags), in the order of
+    their bits in the qc_flags column.
+    """
+    return [
+        # Data for a few minutes after each change in supersaturation
+        {'name': 'ss_transition'},
 
         # Alarms detected by software - note many of these only activate
         # after a certain time period in the CCNC software
-        CCNC_data.loc[CCNC_data['Alarm Code'] > 0] = np.nan
+        {'name': 'alarm', 'column': 'Alarm Code', 'max': 0},
 
         # Concentration lower than 10 /cm3 (as per factory setting)
-        CCNC_data.loc[CCNC_data['CCN Number Conc'] < 10] = np.nan
+        {'name': 'conc_low', 'column': 'CCN Number Conc', 'min': 10},
 
         # Concentration higher than 5000/cm3, the column experiences water
         # vapor depletion and thus undercounts, see Latham & Nenes, AS&T, 2011
-        CCNC_data.loc[CCNC_data['CCN Number Conc'] > 5000] = np.nan
+        {'name': 'conc_high', 'column': 'CCN Number Conc', 'max': 5000},
 
-        # Flow ratio outside 10 +/- 0.4
-        CCNC_data['Flow Ratio'] = \
-                        CCNC_data['Sheath Flow'] / CCNC_data['Sample Flow']
-        CCNC_data.loc[CCNC_data['Flow Ratio'] > (FlowRatio + 2)] = np.nan
-        CCNC_data.loc[CCNC_data['Flow Ratio'] < (FlowRatio - 2)] = np.nan
+        # Flow ratio outside 10 +/- 2
+        {'name': 'flow_ratio', 'column': 'Flow Ratio',
+         'min': FlowRatio - 2, 'max': FlowRatio + 2},
 
         # Irrelevant SuperSaturation values
-        CCNC_data.loc[CCNC_data['Current SS'] < 0] = np.nan
+        {'name': 'ss_negative', 'column': 'Current SS', 'min': 0},
 
         # 80 < Laser current < 120
-        CCNC_data.loc[CCNC_data['Laser Current'] > 120] = np.nan
-        CCNC_data.loc[CCNC_data['Laser Current'] < 80] = np.nan
-
-        # 1st Stage Mon > 4.7 V
-        CCNC_data.loc[CCNC_data['Laser Current'] > 120] = np.nan
+        {'name': 'laser_current', 'column': 'Laser Current',
+         'min': 80, 'max': 120},
 
         # Temperatures deviating from their setpoints
-        CCNC_data.loc[abs(CCNC_data['T1 Set'] -                        \
-                          CCNC_data['T1 Read']) > T1diffLim] = np.nan
-        CCNC_data.loc[abs(CCNC_data['T2 Set'] -                        \
-                          CCNC_data['T2 Read']) > T2diffLim] = np.nan
-        CCNC_data.loc[abs(CCNC_data['T3 Set'] -                        \
-                          CCNC_data['T3 Read']) > T3diffLim] = np.nan
-        CCNC_data.loc[abs(CCNC_data['Nafion Set'] -                    \
-                          CCNC_data['T Nafion']) > NafionTdiffLim] = np.nan
-        CCNC_data.loc[abs(CCNC_data['OPC Set'] -                       \
-                          CCNC_data['T OPC']) > 1] = np.nan
-
-    return CCNC_data#, ReviewData)
+        {'name': 'T1', 'column': 'T1 Read', 'setpoint': 'T1 Set',
+         'max': T1diffLim},
+        {'name': 'T2', 'column': 'T2 Read', 'setpoint': 'T2 Set',
+         'max': T2diffLim},
+        {'name': 'T3', 'column': 'T3 Read', 'setpoint': 'T3 Set',
+         'max': T3diffLim},
+        {'name': 'T_nafion', 'column': 'T Nafion', 'setpoint': 'Nafion Set',
+         'max': NafionTdiffLim},
+        {'name': 'T_OPC', 'column': 'T OPC', 'setpoint': 'OPC Set',
+         'max': OPCT1diffLim},
+        ]
 
 #-----------------------------
 # This function is unused
@@ -1217,96 +2466,210 @@ def flow_cal(data,
     x_data = (pd.to_datetime(data.index) - \
               measured_flows_df.index[0]).total_seconds()
 
-    data['CCN Number Conc'] = data['CCN Number Conc']/set_flow_rate*p(x_data)
+    flow_rate = p(x_data)
+    atmoscripts.set_column(data, 'CCN Number Conc',
+                           data['CCN Number Conc']/set_flow_rate*flow_rate)
 
 
 
     # Rel uncertainty is abs divided by median of liniear regression
-    sigma_divisor = p(x_data)
-    data = uncertainty_calc(data, sigma_abs, sigma_divisor)
+    data = uncertainty_calc(data, sigma_abs, flow_rate)
 
     return data
 
 
-def ss_split(data, split_by_supersaturation=True):
+def ss_split(data, split_by_supersaturation=True, layout='wide',
+             qc_counts=False):
     '''
     Splits the data based on its supersaturation value and removes the
     transition periods when supersaturations haven't stabilised.
+
+    With the wide layout, each supersaturation gets a ccn_<ss> column, filled
+    in from the concentration in a single pivot of the data. With the long
+    layout, each timestamp keeps one row with its supersaturation in the 'ss'
+    column and the concentration in 'ccn', which resample_interval groups by
+    time and supersaturation directly (see ss_split_long).
+
+    If qc_counts is True, the wide layout keeps the QC flags (see DataQC) and
+    the rows which failed QC, blank, so that resample_interval can count
+    them. Otherwise those rows are removed along with the other blank rows.
     '''
+    assert layout in SS_LAYOUTS, "layout must be one of " + str(SS_LAYOUTS)
+    if split_by_supersaturation and layout == 'long':
+        return ss_split_long(data)
     if split_by_supersaturation:
         # Get a list of the supersaturations in the file:
         ss_list = data['Current SS'].unique()
-
-        nan_only = True
-
-        d = {} #Initialise
-        for ss in ss_list:
-            if not np.isnan(ss):
-                # Create a dictionary to store each separated SS
-                d['ccn_' + str(ss)] = data[data['Current SS'] == ss][[\
-                                 'CCN Number Conc']]
-
-                # Concatenate each df in the dictionary
-                split_data = pd.concat(d, axis=1)
-
-                # Remove multi-indexing
-                split_data.columns = split_data.columns.get_level_values(0)
-
-                # Grab the uncertainty too:
-                uncert_cols = ['ccn_sigma', 'ccn_sigma_med', 'ccn_sigma_avg']
-                for col in uncert_cols:
-                    if col in data:
-                        uncert = data[col]
-                        uncert = uncert.dropna()
-                        split_data[col] = uncert
-                nan_only = False
-            elif nan_only:
-                # If the data only contains nan values after filtering
-                # return a dataframe with a single, indexed column full of NaN's
-                split_data = pd.DataFrame(np.nan,
-                                          index=data.index,
-                                          columns=['NaN_ONLY'])
-        try:
-            return split_data
-        except:
+        if len(ss_list) == 0:
             return data
+        ss_list = [ss for ss in ss_list if not np.isnan(ss)]
+
+        # If the data only contains nan values after filtering, this
+        # returns a dataframe with a single, indexed column full of NaN's
+        return _ss_split_chunk(data, ss_list, ss_split_columns(ss_list),
+                               qc_counts)
     else:
         return data
 
-def ss_transition_removal(data):
+# Uncertainty columns which are kept when splitting by supersaturation
+SS_SPLIT_UNCERT_COLS = ['ccn_sigma', 'ccn_sigma_med', 'ccn_sigma_avg']
+
+# Layouts of the data split by supersaturation
+SS_LAYOUTS = ['wide', 'long']
+
+def ss_split_columns(ss_list):
     '''
-    removes data that hasn't stabilised its ss yet due to changing SS setpoint
+    Returns the names of the supersaturation columns made by ss_split for the
+    supersaturations in ss_list, in the order that ss_split puts them.
     '''
-    # Create empty boolean column in the dataframe
-    data['ss_remove'] = False
-
-    i = 1
-    while i < len(data):
-        # Find index of the change in SS
-        ss_prev = data['Current SS'][i-1]
-        ss_next = data['Current SS'][i]
-        if (ss_prev != ss_next) & (not np.isnan(ss_prev)):
-            # Find timestamp of change
-            timestamp0 = data.index[i]
-            # Find timestamp of end of transition - set to n minutes after
-            # change in set point
-            timestamp1 = timestamp0 + datetime.timedelta(minutes=3)
-            # Set data within the transition range to nan
-            data[(data.index >= timestamp0) & (data.index < timestamp1)] = np.nan
-
-            # Start checking again from the end of the removed data
-            try:
-                i = data.index.get_loc(timestamp1)+1
-            except:
-                i = i + 1
-        else:
-            i = i + 1
+    d = {}
+    for ss in ss_list:
+        d['ccn_' + str(ss)] = pd.DataFrame(columns=['CCN Number Conc'])
+    if len(d) == 0:
+        return []
+    return list(pd.concat(d, axis=1).columns.get_level_values(0))
+
+def _ss_split_chunk(data, ss_list, split_columns, qc_counts=False):
+    '''
+    Splits a chunk of data by supersaturation as ss_split does, but with the
+    supersaturations and column order of the whole dataset.
+    '''
+    flags = None
+    if qc_counts and atmoscripts.QC_FLAG_COLUMN in data.columns:
+        flags = data[atmoscripts.QC_FLAG_COLUMN].values
+
+    if len(split_columns) == 0:
+        # The data only contains nan values after filtering
+        split_data = pd.DataFrame(np.nan, index=data.index, columns=['NaN_ONLY'])
+        if flags is not None:
+            split_data[atmoscripts.QC_FLAG_COLUMN] = flags
+        return split_data
+
+    # Only the columns kept are filtered, rather than the whole data. The
+    # rows which failed QC have no SS, so stay blank if they're kept.
+    keep = data['Current SS'].notnull().values
+    if flags is not None:
+        keep = keep | (flags != 0)
+    conc = data['CCN Number Conc'].values[keep]
+
+    # Put each concentration in the column of its supersaturation. The
+    # columns are filled in as rows of an array, which the frame holds
+    # without copying.
+    codes = pd.Index(ss_list).get_indexer(data['Current SS'].values[keep])
+    rows = np.flatnonzero(codes >= 0)
+    values = np.full((len(ss_list), len(conc)), np.nan,
+                     dtype=np.result_type(conc.dtype, np.float32))
+    values[codes[rows], rows] = conc[rows]
+    split_data = pd.DataFrame(values.T, index=data.index[keep],
+                              columns=['ccn_' + str(ss) for ss in ss_list],
+                              copy=False)
+    if list(split_data.columns) != list(split_columns):
+        split_data = split_data[split_columns]
+
+    # Grab the uncertainty too:
+    for col in SS_SPLIT_UNCERT_COLS:
+        if col in data:
+            split_data[col] = data[col].values[keep]
+    if flags is not None:
+        split_data[atmoscripts.QC_FLAG_COLUMN] = flags[keep]
+    return split_data
+
+def ss_split_long(data):
+    '''
+    Splits the data by supersaturation in the long layout: the rows with a
+    supersaturation, with columns 'ss' (the supersaturation), 'ccn' (the
+    concentration) and whichever uncertainty columns the data has.
+    '''
+    keep = data['Current SS'].notnull().values
+    split_data = pd.DataFrame({'ss': data['Current SS'].values[keep],
+                               'ccn': data['CCN Number Conc'].values[keep]},
+                              index=data.index[keep])
+
+    # Grab the uncertainty too:
+    for col in SS_SPLIT_UNCERT_COLS:
+        if col in data:
+            split_data[col] = data[col].values[keep]
+    return split_data
+
+def ss_transition_removal(data, carry=None, settle_time=SS_SETTLE_TIME):
+    '''
+    removes data that hasn't stabilised its ss yet due to changing SS setpoint
 
+    settle_time is the number of minutes removed after each change in SS. It
+    can also be a dict of minutes keyed by the new SS, in which case any SS
+    not in the dict gets SS_SETTLE_TIME minutes.
 
-    # delete the temporary flag column
-    del data['ss_remove']
+    To process data in consecutive chunks, pass the same dict as carry for
+    each chunk (starting with an empty one). See ss_transition_mask.
+    '''
+    remove = ss_transition_mask(data, carry, settle_time)
+    if remove.any():
+        data[remove] = np.nan
     return data
 
+def ss_transition_mask(data, carry=None, settle_time=SS_SETTLE_TIME):
+    '''
+    Returns a boolean array which is True on the rows that ss_transition_removal
+    removes, without changing the data.
+
+    Changes are found across the whole column at once and the rows to remove
+    are found by searching the (sorted) index for the end of each settling
+    period. A change at the row just after a removed period, or from a nan
+    SS, isn't counted as a change.
+
+    The carry dict holds the SS of the last row of the previous chunk and the
+    end of the last transition period, which may run on into the next chunk.
+    '''
+    remove = np.zeros(len(data), dtype=bool)
+    if (carry is not None) and (carry.get('blank_until') is not None):
+        # Finish removing a transition which started in the previous chunk
+        remove |= data.index < carry['blank_until']
+
+    if len(data) == 0:
+        return remove
+
+    # Rows where the SS differs from the row before, where the rows being
+    # removed no longer have an SS
+    ss = data['Current SS'].values.astype(float)
+    ss[remove] = np.nan
+    ss_prev = np.concatenate(([np.nan], ss[:-1]))
+    if (carry is not None) and ('ss_prev' in carry):
+        # Check for a change in SS across the chunk boundary too
+        ss_prev[0] = carry['ss_prev']
+    changes = np.flatnonzero((ss_prev != ss) & ~np.isnan(ss_prev))
+
+    # Step through the changes, skipping those inside each removed period
+    starts = []
+    ends = []
+    k = 0
+    while k < len(changes):
+        i = changes[k]
+        if isinstance(settle_time, dict):
+            minutes = settle_time.get(ss[i], SS_SETTLE_TIME)
+        else:
+            minutes = settle_time
+        timestamp0 = data.index[i]
+        timestamp1 = timestamp0 + datetime.timedelta(minutes=minutes)
+        j = data.index.searchsorted(timestamp1, side='left')
+        starts.append(data.index.searchsorted(timestamp0, side='left'))
+        ends.append(j)
+        if carry is not None:
+            carry['blank_until'] = timestamp1
+        # Start checking again after the first row following the removed data
+        k = np.searchsorted(changes, j+1, side='left')
+
+    if starts:
+        # Mark the start and end of each period, and sweep through them
+        edges = np.zeros(len(data)+1, dtype=int)
+        edges[starts] += 1
+        edges[ends] -= 1
+        remove |= np.cumsum(edges[:-1]) > 0
+
+    if carry is not None:
+        carry['ss_prev'] = np.nan if remove[-1] else ss[-1]
+
+    return remove
+
 def ss_cal(ccn_data, atmos_press=1010, cal_press=830):
     '''
     Calibrates the reported supersaturation level for pressure.
@@ -1320,7 +2683,8 @@ def ss_cal(ccn_data, atmos_press=1010, cal_press=830):
         print("Assumed most recent calibration for the instrument was done in \
                Boulder and so I've used 830 mbar as calibration pressure for supersaturation calibration")
 
-    ccn_data['Current SS'] = ccn_data['Current SS'] + 0.028 * (atmos_press - cal_press) / 100
+    atmoscripts.set_column(ccn_data, 'Current SS',
+                           ccn_data['Current SS'] + 0.028 * (atmos_press - cal_press) / 100)
 
     return ccn_data
 
@@ -1331,11 +2695,34 @@ def timebase_resampler(data=0,
                        variable='ccn',
                        time_int='default',
                        split_by_supersaturation=True,
+                       ss_layout='wide',
                        output_filetype='h5',
+                       cascade=False,
+                       cascade_exact=None,
+                       qc_rules=None,
+                       writer=None,
+                       outputs=None,
                        gui_mode=False,
                        gui_mainloop=None):
     '''
     Time resampling
+
+    If cascade is True, the statistics of the shortest interval are merged
+    into the longer intervals rather than each interval being calculated
+    from the data, with the median and MAD estimated from a sketch of the
+    distribution (see atmoscripts.cascade_resampler), except for the
+    intervals in cascade_exact (or all of them if it's True).
+
+    If qc_rules is given, the rows failing each QC rule in each period are
+    counted from the QC flags of the data (see resample_interval).
+
+    If writer is given, the resampled data is written in the background (see
+    atmoscripts.start_writer). If outputs is given, the files (or parquet
+    stages) the resampled data is saved to are appended to it.
+
+    ss_layout is the layout of the data split by supersaturation (see
+    ss_split). Data in the long layout is grouped by time and supersaturation
+    directly, so cascade isn't used for it.
     '''
     #if no data provided, try to load from file
     if not isinstance(data, pd.DataFrame):
@@ -1349,6 +2736,42 @@ def timebase_resampler(data=0,
             return
 
 
+    time_int = get_time_intervals(time_int)
+
+    resampler = None
+    if split_by_supersaturation and ss_layout == 'long':
+        cascade = False
+    if cascade and [time for time in time_int if time != '1S']:
+        resampler = atmoscripts.cascade_resampler(data,
+                                                  [time for time in time_int
+                                                   if time != '1S'],
+                                                  exact=cascade_exact)
+
+    for time in time_int:
+        if time != '1S':
+            data_resamp = resample_interval(data, time,
+                                            split_by_supersaturation,
+                                            resampler, ss_layout, qc_rules)
+
+            # Save to file
+            fname = save_resampled_data(data, data_resamp, time,
+                                        variable, input_h5_filename,
+                                        output_filetype,
+                                        gui_mode,
+                                        gui_mainloop,
+                                        writer)
+            if outputs is not None:
+                outputs.append(fname)
+    try:
+        return data_resamp
+    except:
+        return data
+
+def get_time_intervals(time_int='default'):
+    '''
+    Interprets the time_int input of timebase_resampler, returning a list of
+    the time resampling intervals
+    '''
     # define time resampling intervals unless specified in function input
     if time_int == 'default':
         time_int = ['5S', '1Min', '5Min', '10Min', '30Min', '1H', '3H', '6H', '12H', '1D']
@@ -1361,148 +2784,140 @@ def timebase_resampler(data=0,
 
     if type(time_int) == str:
         time_int = [time_int]
-    # define MAD calculation
-    mad = lambda x: np.fabs(x - x.median()).median()
-
-    # define square root of the sum of squares calculation (root mean square numerator)
-    rmsn = lambda x: np.sqrt(np.sum(x**2))
+    return time_int
 
-    if split_by_supersaturation:
-        # Different data format to default
+def resample_interval(data, time, split_by_supersaturation=True,
+                      resampler=None, ss_layout='wide', qc_rules=None):
+    '''
+    Resamples the data to a single time interval and calculates the
+    uncertainties, as done for each interval by timebase_resampler.
+    The statistics are calculated by resampler, which defaults to
+    atmoscripts.resample_stats.
+
+    Data split by supersaturation in the long layout is resampled by time
+    and supersaturation together with atmoscripts.resample_stats (ignoring
+    resampler), giving a row for each supersaturation in each period with
+    the supersaturation in the 'ss' column.
+
+    If qc_rules is given (see ccn_qc_rules) and the data has QC flags, a
+    qc_<rule> column counting the rows which failed each rule is added (see
+    atmoscripts.qc_flag_counts). The flags are carried through ss_split
+    with its qc_counts option.
+    '''
+    if resampler is None:
+        resampler = atmoscripts.resample_stats
+
+    if split_by_supersaturation and ss_layout == 'long':
+        # Median, MAD, mean, std and count of each supersaturation
+        columns = [col for col in data.columns
+                   if col not in ['ss', 'ccn_sigma']]
+        data_resamp = atmoscripts.resample_stats(data[columns], time,
+                                                 by=data['ss'])
+        if 'ccn_sigma' in data:
+            rmsn = atmoscripts.resample_stats(data[['ccn_sigma']], time,
+                                              ['rmsn'], ['ccn'],
+                                              by=data['ss'])
+            data_resamp.insert(1, 'ccn_rmsn', rmsn['ccn_rmsn'].values)
+        else:
+            data_resamp.insert(1, 'ccn_rmsn', 0) # if no processing has been done previously
 
-        for time in time_int:
-            if time != '1S':
-                if 'NaN_ONLY' not in data.columns:
-                    data_temp = data.resample(time, fill_method=None).apply(rmsn)
-                    if 'ccn_sigma' in data_temp:
-                        data_resamp = pd.DataFrame(data_temp['ccn_sigma'])
-                        data_resamp.columns = ['ccn_rmsn']
-                    else:
-                        data_resamp = pd.DataFrame(data_temp.ix[:, 0]) # create dataframe
-                        data_resamp['ccn_rmsn'] = 0 # if no processing has been done previously
-                        # Find name of data column to remove
-                        del_col = [col for col in data_resamp.columns if 'ccn_rmsn' not in col]
-                        for col in del_col:
-                            del data_resamp[col]
-                    del data_temp
-                    for column in data.columns:
-                        if column != 'ccn_sigma':
-                            sub_ccn = pd.DataFrame(data[column].copy())
-                            try:
-                                data_resamp[column+'_med'] = \
-                                    sub_ccn.resample(time,
-                                                     fill_method=None).median()
-                                data_resamp[column+'_mad'] = \
-                                    sub_ccn.resample(time,
-                                                     fill_method=None).apply(mad)
-                                data_resamp[column+'_avg'] = \
-                                    sub_ccn.resample(time,
-                                                     fill_method=None).mean()
-                                data_resamp[column+'_std'] = \
-                                    sub_ccn.resample(time,
-                                                     fill_method=None).std()
-                                data_resamp[column+'_count'] = \
-                                    sub_ccn.resample(time,
-                                                     fill_method=None).count()
-                            except:
-                                # If the dataset contains only NaNs
-                                data_resamp[column+'_med'] = np.NaN
-                                data_resamp[column+'_mad'] = np.NaN
-                                data_resamp[column+'_avg'] = np.NaN
-                                data_resamp[column+'_std'] = np.NaN
-                                data_resamp[column+'_count'] = np.NaN
-
-                    # Calculate uncertainty:
-                    data_resamp = uncertainty_calc_time_resample(data_resamp,
-                                                                 'mad',
-                                                                 'count',
-                                                                 col_name='med',
-                                                                 output_sigma_name='sigma')
-
-                    # Reorder columns based on name:
-                    data_resamp.sort_index(axis=1)
-                else:
-                    data_resamp = data.resample(time).mean()
+        # Calculate uncertainty:
+        data_resamp = uncertainty_calc_time_resample(data_resamp,
+                                                     'mad',
+                                                     'count',
+                                                     col_name='med',
+                                                     output_sigma_name='sigma')
 
-                # Save to file
-                save_resampled_data(data, data_resamp, time,
-                                    variable, input_h5_filename,
-                                    output_filetype,
-                                    gui_mode,
-                                    gui_mainloop)
+    elif split_by_supersaturation:
+        # Different data format to default
+        if 'NaN_ONLY' not in data.columns:
+            if 'ccn_sigma' in data:
+                data_resamp = resampler(data[['ccn_sigma']],
+                                        time, ['rmsn'], ['ccn'])
+            else:
+                data_resamp = resampler(data, time, [])
+                data_resamp['ccn_rmsn'] = 0 # if no processing has been done previously
+
+            # Median, MAD, mean, std and count of each supersaturation
+            columns = [col for col in data.columns
+                       if col not in ['ccn_sigma', atmoscripts.QC_FLAG_COLUMN]]
+            data_resamp = pd.concat([data_resamp, resampler(data[columns], time)],
+                                    axis=1)
+
+            # Calculate uncertainty:
+            data_resamp = uncertainty_calc_time_resample(data_resamp,
+                                                         'mad',
+                                                         'count',
+                                                         col_name='med',
+                                                         output_sigma_name='sigma')
+
+            # Reorder columns based on name:
+            data_resamp.sort_index(axis=1)
+        else:
+            data_resamp = data[['NaN_ONLY']].resample(time).mean()
 
     else:
-
-        # define time resampling intervals
-        sub = data.iloc[:, 24:44].copy()
-        sub_ccn = data['CCN Number Conc'].copy()
-        for time in time_int:
-            if time != '1S':
-                data_resamp = sub.resample(time, fill_method=None).median()
-                data_resamp['ccn_count'] = \
-                        sub_ccn.resample(time, fill_method=None).count()
-                data_resamp['ccn_med'] = \
-                        sub_ccn.resample(time, fill_method=None).median()
-                data_resamp['ccn_mad'] = \
-                        sub_ccn.resample(time, fill_method=None).apply(mad)
-                data_resamp['ccn_avg'] = \
-                        sub_ccn.resample(time, fill_method=None).mean()
-                data_resamp['ccn_std'] = \
-                        sub_ccn.resample(time, fill_method=None).std()
-                data_resamp['ccn_rmsn'] = \
-                        sub_ccn.resample(time, fill_method=None).apply(rmsn)
-
-
-                # Calculate uncertainty:
-                data_resamp = uncertainty_calc_time_resample(data_resamp,
-                                                             'rmsn',
-                                                             'ccn_count',
-                                                             'mad',
-                                                             col_name='ccn_med',
-                                                             output_sigma_name='sigma_med')
-                data_resamp = uncertainty_calc_time_resample(data_resamp,
-                                                             'rmsn',
-                                                             'ccn_count',
-                                                             'std',
-                                                             col_name='ccn_avg',
-                                                             output_sigma_name='sigma_avg')
-                # Remove temporary calculation
-                del data_resamp['ccn_rmsn']
-
-                # Rename the cloud droplet bins so they make sense when the
-                # full data is merged
-                data_resamp.rename(columns={'Bin 1': 'CDN Bin 1',
-                                            'Bin 2': 'CDN Bin 2',
-                                            'Bin 3': 'CDN Bin 3',
-                                            'Bin 4': 'CDN Bin 4',
-                                            'Bin 5': 'CDN Bin 5',
-                                            'Bin 6': 'CDN Bin 6',
-                                            'Bin 7': 'CDN Bin 7',
-                                            'Bin 8': 'CDN Bin 8',
-                                            'Bin 9': 'CDN Bin 9',
-                                            'Bin 10': 'CDN Bin 10',
-                                            'Bin 11': 'CDN Bin 11',
-                                            'Bin 12': 'CDN Bin 12',
-                                            'Bin 13': 'CDN Bin 13',
-                                            'Bin 14': 'CDN Bin 14',
-                                            'Bin 15': 'CDN Bin 15',
-                                            'Bin 16': 'CDN Bin 16',
-                                            'Bin 17': 'CDN Bin 17',
-                                            'Bin 18': 'CDN Bin 18',
-                                            'Bin 19': 'CDN Bin 19',
-                                            'Bin 20': 'CDN Bin 20'},
-                                   inplace=True)
-
-                # Save to file
-                save_resampled_data(data, data_resamp, time,
-                                    variable, input_h5_filename,
-                                    output_filetype,
-                                    gui_mode,
-                                    gui_mainloop)
-    try:
-        return data_resamp
-    except:
-        return data
+        sub = data[CCN_COLNAMES[24:44]]
+
+        data_resamp = resampler(sub, time, ['med'])
+        data_resamp.columns = sub.columns
+        data_resamp = pd.concat([data_resamp,
+                                 resampler(data[['CCN Number Conc']],
+                                           time,
+                                           ['count', 'med', 'mad',
+                                            'avg', 'std', 'rmsn'],
+                                           ['ccn'])],
+                                axis=1)
+
+
+        # Calculate uncertainty:
+        data_resamp = uncertainty_calc_time_resample(data_resamp,
+                                                     'rmsn',
+                                                     'ccn_count',
+                                                     'mad',
+                                                     col_name='ccn_med',
+                                                     output_sigma_name='sigma_med')
+        data_resamp = uncertainty_calc_time_resample(data_resamp,
+                                                     'rmsn',
+                                                     'ccn_count',
+                                                     'std',
+                                                     col_name='ccn_avg',
+                                                     output_sigma_name='sigma_avg')
+        # Remove temporary calculation
+        del data_resamp['ccn_rmsn']
+
+        # Rename the cloud droplet bins so they make sense when the
+        # full data is merged
+        data_resamp.rename(columns={'Bin 1': 'CDN Bin 1',
+                                    'Bin 2': 'CDN Bin 2',
+                                    'Bin 3': 'CDN Bin 3',
+                                    'Bin 4': 'CDN Bin 4',
+                                    'Bin 5': 'CDN Bin 5',
+                                    'Bin 6': 'CDN Bin 6',
+                                    'Bin 7': 'CDN Bin 7',
+                                    'Bin 8': 'CDN Bin 8',
+                                    'Bin 9': 'CDN Bin 9',
+                                    'Bin 10': 'CDN Bin 10',
+                                    'Bin 11': 'CDN Bin 11',
+                                    'Bin 12': 'CDN Bin 12',
+                                    'Bin 13': 'CDN Bin 13',
+                                    'Bin 14': 'CDN Bin 14',
+                                    'Bin 15': 'CDN Bin 15',
+                                    'Bin 16': 'CDN Bin 16',
+                                    'Bin 17': 'CDN Bin 17',
+                                    'Bin 18': 'CDN Bin 18',
+                                    'Bin 19': 'CDN Bin 19',
+                                    'Bin 20': 'CDN Bin 20'},
+                           inplace=True)
+
+    if qc_rules is not None and atmoscripts.QC_FLAG_COLUMN in data.columns:
+        # Rows failing each QC rule
+        counts = atmoscripts.qc_flag_counts(data[atmoscripts.QC_FLAG_COLUMN].values,
+                                            data.index, qc_rules, time)
+        data_resamp = pd.concat([data_resamp,
+                                 counts.reindex(data_resamp.index)], axis=1)
+
+    return data_resamp
 
 def uncertainty_calc_time_resample(data,
                                    abs_sigma,
@@ -1511,8 +2926,8 @@ def uncertainty_calc_time_resample(data,
                                    col_name='CCN Number Conc',
                                    output_sigma_name='ccn_sigma'):
     '''
-    Propagates measurement uncertainty and adds statistical uncertainty:
-
+    Propagates measurement uncertainty and adds statistical uncertainty (see
+    atmoscripts.resample_sigma)
     '''
     # Find the rmsn column
     rmsn_cols = [col for col in data.columns if abs_sigma in col]
@@ -1531,9 +2946,9 @@ def uncertainty_calc_time_resample(data,
 
     for i in range(0, len(ss_root_names)):
         data[ss_root_names[i]+"_"+output_sigma_name] = \
-                    np.sqrt((data[rmsn_cols[i]]/data[count_cols[i]])**2
-                            +
-                            (data[dev_cols[i]]/np.sqrt(data[count_cols[i]]))**2)
+                    atmoscripts.resample_sigma(data[rmsn_cols[i]],
+                                               data[count_cols[i]],
+                                               data[dev_cols[i]])
 
     return data
 
@@ -1542,23 +2957,34 @@ def uncertainty_calc(data,
                      abs_sigma,
                      sigma_divisor,
                      col_name='CCN Number Conc',
-                     output_sigma_name='ccn_sigma'):
+                     output_sigma_name='ccn_sigma',
+                     sigma_dtype=None):
     '''
-    Calculates and propogates uncertainty for each calibration process
+    Calculates and propogates uncertainty for each calibration process (see
+    atmoscripts.propagate_sigma). Rows with a divisor of 0 get an
+    uncertainty of nan.
+
+    When the uncertainty is first calculated, the column is made with
+    sigma_dtype if it's given, e.g. float32 to halve its size along with
+    compact raw data. Later terms are calculated in float64 and stored at
+    the precision of the column.
     '''
     # Remove 0 divisors
-    sigma_divisor = pd.Series([np.nan if i == 0 else i for i in sigma_divisor],
-                              index=data.index)
+    sigma_divisor = atmoscripts.nonzero_divisor(sigma_divisor)
 
     if 'ccn_sigma' in data.columns:
-        data[output_sigma_name] = data[col_name] * \
-                                  ((abs_sigma/sigma_divisor)**2
-                                   +
-                                   (data['ccn_sigma']/data[col_name])**2)**0.5
+        atmoscripts.set_column(data, output_sigma_name,
+                               atmoscripts.propagate_sigma(data[col_name],
+                                                           abs_sigma,
+                                                           sigma_divisor,
+                                                           data['ccn_sigma']))
 
     else: #Initialise
-        data['ccn_sigma'] = data['CCN Number Conc'] * \
-                            ((abs_sigma/sigma_divisor)**2)**0.5
+        sigma = atmoscripts.propagate_sigma(data['CCN Number Conc'],
+                                            abs_sigma, sigma_divisor)
+        if sigma_dtype is not None:
+            sigma = sigma.astype(sigma_dtype)
+        data['ccn_sigma'] = sigma
 
     return data
 
@@ -1568,8 +2994,12 @@ def save_resampled_data(data, data_resamp, time_int,
                         input_h5_filename=None,
                         output_filetype='h5',
                         gui_mode=False,
-                        gui_mainloop=None):
-
+                        gui_mainloop=None,
+                        writer=None):
+    '''
+    Saves the data resampled to time_int, returning the name of the file, or
+    the path of the parquet stage, that it's saved to.
+    '''
     if input_h5_filename is not None:
         s = input_h5_filename.split('.')
         outputfilename = s[0]+'_'+time_int+'.'+output_filetype
@@ -1579,17 +3009,26 @@ def save_resampled_data(data, data_resamp, time_int,
         outputfilename = 'undefinedData_'+ time_int +'.'+output_filetype
 
     if output_filetype in ['h5', 'hdf']:
-        data_resamp.to_hdf(outputfilename, key=variable)
+        atmoscripts.submit_write(writer, outputfilename, data_resamp.to_hdf,
+                                 os.path.abspath(outputfilename), key=variable)
+    elif output_filetype == 'parquet':
+        # Saved to the dataset in the current directory, with the time
+        # interval as the processing stage
+        atmoscripts.submit_write(writer, None, atmoscripts.df_to_parquet,
+                                 data_resamp, os.getcwd(), 'CCN', time_int)
+        return atmoscripts.parquet_stage_path(os.getcwd(), 'CCN', time_int)
     elif output_filetype in ['nc', 'netcdf']:
         #xkcd
+        atmoscripts.wait_for_writes(writer)
         atmoscripts.df_to_netcdf(data_resamp,
                                  outputfilename,
                                  gui_mode=gui_mode,
                                  gui_mainloop=gui_mainloop)
     else:
-        data_resamp.to_csv(outputfilename)
+        atmoscripts.submit_write(writer, outputfilename, data_resamp.to_csv,
+                                 os.path.abspath(outputfilename))
 
-    return
+    return os.path.abspath(outputfilename)
 
 # if this script is run at the command line, run the main script
 if __name__ == '__main__':
@@ -8,14 +8,24 @@ import os
 import sys
 import pandas as pd
 import glob
+import io
 import pickle
 import numpy as np
 import re
+import time as systime
+import concurrent.futures
 import matplotlib.pyplot as plt
 
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 import atmoscripts
 
+# Processing stages which LoadAndProcess can save, in processing order
+CN_STAGES = ['QC', 'flowCal', 'logFilt']
+
+# Columns which the stages change, besides setting rows to nan and adding
+# columns, which are all the stage diffs need to be taken from
+CN_STAGE_COLUMNS = ['Concentration', 'cn_sigma', atmoscripts.QC_FLAG_COLUMN]
+
 def Load_to_HDF(input_path= None,
                 input_filelist = None,
                 output_path = None,
@@ -24,10 +34,16 @@ def Load_to_HDF(input_path= None,
                 OutputTZ = 0,
                 resample_time = False,
                 output_file_frequency = 'all',
-                force_reload_from_source = False
+                force_reload_from_source = False,
+                workers = None,
+                compact = False
                 ):
     """
     Load performed after data has been exported to CSV file with just raw concentrations and times.
+    If workers is an integer greater than 1, the csv files are parsed in a pool
+    of that many processes and written to the hdf file(s) in one go.
+    If compact is True, the concentrations are stored as float32 (see
+    expand_cpc_samples).
     """
     if output_path is None:
         os.chdir(input_path)
@@ -39,50 +55,66 @@ def Load_to_HDF(input_path= None,
 
     output_h5_filename = output_h5_filename + '_raw'
 
+    # The files loaded are recorded next to the output rather than the raw data
+    manifest_filename = atmoscripts.manifest_path(input_path
+                                                  if output_path is None
+                                                  else output_path)
+
     if force_reload_from_source:
-        remove_previous_output('h5',force_reload_from_source, input_filelist)
+        remove_previous_output('h5',force_reload_from_source, input_filelist,
+                               manifest_filename)
 
     if input_filelist is None:
         os.chdir(input_path)
         filelist = glob.glob('*.csv')
-        # Check if previous data has been loaded, if so, don't load it again
-        if os.path.isfile('files_loaded.txt'):
-            with open('files_loaded.txt', 'rb') as f:
-                files_already_loaded = pickle.load(f)
-            # Get only the new files to be loaded:
-            filelist=list(set(filelist).difference(set(files_already_loaded)))
-        # Read where the import has gotten up to previously:
-            if os.path.isfile('partial_files_loaded.txt'):
-                with open('partial_files_loaded.txt','r') as f:
-                    last_loaded = f.readlines()
-                    last_loaded = [x.strip() for x in last_loaded]
-                    last_loaded_file = last_loaded[0]
-                if type(last_loaded_file) is str:
-                    filelist.append(last_loaded_file)
     else:
         filelist = input_filelist
     filelist.sort()
-
-    #Iterate through to load the raw files
-    for file in filelist:
-        # Read cpc csv file
-        read_cpc_csv(file, output_h5_filename, output_file_frequency,
-                     InputTZ, OutputTZ)
+    # Check if previous data has been loaded, if so, don't load it again.
+    # Files which have grown since are loaded from the last sample which
+    # was loaded previously.
+    checked = atmoscripts.check_manifest(filelist,
+                                         atmoscripts.read_manifest(manifest_filename))
+
+    to_load = [(fname, status, record) for fname, status, record in checked
+               if status in ['new', 'changed', 'grown']]
+    skip_samples = [max(record['rows'] - 1, 0)
+                    if status == 'grown' and record['rows'] is not None else 0
+                    for fname, status, record in to_load]
+    # Record the unchanged files whose record has been updated
+    atmoscripts.write_manifest([record for fname, status, record in checked
+                                if status in ['unchanged', 'moved']
+                                and record is not None],
+                               manifest_filename)
+
+    if (workers is not None) and (workers > 1) and (len(to_load) > 1):
+        loaded = read_cpc_csv_parallel([fname for fname, _, _ in to_load],
+                                       output_h5_filename,
+                                       output_file_frequency, InputTZ, OutputTZ,
+                                       workers, skip_samples, compact)
+        atmoscripts.write_manifest(
+                [atmoscripts.set_manifest_rows(record, *loaded[i])
+                 for i, (fname, status, record) in enumerate(to_load)
+                 if loaded[i] is not None],
+                manifest_filename)
+    else:
+        #Iterate through to load the raw files
+        for (file, status, record), skip in zip(to_load, skip_samples):
+            # Read cpc csv file
+            loaded = read_cpc_csv(file, output_h5_filename,
+                                  output_file_frequency, InputTZ, OutputTZ,
+                                  skip, compact)
+            # Record each file as it's loaded, so an interrupted update
+            # doesn't load it again
+            if loaded is not None:
+                atmoscripts.write_manifest(
+                        [atmoscripts.set_manifest_rows(record, *loaded)],
+                        manifest_filename)
 
     # Clean up
     if os.path.isfile('partial_files_loaded.txt'):
         os.remove('partial_files_loaded.txt')
 
-    #Save the files that have already been loaded to file for next update
-    with open('files_loaded.txt', 'wb') as f:
-        try:
-            files_already_loaded
-        except NameError:
-            filelist = filelist
-        else:
-            filelist = filelist + files_already_loaded
-        pickle.dump(filelist, f)
-
     if resample_time:
         timebase_resampler(input_path, output_h5_filename,
                            variable = output_h5_filename,
@@ -101,6 +133,8 @@ def Load_to_NonHDF(input_path= None,
                 output_file_frequency = 'all',
                 force_reload_from_source = False,
                 output_file_format = 'csv',
+                workers = None,
+                compact = False,
 
                 gui_mode = True,
                 gui_mainloop = None
@@ -121,7 +155,9 @@ def Load_to_NonHDF(input_path= None,
                 OutputTZ = OutputTZ,
                 resample_time = resample_time,
                 output_file_frequency = output_file_frequency,
-                force_reload_from_source = force_reload_from_source
+                force_reload_from_source = force_reload_from_source,
+                workers = workers,
+                compact = compact
                 )
 
     os.chdir(output_path)
@@ -157,10 +193,24 @@ def Load_to_NonHDF(input_path= None,
     return
 
 
-def load_cn(data_path=None, filetype=None, fname=None):
+def load_cn(data_path=None, filetype=None, fname=None,
+            stage=None, columns=None, start=None, end=None):
     '''
     Loads data from concatenated data file.
+    Only the given columns are returned if columns isn't None, and only the
+    data from start up to (but not including) end if they are given. For a
+    parquet dataset, the processing stage (e.g. 'flowCal' or a resampling
+    interval such as '5S') is loaded from the dataset at fname, or at
+    data_path if there's no fname, reading only the parts of the dataset
+    needed for the columns and time range.
     '''
+    if filetype == 'parquet':
+        assert stage is not None, 'specify the processing stage to load!'
+        if fname is None:
+            fname = data_path
+        return atmoscripts.read_parquet(fname, 'CPC', stage,
+                                        columns, start, end)
+
     if fname is None:
         assert data_path is not None, 'specify data path!'
         assert filetype is not None, 'specify filetype!'
@@ -184,14 +234,34 @@ def load_cn(data_path=None, filetype=None, fname=None):
                            parse_dates=True,
                            infer_datetime_format=True)
 
+    if columns is not None:
+        data = data[columns]
+    if start is not None:
+        data = data[data.index >= pd.Timestamp(start)]
+    if end is not None:
+        data = data[data.index < pd.Timestamp(end)]
     return data
 
+def query(data_path, stage='raw', start=None, end=None, columns=None,
+          resolution=None, filetype='h5'):
+    '''
+    Returns the CPC data of a processing stage (e.g. 'raw' or 'flowCal'), or
+    resampled to a time resolution (e.g. '1Min'), from start up to (but not
+    including) end, with only the given columns if columns isn't None. Only
+    the files in data_path which overlap the time range are read, and only
+    the rows in the range are read from hdf tables and parquet datasets.
+    See atmoscripts.query.
+    '''
+    return atmoscripts.query(data_path, 'CPC', stage, start, end,
+                             columns, resolution, filetype)
 
-def remove_previous_output(filetype, reload_from_source, input_flist):
+def remove_previous_output(filetype, reload_from_source, input_flist,
+                           manifest_filename = atmoscripts.FILE_MANIFEST):
     '''
     Checks if previous files have been created. If not, then return true and
     create the new files. If so, and you've been asked to reload_from_source,
     return true. Otherwise, return false and don't reload the files.
+    The manifest of loaded files, manifest_filename, is removed too.
     '''
     input_filelist = [f.split('/')[-1] for f in input_flist]
     filelist = glob.glob('*'+filetype)
@@ -202,6 +272,8 @@ def remove_previous_output(filetype, reload_from_source, input_flist):
                 os.remove(file)
         if os.path.isfile('files_loaded.txt'):
             os.remove('files_loaded.txt')
+        if os.path.isfile(manifest_filename):
+            os.remove(manifest_filename)
     return
 
 def save_to_hdf(data, output_h5_filename, output_file_frequency):
@@ -334,13 +406,15 @@ def check_cpc_file_format(filename):
 def append_to_list(lst, line):
     return lst.append(line)
 
-def read_cpc_csv(read_filename, output_filename_base, output_file_frequency, InputTZ=0, OutputTZ=0):
+def read_cpc_csv(read_filename, output_filename_base, output_file_frequency, InputTZ=0, OutputTZ=0,
+                 skip_samples=0, compact=False):
     '''
     Reads CPC data exports from AIM 10 and higher as row based, with
-    ONLY concentration data output
+    ONLY concentration data output. The first skip_samples samples in the
+    file are skipped.
+    Returns the number of samples in the file and the timestamps loaded, or
+    None if the file isn't a CPC export.
     '''
-    import numpy as np
-
     if output_file_frequency == 'all':
         print('Saving all data to a single HDF file')
     else:
@@ -350,81 +424,265 @@ def read_cpc_csv(read_filename, output_filename_base, output_file_frequency, Inp
     read_filename = check_cpc_file_format(read_filename)
     if read_filename is None:
         return
-    # Read each row of data, taking into account that each row can change length and parsing format (weird...)
-    df = pd.read_csv(read_filename, skiprows = range(0,3), engine='python', skipinitialspace=True, iterator = True, chunksize = 1000)
+    if not is_cpc_export(read_filename):
+        # The csv file that you've read isn't actually a TSI CPC file
+        return
 
     # Read the number of samples in the file
-    with open(read_filename) as f:
-        lastline = f.readlines()[-1]
-    numsamples = lastline.split(",")[0]
+    numsamples = get_cpc_numsamples(read_filename)
 
     # Read where the import has gotten up to previously:
-    first_load = True
-    if os.path.isfile('partial_files_loaded.txt'):
-        with open('partial_files_loaded.txt','r') as f:
-            last_loaded = f.readlines()
-            last_loaded = [x.strip() for x in last_loaded]
-            last_loaded_file = last_loaded[0]
-            last_loaded_sample = int(last_loaded[1])
-            first_load = False
+    last_loaded_file, last_loaded_sample = read_partial_load_state()
+    last_loaded_sample = samples_to_skip(read_filename, last_loaded_file,
+                                         last_loaded_sample, skip_samples)
+
+    index = []
+    for chunk, data in read_cpc_chunks(read_filename, numsamples,
+                                       InputTZ, OutputTZ,
+                                       read_filename, last_loaded_sample,
+                                       compact):
+        # Save to hdf file
+        print('Saving chunk to file')
+        outputfilename = save_to_hdf(data, output_filename_base, output_file_frequency)
+        index.append(data.index)
+
+        # Alert the user where the process is up to
+        print('Data loaded from ' + read_filename +' and samples ' + str(chunk['Sample #'].iloc[0])
+                    + ' to ' + str(chunk['Sample #'].iloc[-1]) + ' saved to ' + outputfilename)
+
+    write_partial_load_state(read_filename, numsamples)
+    if len(index) > 0:
+        index = index[0].append(index[1:])
+    else:
+        index = pd.DatetimeIndex([])
+    return count_samples(numsamples), index
+
+def read_cpc_csv_parallel(filelist, output_filename_base, output_file_frequency,
+                          InputTZ=0, OutputTZ=0, workers=2, skip_samples=None,
+                          compact=False):
+    '''
+    Parses a list of CPC csv files in a pool of worker processes, then merges
+    them in timestamp order and saves them to hdf in one go. Where timestamps
+    are duplicated, the data from the file later in the list is kept, as when
+    the files are loaded one after the other with read_cpc_csv.
+    If skip_samples is given, it's a list with the number of samples to skip
+    at the start of each file.
+    Returns a list with the number of samples and the timestamps loaded from
+    each file as read_cpc_csv does.
+    '''
+    if output_file_frequency == 'all':
+        print('Saving all data to a single HDF file')
+    else:
+        print('Saving to ' + output_file_frequency + ' HDF file')
+
+    # The workers only see where the previous import had gotten up to
+    last_loaded_file, last_loaded_sample = read_partial_load_state()
+
+    print('Reading ' + str(len(filelist)) + ' files with ' + str(workers)
+          + ' worker processes')
+    n = len(filelist)
+    if skip_samples is None:
+        skip_samples = [0]*n
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        # map returns the results in the order of the filelist
+        results = list(pool.map(parse_cpc_csv, filelist,
+                                [InputTZ]*n, [OutputTZ]*n,
+                                [last_loaded_file]*n, [last_loaded_sample]*n,
+                                skip_samples, [compact]*n))
+
+    frames = [data for _, _, data in results if data is not None]
+    if len(frames) > 0:
+        data = atmoscripts.merge_timestamped(frames)
+        print('Saving data to file')
+        outputfilename = save_to_hdf(data, output_filename_base, output_file_frequency)
+        print('Data loaded from ' + str(len(frames)) + ' files and saved to '
+              + outputfilename)
+
+    # Record the last file which was successfully read
+    loaded = [(f, num) for f, num, _ in results if f is not None]
+    if len(loaded) > 0:
+        write_partial_load_state(*loaded[-1])
+
+    return [(count_samples(num),
+             data.index if data is not None else pd.DatetimeIndex([]))
+            if f is not None else None
+            for f, num, data in results]
+
+def parse_cpc_csv(read_filename, InputTZ=0, OutputTZ=0,
+                  last_loaded_file=None, last_loaded_sample=None,
+                  skip_samples=0, compact=False):
+    '''
+    Parses a whole CPC csv file without saving it, skipping its first
+    skip_samples samples. Used by the worker processes of
+    read_cpc_csv_parallel.
+    Returns the (possibly reformatted) filename, the number of samples and the
+    data, or None for the filename if the file isn't a CPC export and None for
+    the data if there was nothing new to load.
+    '''
+    read_filename = check_cpc_file_format(read_filename)
+    if (read_filename is None) or (not is_cpc_export(read_filename)):
+        return None, None, None
+
+    numsamples = get_cpc_numsamples(read_filename)
+    last_loaded_sample = samples_to_skip(read_filename, last_loaded_file,
+                                         last_loaded_sample, skip_samples)
+
+    frames = [data for _, data in read_cpc_chunks(read_filename, numsamples,
+                                                  InputTZ, OutputTZ,
+                                                  read_filename,
+                                                  last_loaded_sample,
+                                                  compact)]
+    if len(frames) == 0:
+        return read_filename, numsamples, None
+
+    data = pd.concat(frames)
+    # Drop duplicates between chunks, keeping the last as save_to_hdf would
+    data = data[~data.index.duplicated(keep='last')]
+    return read_filename, numsamples, data
+
+def read_cpc_chunks(read_filename, numsamples, InputTZ=0, OutputTZ=0,
+                    last_loaded_file=None, last_loaded_sample=None,
+                    compact=False):
+    '''
+    Generator which reads a row based CPC export in chunks of 1000 samples and
+    yields each chunk along with its data as a dataframe of concentrations
+    indexed by timestamp. Samples up to last_loaded_sample are skipped if this
+    file is the last_loaded_file. If compact is True, the concentrations are
+    float32 (see expand_cpc_samples).
+    '''
+    # Read each row of data, taking into account that each row can change length and parsing format (weird...)
+    df = pd.read_csv(read_filename, skiprows = range(0,3), engine='python', skipinitialspace=True, iterator = True, chunksize = 1000)
 
     for chunk in df:
         # Extract initial timestamp for each sample (i.e. each row)
-        try:
-            chunk['sample_timestamp'] = pd.to_datetime(chunk['Start Date']+' '+chunk['Start Time'], format = '%m/%d/%y %H:%M:%S')
-            chunk = chunk.reset_index()
-            del chunk['index']
-        except KeyError:
-            # The csv file that you've read isn't actually a TSI CPC file
-            return
-
-        data = pd.DataFrame(columns = {'Timestamp', 'Concentration'})
-        for rowidx in range(0,len(chunk)):
-            if not first_load:
-                if (chunk['Sample #'][rowidx] <= last_loaded_sample) and (read_filename == last_loaded_file):
-                    continue
-            # Create timestamp and extract concentration for each sample in chunk
-            timestamp = [chunk['sample_timestamp'][rowidx]+pd.Timedelta(seconds=x) for x in range(0,chunk['Sample Length'][rowidx])]
-            conc = chunk.loc[rowidx][12:(12+chunk['Sample Length'][rowidx])]
+        chunk['sample_timestamp'] = pd.to_datetime(chunk['Start Date']+' '+chunk['Start Time'], format = '%m/%d/%y %H:%M:%S')
+        chunk = chunk.reset_index()
+        del chunk['index']
+
+        # Skip the samples which have been loaded previously
+        if last_loaded_file is not None and read_filename == last_loaded_file:
+            chunk = chunk[chunk['Sample #'] > last_loaded_sample]
+        if len(chunk) == 0:
+            continue
 
-            print('Formatting sample ' + str(chunk['Sample #'].loc[rowidx])
-                  + ' of ' + numsamples + ' from file ' + read_filename)
+        print('Formatting samples ' + str(chunk['Sample #'].iloc[0]) + ' to '
+              + str(chunk['Sample #'].iloc[-1]) + ' of ' + numsamples
+              + ' from file ' + read_filename)
 
-            # Format data as dataframe
-            data_temp = pd.DataFrame({'Timestamp': timestamp, 'Concentration': conc.values})
-            # Append new data to current data
-            data = pd.concat([data,data_temp])
+        # Create timestamp and extract concentration for every sample in chunk
+        data = expand_cpc_samples(chunk, compact)
 
         if len(data) != 0:
-            # Drop duplicates that may be present
-            data = data.drop_duplicates(subset='Timestamp', keep='last')
-            # Set index
-            data = data.set_index('Timestamp')
-            # Coerce data to the correct type, dealing with infinite values output from AIM
-            data['Concentration'] = [np.nan if x == '1.#INF'  else float(x) for x in data['Concentration']]
-
             #Correct for Timezone offsets caused by AIM exporting process
             if InputTZ-OutputTZ != 0 :
                 data = TimeZoneCorrection(data, CurrentTZ = InputTZ, OutputTZ = OutputTZ)
 
-            # Save to hdf file
-            print('Saving chunk to file')
-            outputfilename = save_to_hdf(data, output_filename_base, output_file_frequency)
+            yield chunk, data
+
+def expand_cpc_samples(chunk, compact=False):
+    '''
+    Expands a chunk of row based CPC samples into a dataframe of
+    concentrations indexed by timestamp, with one row per second of each
+    sample. Each row of the chunk holds the sample start time in
+    'sample_timestamp', its length in 'Sample Length' and the concentrations
+    from the 13th column onwards.
+    Duplicate timestamps keep the last sample, and the infinite values output
+    from AIM ('1.#INF') are set to nan.
+    If compact is True, the concentrations are float32 rather than float64,
+    halving their size in memory and on disk. float32 keeps about 7
+    significant figures (a relative error of at most 2**-24), more than AIM
+    exports the concentrations with.
+    '''
+    lengths = chunk['Sample Length'].values.astype(np.int64)
+    maxlen = lengths.max() if len(lengths) > 0 else 0
+
+    # Seconds since the start of its sample for every data point, with the
+    # samples laid end to end
+    sample_starts = np.cumsum(lengths) - lengths
+    offsets = np.arange(lengths.sum()) - np.repeat(sample_starts, lengths)
+    timestamp = np.repeat(chunk['sample_timestamp'].values, lengths) + \
+                offsets.astype('timedelta64[s]')
+
+    # Take the first 'Sample Length' concentrations from each row, in row order
+    conc_block = chunk.iloc[:, 12:12+maxlen].values
+    in_sample = np.arange(conc_block.shape[1]) < lengths[:, None]
+    conc = conc_block[in_sample]
+
+    data = pd.DataFrame({'Timestamp': timestamp, 'Concentration': conc})
+
+    # Drop duplicates that may be present
+    data = data.drop_duplicates(subset='Timestamp', keep='last')
+    # Set index
+    data = data.set_index('Timestamp')
+    # Coerce data to the correct type, dealing with infinite values output from AIM
+    data['Concentration'] = \
+        data['Concentration'].replace('1.#INF', np.nan).astype(
+                np.float32 if compact else float)
+
+    return data
 
-            # Alert the user where the process is up to
-            print('Data loaded from ' + read_filename +' and samples ' + str(chunk['Sample #'].iloc[0])
-                        + ' to ' + str(chunk['Sample #'].iloc[-1]) + ' saved to ' + outputfilename)
+def is_cpc_export(read_filename):
+    '''
+    Checks that the csv file is actually a TSI CPC export, i.e. that it has
+    the sample start date and time columns
+    '''
+    header = pd.read_csv(read_filename, skiprows = range(0,3), engine='python',
+                         skipinitialspace=True, nrows=0)
+    return ('Start Date' in header.columns) and ('Start Time' in header.columns)
 
+def get_cpc_numsamples(read_filename):
+    '''
+    Reads the number of samples in the file from the last line
+    '''
+    with open(read_filename) as f:
+        lastline = f.readlines()[-1]
+    return lastline.split(",")[0]
+
+def count_samples(numsamples):
+    '''
+    Converts the number of samples read by get_cpc_numsamples to an integer,
+    or None if the last line of the file doesn't start with a sample number
+    (e.g. it was only partially written)
+    '''
+    try:
+        return int(numsamples)
+    except ValueError:
+        return None
+
+def samples_to_skip(read_filename, last_loaded_file, last_loaded_sample,
+                    skip_samples=0):
+    '''
+    Returns the number of samples to skip at the start of a file, being the
+    larger of skip_samples and the samples loaded previously if the file is
+    the last_loaded_file of the partial load state
+    '''
+    if last_loaded_file is not None and read_filename == last_loaded_file:
+        return max(last_loaded_sample, skip_samples)
+    return skip_samples
+
+def read_partial_load_state():
+    '''
+    Reads where the import has gotten up to previously, returning the last
+    loaded file and sample number, or None for both if there's no record.
+    '''
+    if not os.path.isfile('partial_files_loaded.txt'):
+        return None, None
+    with open('partial_files_loaded.txt','r') as f:
+        last_loaded = f.readlines()
+        last_loaded = [x.strip() for x in last_loaded]
+    return last_loaded[0], int(last_loaded[1])
+
+def write_partial_load_state(read_filename, numsamples):
+    '''
+    Records the last file loaded and its number of samples, so the next update
+    can pick up where this one finished
+    '''
     if os.path.isfile('partial_files_loaded.txt'):
         os.remove('partial_files_loaded.txt')
     with open('partial_files_loaded.txt','wt') as f:
         f.write(read_filename)
         f.write('\n')
         f.write(numsamples)
-
-    # Make sure the file is closed
-    f = open(read_filename,'r')
-    f.close()
     return
 
 def read_cpc_csv_row_AIM9(read_filename, output_filename_base, output_file_frequency, InputTZ=0, OutputTZ=0):
@@ -577,6 +835,32 @@ def TimeZoneCorrection(DataFrame, CurrentTZ, ConvertToUTC = True, OutputTZ = 0):
     return DataFrame
 
 
+def cn_qc_rules(conc_max = 1e4):
+    '''
+    Returns the QC rules of DataQC (see atmoscripts.qc_flags), in the order of
+    their bits in the qc_flags column.
+    '''
+    return [
+        # Negative concentrations
+        {'name': 'conc_negative', 'column': 'Concentration', 'min': 0},
+
+        # Concentrations above the single particle counting range, where
+        # coincidence undercounts (10^4 /cm3 for the 3772)
+        {'name': 'conc_high', 'column': 'Concentration', 'max': conc_max},
+        ]
+
+def DataQC(data, conc_max = 1e4):
+    '''
+    Removes the concentrations failing the rules of cn_qc_rules in one step,
+    keeping the bitmask of the rules each row failed in the qc_flags column,
+    as the QC of the CCNC does (see atmoscripts.qc_flags). conc_max is the
+    upper limit of the counting range, e.g. 10^4 /cm3 for the 3772 or
+    3 x 10^5 /cm3 for the 3776.
+    The data is modified in place.
+    '''
+    flags = atmoscripts.qc_flags(data, cn_qc_rules(conc_max))
+    return atmoscripts.apply_qc_flags(data, flags)
+
 def flow_cal(data,
              flow_cal_filename = None,
              flow_cal_path = None,
@@ -644,14 +928,15 @@ def flow_cal(data,
     x_data = (pd.to_datetime(data.index) - \
               measured_flows_df.index[0]).total_seconds()
 
-    data['Concentration'] = data['Concentration']/set_flow_rate*p(x_data)
+    flow_rate = p(x_data)
+    atmoscripts.set_column(data, 'Concentration',
+                           data['Concentration']/set_flow_rate*flow_rate)
    #plt.plot(x,y,'.',xp,p(xp),'--')
 
 
 
     # Rel uncertainty is abs divided by median of liniear regression
-    sigma_divisor = p(x_data)
-    data = uncertainty_calc(data,sigma_abs,sigma_divisor)
+    data = uncertainty_calc(data,sigma_abs,flow_rate)
 
     return data
 
@@ -781,8 +1066,19 @@ def LoadAndProcess(cn_raw_path = None,
                    filename_base = 'CN',
                    force_reload_from_source = False,
                    output_time_resolution = '1S',
+                   cascade_resample = False,
+                   cascade_exact = None,
                    concat_file_frequency = 'all',
                    input_filelist = None,
+                   workers = None,
+                   compact = False,
+                   background_writes = True,
+                   persist_stages = 'all',
+                   stage_format = 'full',
+                   resume = False,
+                   report_memory = False,
+                   follow = False,
+                   poll_interval = 5,
 
                    gui_mode = False,
                    gui_mainloop = None,
@@ -791,6 +1087,10 @@ def LoadAndProcess(cn_raw_path = None,
                    CurrentTZ = 0,
                    OutputTZ = 0,
 
+                   QC = False,
+                   CN_conc_max = 1e4,
+                   qc_counts = False,
+
                    mask_period_file = None,
                    mask_period_timestamp_df = None,
 
@@ -803,17 +1103,93 @@ def LoadAndProcess(cn_raw_path = None,
                    ):
     '''
     Loads CPC data from csv files exported from AIM, concatenates, then saves
-    to output files of hdf, netcdf or csv format.
+    to output files of hdf, netcdf or csv format, or to a parquet dataset.
+    With parquet, the concatenated raw data is kept in hdf files and the
+    processed data of each step is saved to the dataset in the output path
+    (see atmoscripts.df_to_parquet).
     Data can then be:
+        - quality controlled for the concentration limits of cn_qc_rules,
+        with CN_conc_max as the upper limit (see DataQC)
         - calibrated for flow rates
         - correcting for time zone offsets resulting from timezone errors in
         exporting data
         - filtering for logged events
         - If requested, it will perform exhaust removal (assuming its on the RVI)
+    If workers is an integer greater than 1, the raw csv files are parsed in a
+    pool of that many processes.
+    If compact is True, the concentrations are loaded as float32, halving the
+    size of the raw data in memory and on disk (see expand_cpc_samples), and
+    their uncertainties are stored as float32 too (see uncertainty_calc). The
+    raw files are only loaded again with force_reload_from_source.
+    If cascade_resample is True, the longer time resampling intervals are
+    merged from the statistics of the shorter ones (see timebase_resampler).
+    cascade_exact is a list of the intervals whose median and MAD are still
+    calculated exactly from the data, or True for all of them.
+    If qc_counts is True (along with QC), the resampled data has a qc_<rule>
+    column for each rule of cn_qc_rules, counting the rows which failed it
+    in each period (see atmoscripts.qc_flag_counts).
+    If background_writes is True, the output of each step is written in a
+    background thread while the next step is processed (see
+    atmoscripts.start_writer). Each file's output is finished before the
+    next file is loaded, and errors from the writes are raised as usual.
+    persist_stages is 'all', 'none' or a list of the stages in CN_STAGES
+    whose output is saved. With stage_format 'diff', only the rows each
+    saved stage set to nan and the columns it changed are saved, rather than
+    a full copy of the data (see save_stage). load_stage rebuilds a stage
+    from the concatenated raw file and the diffs.
+    The stages completed for each concatenated raw file are recorded in
+    checkpoints.jsonl in the output path, along with the parameters they were
+    run with and where their output was saved (see
+    atmoscripts.read_checkpoints). If resume is True, a file which has been
+    processed before with the same parameters is skipped, and one whose
+    processing was cut short carries on from the output of the last stage
+    that was saved, rather than starting over.
+    The stages work on the data in place rather than on copies of it. If
+    report_memory is True, the memory each stage allocates is printed (see
+    atmoscripts.report_memory).
+    If follow is True, the csv files in cn_raw_path are followed as AIM
+    exports them instead, processing the new samples every poll_interval
+    seconds until interrupted (see follow_cn). Following can't be combined
+    with the options of the batch processing which it doesn't support:
+    load_from_filetype, input_filelist, workers, cascade_resample,
+    cascade_exact, persist_stages, stage_format, resume and report_memory.
     '''
     if cn_output_path is None:
         cn_output_path = cn_raw_path
 
+    if follow:
+        unsupported = {'load_from_filetype': load_from_filetype != 'csv',
+                       'input_filelist': input_filelist is not None,
+                       'workers': (workers or 1) > 1,
+                       'cascade_resample': cascade_resample,
+                       'cascade_exact': cascade_exact is not None,
+                       'persist_stages': persist_stages != 'all',
+                       'stage_format': stage_format != 'full',
+                       'resume': resume,
+                       'report_memory': report_memory}
+        assert not any(unsupported.values()), "follow can't be used with " + \
+            ', '.join(name for name, used in unsupported.items() if used)
+
+        follow_cn(cn_raw_path,
+                  cn_output_path = cn_output_path,
+                  cn_output_filetype = cn_output_filetype,
+                  filename_base = filename_base,
+                  poll_interval = poll_interval,
+                  output_time_resolution = output_time_resolution,
+                  InputTZ = CurrentTZ,
+                  OutputTZ = OutputTZ,
+                  QC = QC,
+                  CN_conc_max = CN_conc_max,
+                  qc_counts = qc_counts,
+                  mask_period_file = mask_period_file,
+                  mask_period_timestamp_df = mask_period_timestamp_df,
+                  flow_cal_file = flow_cal_file,
+                  flow_cal_df = flow_cal_df,
+                  CN_flow_setpt = CN_flow_setpt,
+                  CN_flow_polyDeg = CN_flow_polyDeg,
+                  compact = compact)
+        return
+
     if load_from_filetype == "csv" and force_reload_from_source:
         load_data_to_file(
                           cn_raw_path = cn_raw_path,
@@ -825,95 +1201,516 @@ def LoadAndProcess(cn_raw_path = None,
                           concat_file_frequency = concat_file_frequency,
                           InputTZ = CurrentTZ,
                           OutputTZ= OutputTZ,
+                          workers = workers,
+                          compact = compact,
                           gui_mode = gui_mode,
                           gui_mainloop = gui_mainloop
                           )
 
-    raw_filelist = get_raw_filelist(cn_output_path,cn_output_filetype, 'raw')
+    # The raw data is concatenated to hdf when saving to parquet
+    if cn_output_filetype == 'parquet':
+        raw_filelist = get_raw_filelist(cn_output_path, 'h5', 'raw')
+    else:
+        raw_filelist = get_raw_filelist(cn_output_path,cn_output_filetype, 'raw')
+
+    writer = atmoscripts.start_writer() if background_writes else None
+    report = atmoscripts.start_memory_report() if report_memory else None
+    persist = atmoscripts.persisted_stages(persist_stages, CN_STAGES)
+    assert stage_format in ['full', 'diff'], "stage_format must be 'full' or 'diff'"
+
+    # The parameters that go into the output of each stage, for checkpointing.
+    # The data frames are copied, as the processing can modify them.
+    settings = {'output_filetype': cn_output_filetype,
+                'stage_format': stage_format,
+                'persist': persist if stage_format == 'diff' else None,
+                'time_zone': [NeedsTZCorrection, CurrentTZ, OutputTZ]}
+    stage_params = []
+    if QC:
+        stage_params.append(('QC', {'conc_max': CN_conc_max}))
+    if flow_cal_file is not None:
+        stage_params.append(('flowCal', {
+                'flow_cal': atmoscripts.checkpoint_file(cn_raw_path, flow_cal_file),
+                'flow_setpt': CN_flow_setpt,
+                'flow_polyDeg': CN_flow_polyDeg}))
+    elif flow_cal_df is not None:
+        stage_params.append(('flowCal', {'flow_cal': flow_cal_df.copy(),
+                                         'flow_setpt': CN_flow_setpt,
+                                         'flow_polyDeg': CN_flow_polyDeg}))
+    if mask_period_file is not None:
+        stage_params.append(('logFilt', {
+                'mask': atmoscripts.checkpoint_file(cn_raw_path, mask_period_file)}))
+    elif mask_period_timestamp_df is not None:
+        stage_params.append(('logFilt', {'mask': mask_period_timestamp_df.copy()}))
+    qc_counts = qc_counts and QC
+    stage_params.append(('resample', {'time_int': output_time_resolution,
+                                      'cascade': cascade_resample,
+                                      'cascade_exact': cascade_exact,
+                                      'qc_counts': qc_counts}))
+    checkpoints = atmoscripts.read_checkpoints(cn_output_path) if resume else {}
+
+    data = None
+
+    # The writes already queued are finished if the processing stops part
+    # way (e.g. on Ctrl-C), so the stages saved before then are checkpointed
+    try:
+        for file in raw_filelist:
+            # Find the stages already done
+            checkpoint = {'path': os.path.join(os.path.abspath(cn_output_path), file),
+                          'output_path': cn_output_path,
+                          'settings': settings,
+                          'stage_params': stage_params}
+            resumed = None
+            if resume:
+                resumed = atmoscripts.resume_checkpoint(checkpoints,
+                                                        checkpoint['path'],
+                                                        settings, stage_params)
+            done = atmoscripts.resumed_stages(resumed, stage_params)
+            if 'resample' in done:
+                print(file + ' has already been processed, skipping')
+                continue
+
+            # Load data
+            if resumed is not None:
+                print('Resuming ' + file + ' from its ' + resumed['stage'] + ' output')
+                data = load_checkpoint(resumed, cn_output_path, checkpoint['path'],
+                                       cn_output_filetype, stage_format,
+                                       persist_stages, NeedsTZCorrection,
+                                       CurrentTZ, OutputTZ)
+            else:
+                data = load_cn(fname = file)
+    #        if load_from_filetype == "csv":
+    #            data = load_cn(cn_output_path,cn_output_filetype)
+    #        else:
+    #            data = load_cn(cn_raw_path, load_from_filetype)
+
+                plot_me(data, plot_each_step,'Concentration','raw')
+            atmoscripts.report_memory(report, 'load')
+
+
+            # Correct timezone if necessary
+            if NeedsTZCorrection and resumed is None:
+                if CurrentTZ - OutputTZ != 0:
+                    if OutputTZ == 0:
+                        ToUTC = True
+                    else:
+                        ToUTC = False
+                    data = TimeZoneCorrection(data,
+                                            CurrentTZ,
+                                            ConvertToUTC = ToUTC,
+                                            OutputTZ = 0)
+
+            # The data as last saved, which the diffs are taken from
+            diff_base = None
+            if stage_format == 'diff':
+                diff_base = atmoscripts.stage_snapshot(data, CN_STAGE_COLUMNS)
+
+            # Calculate CN counting uncertainty
+            if resumed is None:
+                data = uncertainty_calc(data,
+                                            1,
+                                            np.sqrt(data['Concentration']),
+                                            sigma_dtype = np.float32 if compact else None)
+
+            # Hold the data in one block, which the stages below modify in place
+            data = atmoscripts.column_store(data)
+            atmoscripts.report_memory(report, 'uncertainty')
+
+            # QC the concentrations
+            if QC and 'QC' not in done:
+                data = DataQC(data, conc_max = CN_conc_max)
+                diff_base = save_stage(data, cn_output_path, 'QC',
+                                       cn_output_filetype, file, persist,
+                                       stage_format, diff_base, writer,
+                                       checkpoint)
+                atmoscripts.report_memory(report, 'QC')
+                plot_me(data, plot_each_step,'Concentration','QC')
+            atmoscripts.wait_for_writes(writer)
+
+            # Perform flow calibration if data is provided
+            if 'flowCal' in done:
+                pass
+            elif flow_cal_file is not None:
+                data = flow_cal(data,
+                                flow_cal_file,
+                                cn_raw_path,
+                                set_flow_rate=CN_flow_setpt,
+                                polydeg=CN_flow_polyDeg
+                                )
+                diff_base = save_stage(data, cn_output_path, 'flowCal',
+                                       cn_output_filetype, file, persist,
+                                       stage_format, diff_base, writer,
+                                       checkpoint)
+                atmoscripts.report_memory(report, 'flowCal')
+                plot_me(data, plot_each_step,'Concentration','flow cal')
+            elif flow_cal_df is not None:
+                data = flow_cal(data,
+                                measured_flows_df=flow_cal_df,
+                                set_flow_rate=CN_flow_setpt,
+                                polydeg=CN_flow_polyDeg
+                                )
+                diff_base = save_stage(data, cn_output_path, 'flowCal',
+                                       cn_output_filetype, file, persist,
+                                       stage_format, diff_base, writer,
+                                       checkpoint)
+                atmoscripts.report_memory(report, 'flowCal')
+                plot_me(data, plot_each_step,'Concentration','flow cal')
+
+            # Correct for inlet losses #xkcd
+        #    data = inlet_corrections(data, IE)
+        #    save_as(data,cn_output_data_path,'IE',cn_output_filetype)
+        #
+        #   plot_me(data, plot_each_step,'CN Number Conc', 'IE')
+
+            # The saved data is written as it is rather than copied, so each
+            # stage waits for the writes before modifying it
+            atmoscripts.wait_for_writes(writer)
+
+            # Filter for logged events
+            if 'logFilt' in done:
+                pass
+            elif mask_period_file is not None:
+                data = atmoscripts.log_filter(data,
+                                                  cn_raw_path,mask_period_file)
+                diff_base = save_stage(data, cn_output_path, 'logFilt',
+                                       cn_output_filetype, file, persist,
+                                       stage_format, diff_base, writer,
+                                       checkpoint)
+                atmoscripts.report_memory(report, 'logFilt')
+                plot_me(data, plot_each_step,'Concentration','log filter')
+            elif mask_period_timestamp_df is not None:
+                data = atmoscripts.log_filter(data,
+                                                  log_mask_df=mask_period_timestamp_df)
+                diff_base = save_stage(data, cn_output_path, 'logFilt',
+                                       cn_output_filetype, file, persist,
+                                       stage_format, diff_base, writer,
+                                       checkpoint)
+                atmoscripts.report_memory(report, 'logFilt')
+                plot_me(data, plot_each_step,'Concentration','log filter')
+
+
+            # Filter for exhaust #xkcd
+
+        #    save_as(data,cn_output_path,'exhaustfilt',cn_output_filetype, file)
+
+
+            # Resample timebase and calculate uncertainties
+            resampled = []
+            data = timebase_resampler(data,time_int=output_time_resolution,
+                                      input_h5_filename = file,
+                                      output_filetype = cn_output_filetype,
+                                      output_path = cn_output_path,
+                                      cascade = cascade_resample,
+                                      cascade_exact = cascade_exact,
+                                      qc_rules = cn_qc_rules() if qc_counts
+                                                 else None,
+                                      writer = writer,
+                                      outputs = resampled,
+                                      gui_mode=gui_mode,
+                                      gui_mainloop = gui_mainloop)
+            atmoscripts.submit_checkpoint(writer, checkpoint, 'resample',
+                                          resampled)
+
+            # Finish writing before the next file is loaded
+            atmoscripts.wait_for_writes(writer)
+            atmoscripts.report_memory(report, 'resample')
+
+            if os.path.isfile('netcdf_global_attributes.temp'):
+                os.remove('netcdf_global_attributes.temp')
+    finally:
+        atmoscripts.stop_writer(writer)
+        atmoscripts.stop_memory_report(report)
 
-    for file in raw_filelist:
-        # Load data
-        data = load_cn(fname = file)
-#        if load_from_filetype == "csv":
-#            data = load_cn(cn_output_path,cn_output_filetype)
-#        else:
-#            data = load_cn(cn_raw_path, load_from_filetype)
-
-        plot_me(data, plot_each_step,'Concentration','raw')
-
-
-        # Correct timezone if necessary
-        if NeedsTZCorrection:
-            if CurrentTZ - OutputTZ != 0:
-                if OutputTZ == 0:
-                    ToUTC = True
-                else:
-                    ToUTC = False
-                data = TimeZoneCorrection(data,
-                                        CurrentTZ,
-                                        ConvertToUTC = ToUTC,
-                                        OutputTZ = 0)
-
-        # Calculate CN counting uncertainty
-        data = uncertainty_calc(data,
-                                    1,
-                                    np.sqrt(data['Concentration']))
-
-        # Perform flow calibration if data is provided
-        if flow_cal_file is not None:
-            data = flow_cal(data,
-                            flow_cal_file,
-                            cn_raw_path,
-                            set_flow_rate=CN_flow_setpt,
-                            polydeg=CN_flow_polyDeg
-                            )
-            save_as(data,cn_output_path,'flowCal',cn_output_filetype, file)
-            plot_me(data, plot_each_step,'Concentration','flow cal')
-        elif flow_cal_df is not None:
-            data = flow_cal(data,
-                            measured_flows_df=flow_cal_df,
-                            set_flow_rate=CN_flow_setpt,
-                            polydeg=CN_flow_polyDeg
-                            )
-            save_as(data,cn_output_path,'flowCal',cn_output_filetype, file)
-            plot_me(data, plot_each_step,'Concentration','flow cal')
-
-        # Correct for inlet losses #xkcd
-    #    data = inlet_corrections(data, IE)
-    #    save_as(data,cn_output_data_path,'IE',cn_output_filetype)
-    #
-    #   plot_me(data, plot_each_step,'CN Number Conc', 'IE')
-
-        # Filter for logged events
-        if mask_period_file is not None:
-            data = atmoscripts.log_filter(data,
-                                              cn_raw_path,mask_period_file)
-            save_as(data,cn_output_path,'logFilt',cn_output_filetype, file)
-            plot_me(data, plot_each_step,'Concentration','log filter')
-        elif mask_period_timestamp_df is not None:
-            data = atmoscripts.log_filter(data,
-                                              log_mask_df=mask_period_timestamp_df)
-            save_as(data,cn_output_path,'logFilt',cn_output_filetype, file)
-            plot_me(data, plot_each_step,'Concentration','log filter')
-
-
-        # Filter for exhaust #xkcd
-
-    #    save_as(data,cn_output_path,'exhaustfilt',cn_output_filetype, file)
-
-
-        # Resample timebase and calculate uncertainties
-        data = timebase_resampler(data,time_int=output_time_resolution,
-                                  input_h5_filename = file,
-                                  output_filetype = cn_output_filetype,
-                                  output_path = cn_output_path,
-                                  gui_mode=gui_mode,
-                                  gui_mainloop = gui_mainloop)
-
-        if os.path.isfile('netcdf_global_attributes.temp'):
-            os.remove('netcdf_global_attributes.temp')
     return data
 
+def follow_cn(cn_raw_path,
+              cn_output_path = None,
+              cn_output_filetype = 'hdf',
+              filename_base = 'CN',
+              poll_interval = 5,
+              from_start = False,
+              output_time_resolution = 'default',
+              InputTZ = 0,
+              OutputTZ = 0,
+              QC = False,
+              CN_conc_max = 1e4,
+              qc_counts = False,
+              mask_period_file = None,
+              mask_period_timestamp_df = None,
+              flow_cal_file = None,
+              flow_cal_df = None,
+              CN_flow_setpt = 1000,
+              CN_flow_polyDeg = 2,
+              compact = False,
+              max_polls = None
+              ):
+    '''
+    Real-time mode: follows the row based csv files being exported by AIM in
+    cn_raw_path, and every poll_interval seconds pushes the samples appended
+    since the last poll through the processing of LoadAndProcess. Only the
+    new part of each file is read, so the cost of a poll depends on the new
+    data rather than the size of the files. Runs until interrupted (Ctrl-C),
+    or for max_polls polls if it's given. AIM writes each sample when it
+    finishes, so the data is only as up to date as the last complete sample.
+
+    The output of each step is appended to files named as in
+    atmoscripts.live_output_filename (e.g. CN_live_raw_flowCal.h5), and the
+    periods of each time resampling interval are appended as soon as they
+    are complete. The output filetype must be hdf, h5, csv or parquet.
+
+    Files which exist when following starts are read from their current end,
+    unless from_start is True, while files created later are read from the
+    start. The offset reached in each file is kept in the output path, so
+    following can be stopped and started again without losing data. The
+    offsets are saved after the output of each poll, so rows may be repeated
+    in the output if it's stopped while writing.
+
+    The mask period file is checked for changes on each poll. If compact is
+    True, the concentrations are read as float32 (see expand_cpc_samples).
+    QC, CN_conc_max and qc_counts are as for LoadAndProcess.
+    '''
+    if cn_output_path is None:
+        cn_output_path = cn_raw_path
+    qc_counts = qc_counts and QC
+    qc_rules = cn_qc_rules() if qc_counts else None
+    cn_raw_path = os.path.abspath(cn_raw_path)
+    cn_output_path = os.path.abspath(cn_output_path)
+
+    time_int = [t for t in get_time_intervals(output_time_resolution)
+                if t != '1S']
+    for time in time_int:
+        assert pd.Timedelta('1D') % pd.Timedelta(time) == pd.Timedelta(0), \
+            'Time resampling intervals must divide a day evenly when following files'
+
+    if flow_cal_file is not None:
+        flow_cal_df = load_flow_cals(flow_cal_file, cn_raw_path)
+    if mask_period_timestamp_df is not None:
+        mask_period_timestamp_df = atmoscripts.merge_mask_periods(mask_period_timestamp_df)
+
+    # The last processing step, which is resampled
+    if (mask_period_file is not None) or (mask_period_timestamp_df is not None):
+        last_stage = 'logFilt'
+    elif flow_cal_df is not None:
+        last_stage = 'flowCal'
+    elif QC:
+        last_stage = 'QC'
+    else:
+        last_stage = 'raw'
+
+    # Offset reached in each raw file, compacted to one record per file
+    state_file = os.path.join(cn_output_path,
+                              filename_base + '_' + atmoscripts.TAIL_STATE)
+    tail = atmoscripts.read_manifest(state_file, legacy_filename=None)
+    if len(tail) > 0:
+        atmoscripts.write_manifest(tail.values(), state_file + '.tmp')
+        os.replace(state_file + '.tmp', state_file)
+
+    # Files to read from their end
+    if from_start:
+        skip_existing = set()
+    else:
+        skip_existing = set(_cpc_raw_files(cn_raw_path)).difference(tail)
+
+    # Pick up the periods which were still incomplete in the last run
+    resample_carry = {}
+    written = {}
+    ends = [pd.Timestamp(r['end']) for r in tail.values() if r['end'] is not None]
+    last_time = max(ends) if len(ends) > 0 else None
+    if last_time is not None:
+        saved = atmoscripts.read_live_output(cn_output_path, filename_base,
+                                             'CPC', last_stage,
+                                             cn_output_filetype,
+                                             start=last_time.floor('1D'))
+        if (saved is not None) and (len(saved) > 0):
+            if 'cn_sigma' not in saved:
+                saved = uncertainty_calc(saved, 1, np.sqrt(saved['Concentration']),
+                                         sigma_dtype = np.float32 if compact else None)
+            for time in time_int:
+                held = saved[saved.index >= last_time.floor(time)]
+                if len(held) > 0:
+                    resample_carry[time] = held
+
+    print('Following CPC files in ' + cn_raw_path)
+    npolls = 0
+    try:
+        while (max_polls is None) or (npolls < max_polls):
+            poll_start = systime.time()
+            npolls = npolls + 1
+
+            frames, updated = _read_new_cpc_rows(cn_raw_path, tail,
+                                                 skip_existing,
+                                                 InputTZ, OutputTZ, compact)
+            skip_existing = set()
+            data = None
+            if len(frames) > 0:
+                data = atmoscripts.merge_timestamped(frames)
+                if last_time is not None:
+                    data = data[data.index > last_time]
+
+            if (data is not None) and (len(data) > 0):
+                print('Processing ' + str(len(data)) + ' new rows up to ' +
+                      str(data.index[-1]))
+                last_time = data.index[-1]
+                atmoscripts.append_live_output(data, cn_output_path,
+                                               filename_base, 'CPC', 'raw',
+                                               cn_output_filetype, written)
+
+                # Calculate CN counting uncertainty
+                data = uncertainty_calc(data, 1, np.sqrt(data['Concentration']),
+                                        sigma_dtype = np.float32 if compact else None)
+
+                # QC the concentrations
+                if QC:
+                    data = DataQC(data, conc_max = CN_conc_max)
+                    atmoscripts.append_live_output(data, cn_output_path,
+                                                   filename_base, 'CPC', 'QC',
+                                                   cn_output_filetype, written)
+
+                # Perform flow calibration if data is provided
+                if flow_cal_df is not None:
+                    data = flow_cal(data,
+                                    measured_flows_df=flow_cal_df,
+                                    set_flow_rate=CN_flow_setpt,
+                                    polydeg=CN_flow_polyDeg)
+                    atmoscripts.append_live_output(data, cn_output_path,
+                                                   filename_base, 'CPC', 'flowCal',
+                                                   cn_output_filetype, written)
+
+                # Filter for logged events
+                if mask_period_file is not None:
+                    data = atmoscripts.log_filter(data, cn_raw_path,
+                                                  mask_period_file)
+                elif mask_period_timestamp_df is not None:
+                    data = atmoscripts.log_filter(data,
+                                                  log_mask_df=mask_period_timestamp_df)
+                if last_stage == 'logFilt':
+                    atmoscripts.append_live_output(data, cn_output_path,
+                                                   filename_base, 'CPC', 'logFilt',
+                                                   cn_output_filetype, written)
+
+                # Resample the periods which are complete
+                for time in time_int:
+                    data_resamp = _resample_chunk(data, time, resample_carry,
+                                                  qc_rules)
+                    atmoscripts.append_live_output(data_resamp, cn_output_path,
+                                                   filename_base, 'CPC', time,
+                                                   cn_output_filetype, written)
+
+            # Save the offsets once the output is written
+            if len(updated) > 0:
+                atmoscripts.write_manifest(updated, state_file)
+
+            if (max_polls is None) or (npolls < max_polls):
+                systime.sleep(max(0, poll_interval - (systime.time() - poll_start)))
+    except KeyboardInterrupt:
+        print('Stopped following CPC files')
+
+    return
+
+def _cpc_raw_files(cn_raw_path):
+    '''
+    Returns the absolute paths of the csv files in cn_raw_path which may be
+    AIM exports
+    '''
+    return [os.path.abspath(f)
+            for f in sorted(glob.glob(os.path.join(cn_raw_path, '*.csv')))
+            if not f.endswith('_reformatted.csv')]
+
+def _read_new_cpc_rows(cn_raw_path, tail, skip_existing, InputTZ=0, OutputTZ=0,
+                       compact=False):
+    '''
+    Reads the samples appended to the AIM exports since the offsets in tail,
+    a dict of records keyed by file (see follow_cn). Returns the data from
+    each file and the records which have changed, which are updated in tail.
+    Files in skip_existing are read from their current end.
+    '''
+    frames = []
+    updated = []
+    for path in _cpc_raw_files(cn_raw_path):
+        record = tail.get(path)
+        if (record is None) or (os.path.getsize(path) < record['offset']):
+            # A new file, or one which has been replaced
+            record = _cpc_tail_record(path, path in skip_existing)
+            if record is None:
+                continue
+            tail[path] = record
+            updated.append(record)
+
+        offset = record['offset']
+        text = atmoscripts.read_new_lines(path, record)
+        if record['offset'] == offset:
+            continue
+        if record not in updated:
+            updated.append(record)
+
+        data = _parse_cpc_rows(text, record['columns'], compact)
+        if (data is None) or (len(data) == 0):
+            continue
+        if InputTZ-OutputTZ != 0:
+            data = TimeZoneCorrection(data, CurrentTZ = InputTZ, OutputTZ = OutputTZ)
+        frames.append(data)
+        record['end'] = str(data.index.max())
+    return frames, updated
+
+def _cpc_tail_record(path, skip_existing=False, header_lines=10):
+    '''
+    Returns the record used by follow_cn to follow an AIM export, holding the
+    names of the sample columns from its header and starting after the
+    header, or at the end of the file if skip_existing. Returns None if the
+    file isn't an AIM export or its header hasn't been written yet.
+    '''
+    with open(path, 'rb') as f:
+        first = f.readline().decode('utf-8', errors='replace')
+        if not first.startswith('Sample File'):
+            return None
+        for i in range(header_lines):
+            line = f.readline().decode('utf-8', errors='replace')
+            if not line.endswith('\n'):
+                return None
+            if line.split(',')[0] == 'Sample #':
+                break
+        else:
+            return None
+        header_end = f.tell()
+
+    # The names of the sample columns before the concentrations
+    columns = [col.strip() for col in line.split(',')[:12]]
+    if ('Start Date' not in columns) or ('Start Time' not in columns):
+        return None
+
+    record = {'path': path,
+              'columns': columns,
+              'offset': header_end,
+              'end': None}
+    if skip_existing:
+        record['offset'] = max(header_end, atmoscripts.tail_end_offset(path))
+    return record
+
+def _parse_cpc_rows(text, columns, compact=False):
+    '''
+    Parses lines of a row based AIM export, returning the concentrations
+    indexed by timestamp as read_cpc_chunks does. columns are the names of
+    the columns before the concentrations. Lines which aren't samples, such
+    as the header which AIM repeats before each sample, are skipped.
+    '''
+    lines = []
+    for line in text.splitlines():
+        try:
+            int(line.split(',')[0])
+        except ValueError:
+            continue
+        lines.append(line)
+    if len(lines) == 0:
+        return None
+
+    # Samples can differ in length, so read enough columns for the longest
+    width = max(line.count(',') for line in lines) + 1
+    chunk = pd.read_csv(io.StringIO('\n'.join(lines)), header=None,
+                        names=range(width), skipinitialspace=True)
+    chunk = chunk.rename(columns=dict(enumerate(columns)))
+    chunk['sample_timestamp'] = pd.to_datetime(chunk['Start Date']+' '+chunk['Start Time'], format = '%m/%d/%y %H:%M:%S')
+
+    return expand_cpc_samples(chunk, compact)
+
 def plot_me(data, plot_each_step, var=None, title = ''):
     if plot_each_step:
         if var is None:
@@ -933,9 +1730,25 @@ def get_raw_filelist(cn_output_path, output_filetype, substring='raw'):
     os.chdir(cn_output_path)
     flist = glob.glob('*.'+output_filetype)
     raw_filelist = [f for f in flist if substring in f]
+
+    raw_filelist = [check_file(f) for f in raw_filelist]
+    raw_filelist = [f for f in raw_filelist if f is not None]
+
     raw_filelist.sort()
     return raw_filelist
 
+def check_file(fname):
+    '''
+    Returns fname if it's a concatenated raw file (e.g. CN_raw.h5,
+    CN_raw_20170323.h5 or CN_raw_2017_wk12.h5), or None if it's the output of
+    a processing stage made from one (e.g. CN_raw_20170323_flowCal.h5)
+    '''
+    base = os.path.basename(fname).split('.')[0]
+    if re.search('_raw(_[0-9]+(_wk[0-9]+)?)?$', base) and \
+       not base.endswith('_live_raw'):
+        return fname
+    return None
+
 def load_data_to_file(
                       cn_raw_path = None,
                       cn_output_path = None,
@@ -946,14 +1759,16 @@ def load_data_to_file(
                       concat_file_frequency = 'all',
                       InputTZ = 0,
                       OutputTZ = 0,
+                      workers = None,
+                      compact = False,
                       gui_mode = True,
                       gui_mainloop = None
                       ):
 
-    assert cn_output_filetype in ['hdf','h5','netcdf','nc','csv'], "Don't \
-        recognise filetype to save to. Please use hdf, h5, netcdf or csv"
+    assert cn_output_filetype in ['hdf','h5','netcdf','nc','csv','parquet'], "Don't \
+        recognise filetype to save to. Please use hdf, h5, netcdf, csv or parquet"
 
-    if cn_output_filetype in ['hdf','h5']:
+    if cn_output_filetype in ['hdf','h5','parquet']:
         filelist_empty = check_filelist('.h5', force_reload_from_source,input_filelist)
         if filelist_empty:
             Load_to_HDF(input_path = cn_raw_path,
@@ -962,7 +1777,9 @@ def load_data_to_file(
                         output_file_frequency = concat_file_frequency,
                         input_filelist=input_filelist,
                         InputTZ = InputTZ, OutputTZ = OutputTZ,
-                        force_reload_from_source = force_reload_from_source
+                        force_reload_from_source = force_reload_from_source,
+                        workers = workers,
+                        compact = compact
                         )
 
     elif cn_output_filetype in ['netcdf','nc','csv']:
@@ -976,6 +1793,8 @@ def load_data_to_file(
                         InputTZ = InputTZ, OutputTZ = OutputTZ,
                         force_reload_from_source = force_reload_from_source,
                         output_file_format = cn_output_filetype,
+                        workers = workers,
+                        compact = compact,
                         gui_mode = gui_mode,
                         gui_mainloop = gui_mainloop
                         )
@@ -1009,7 +1828,8 @@ def save_as(data,
             save_path,
             filename_appendage = '',
             filetype='hdf',
-            fname_current = None
+            fname_current = None,
+            writer = None
             ):
     '''
     Saves data to file, reading the original filename, and appending informative
@@ -1017,19 +1837,27 @@ def save_as(data,
     For example
     CN.h5 becomes CN_QC.h5
     CN.nc becomes CN_QC_flowcal.nc
+    With parquet, the data is saved to the dataset in save_path as the
+    processing stage filename_appendage.
+    If writer is given (see atmoscripts.start_writer), the data is queued to
+    be written in the background rather than copied, so it mustn't be
+    modified until atmoscripts.wait_for_writes has been called.
+    Returns the name of the file, or the path of the parquet stage, that the
+    data is saved to.
     '''
-    assert filetype in ['hdf','h5','netcdf','nc','csv'], "Don't recognise \
-                        filetype to save to. Please use hdf, h5, netcdf or csv"
+    assert filetype in ['hdf','h5','netcdf','nc','csv','parquet'], "Don't recognise \
+                        filetype to save to. Please use hdf, h5, netcdf, csv or parquet"
     assert save_path is not None, 'You must specify the directory where you \
                         want to save!'
     os.chdir(save_path)
 
-
     if filetype in ['hdf','h5']:
-        fname = get_filenamebase('h5', filename_appendage, fname_current)
+        fname = get_filenamebase('h5', filename_appendage, fname_current,
+                                 atmoscripts.queued_files(writer, 'h5'))
 
         # Save data to file
-        data.to_hdf(fname, key='cn')
+        atmoscripts.submit_write(writer, fname, data.to_hdf,
+                                 os.path.abspath(fname), key='cn')
 
     elif filetype in ['netcdf','nc']:
         # Get the filename of the most recently created file
@@ -1039,20 +1867,157 @@ def save_as(data,
         # xkcd
 
     elif filetype == 'csv':
-        fname = get_filenamebase('csv', filename_appendage, fname_current)
+        fname = get_filenamebase('csv', filename_appendage, fname_current,
+                                 atmoscripts.queued_files(writer, 'csv'))
 
         # Save data to file
-        data.to_csv(fname)
+        atmoscripts.submit_write(writer, fname, data.to_csv,
+                                 os.path.abspath(fname))
 
-    return
+    elif filetype == 'parquet':
+        atmoscripts.submit_write(writer, None, atmoscripts.df_to_parquet,
+                                 data, os.getcwd(), 'CPC', filename_appendage)
+        fname = atmoscripts.parquet_stage_path(os.getcwd(), 'CPC',
+                                               filename_appendage)
+
+    return fname
+
+def save_stage(data, save_path, stage, filetype, fname_current, persist,
+               stage_format = 'full', diff_base = None, writer = None,
+               checkpoint = None):
+    '''
+    Saves the output of a processing stage of LoadAndProcess if the stage is
+    in persist. With stage_format 'full' the data is saved by save_as, and
+    with 'diff' only its changes from diff_base, a snapshot of the data as
+    it was last saved or loaded (see atmoscripts.stage_snapshot), are saved
+    by save_stage_diff. Returns the snapshot to take the next diff from.
+    If checkpoint is given, the stage is recorded as completed once it has
+    been saved (see atmoscripts.submit_checkpoint).
+    '''
+    output = None
+    if stage in persist and stage_format == 'diff':
+        output = save_stage_diff(atmoscripts.stage_diff(diff_base, data),
+                                 save_path, stage, filetype, fname_current,
+                                 writer)
+        diff_base = atmoscripts.stage_snapshot(data, CN_STAGE_COLUMNS)
+    elif stage in persist:
+        output = save_as(data, save_path, stage, filetype, fname_current,
+                         writer = writer)
+    atmoscripts.submit_checkpoint(writer, checkpoint, stage, output, data)
+    return diff_base
+
+def stage_diff_filename(fname_current, stage, ext):
+    '''
+    Returns the name of the file holding the diff of a processing stage of
+    the concatenated raw file fname_current, e.g. CN_raw_flowCal_diff.h5
+    '''
+    base = os.path.basename(fname_current).split('.')[0]
+    return base + '_' + stage + '_diff.' + ext
+
+def save_stage_diff(diff, save_path, stage, filetype, fname_current,
+                    writer = None):
+    '''
+    Saves the diff of a processing stage (see atmoscripts.stage_diff) to the
+    file named by stage_diff_filename, or to a parquet dataset as the stage
+    <stage>_diff. As with save_as, nothing is saved for netcdf. Returns the
+    name of the file, or the path of the parquet stage, saved to.
+    '''
+    os.chdir(save_path)
+    fname = None
+    if filetype == 'parquet':
+        atmoscripts.submit_write(writer, None, atmoscripts.df_to_parquet,
+                                 diff, os.getcwd(), 'CPC', stage + '_diff')
+        fname = atmoscripts.parquet_stage_path(os.getcwd(), 'CPC',
+                                               stage + '_diff')
+    elif filetype in ['hdf','h5']:
+        fname = os.path.abspath(stage_diff_filename(fname_current, stage, 'h5'))
+        atmoscripts.submit_write(writer, None, diff.to_hdf, fname, key='cn')
+    elif filetype == 'csv':
+        fname = os.path.abspath(stage_diff_filename(fname_current, stage, 'csv'))
+        atmoscripts.submit_write(writer, None, diff.to_csv, fname)
+    return fname
+
+def load_stage(data_path, stage, fname, filetype = 'h5',
+               persist_stages = 'all',
+               NeedsTZCorrection = False, CurrentTZ = 0, OutputTZ = 0,
+               stages = None):
+    '''
+    Rebuilds the output of a processing stage which LoadAndProcess saved with
+    stage_format='diff', from the concatenated raw file fname in data_path
+    and the diffs of the stages saved up to it. persist_stages and the time
+    zone settings must be as they were for LoadAndProcess.
+    Only the diffs of the stages which were run are applied. These are given
+    by stages, or by default are those recorded in the checkpoint of the
+    stage in data_path (see atmoscripts.submit_checkpoint).
+    '''
+    persist = atmoscripts.persisted_stages(persist_stages, CN_STAGES)
+    assert stage in persist, stage + " wasn't saved"
+    if stages is None:
+        record = atmoscripts.read_checkpoints(data_path).get(
+                (os.path.abspath(os.path.join(data_path, fname)), stage))
+        assert record is not None and 'stages' in record, \
+            "No checkpoint of the stages run for " + fname
+        stages = record['stages']
+
+    os.chdir(data_path)
+    data = load_cn(fname = fname)
+    if NeedsTZCorrection and (CurrentTZ - OutputTZ != 0):
+        data = TimeZoneCorrection(data,
+                                  CurrentTZ,
+                                  ConvertToUTC = (OutputTZ == 0),
+                                  OutputTZ = 0)
+    # Held as LoadAndProcess holds the data, so the columns match
+    data = atmoscripts.column_store(data)
+
+    for s in persist[:persist.index(stage)+1]:
+        if s not in stages:
+            continue
+        if filetype == 'parquet':
+            diff = atmoscripts.read_parquet(data_path, 'CPC', s + '_diff',
+                                            start = data.index.min(),
+                                            end = data.index.max() + pd.Timedelta(1, 'us'))
+        elif filetype in ['hdf','h5']:
+            diff = pd.read_hdf(stage_diff_filename(fname, s, 'h5'), key='cn')
+        else:
+            diff = pd.read_csv(stage_diff_filename(fname, s, 'csv'),
+                               index_col=0, parse_dates=True)
+        data = atmoscripts.apply_stage_diff(data, diff)
+    return data
 
-def get_filenamebase(ext, appendage, fname_current=None):
+def load_checkpoint(record, data_path, fname, filetype = 'h5',
+                    stage_format = 'full', persist_stages = 'all',
+                    NeedsTZCorrection = False, CurrentTZ = 0, OutputTZ = 0):
+    '''
+    Loads the output of the stage of a checkpoint record (see
+    atmoscripts.resume_checkpoint) of the concatenated raw file fname, so
+    that LoadAndProcess can carry on from it.
+    '''
+    if stage_format == 'diff':
+        return load_stage(data_path, record['stage'], fname, filetype,
+                          persist_stages, NeedsTZCorrection, CurrentTZ,
+                          OutputTZ, record.get('stages'))
+    if filetype == 'parquet':
+        return load_cn(data_path, filetype, stage = record['stage'],
+                       start = record['start'],
+                       end = pd.Timestamp(record['end']) + pd.Timedelta(1, 'us'))
+    return load_cn(fname = record['output'])
+
+def get_filenamebase(ext, appendage, fname_current=None, queued=None):
     '''
     Get's the filename of the most recently created file and produces the new
     filename
+
+    queued is a list of files queued to be written in the background (see
+    atmoscripts.queued_files), which count as the most recently created in
+    the order they were queued.
     '''
 
     filelist = glob.glob('*.'+ ext)
+    if queued is None:
+        queued = []
+    queued = [os.path.basename(f) for f in queued
+              if os.path.dirname(f) == os.getcwd()]
+    filelist = filelist + [f for f in queued if f not in filelist]
 
     if len(filelist) == 0:
         return 'CN_unknown' + appendage + '.' + ext
@@ -1061,11 +2026,11 @@ def get_filenamebase(ext, appendage, fname_current=None):
             # Get the most recent version of the current file
             fname_current_base = fname_current.split('.')[0]
             fname_current_list = [f for f in filelist if fname_current_base in f]
-            fname_old = max(fname_current_list,key=os.path.getctime)
+            fname_old = _newest_file(fname_current_list, queued)
             fname_old = fname_old.split('.')
         else:
             # Get the filename of the most recently created file
-            fname_old = max(filelist, key=os.path.getctime).split('.')
+            fname_old = _newest_file(filelist, queued).split('.')
 
         # if the version of the file is already there, overwrite
         if appendage in fname_old[0]:
@@ -1073,6 +2038,16 @@ def get_filenamebase(ext, appendage, fname_current=None):
         else:
             return fname_old[0] + '_' + appendage + '.' + fname_old[1]
 
+def _newest_file(filelist, queued):
+    '''
+    Returns the most recently created file in filelist, where files still
+    queued to be written are newer than any on disk
+    '''
+    in_queue = [f for f in queued if f in filelist]
+    if len(in_queue) > 0:
+        return in_queue[-1]
+    return max(filelist, key=os.path.getctime)
+
 #==============================================================================
 # def resample_timebase(data=0,RawDataPath='',input_h5_filename='',variable='CN',time_int='default'):
 #     ### Time resampling
@@ -1131,11 +2106,29 @@ def timebase_resampler(
                       time_int='default',
                       output_filetype = 'h5',
                       output_path = None,
+                      cascade = False,
+                      cascade_exact = None,
+                      qc_rules = None,
+                      writer = None,
+                      outputs = None,
                       gui_mode=False,
                       gui_mainloop = None
                       ):
     '''
     Time resampling
+
+    If cascade is True, the statistics of the shortest interval are merged
+    into the longer intervals rather than each interval being calculated
+    from the data, with the median and MAD estimated from a sketch of the
+    distribution (see atmoscripts.cascade_resampler), except for the
+    intervals in cascade_exact (or all of them if it's True).
+
+    If qc_rules is given, the rows failing each QC rule in each period are
+    counted from the QC flags of the data (see resample_interval).
+
+    If writer is given, the resampled data is written in the background (see
+    atmoscripts.start_writer). If outputs is given, the files (or parquet
+    stages) the resampled data is saved to are appended to it.
     '''
     #if no data provided, try to load from file
     if not isinstance(data, pd.DataFrame):
@@ -1149,6 +2142,41 @@ def timebase_resampler(
             return
 
 
+    time_int = get_time_intervals(time_int)
+
+    resampler = atmoscripts.resample_stats
+    if cascade and [time for time in time_int if time != '1S']:
+        resampler = atmoscripts.cascade_resampler(data,
+                                                  [time for time in time_int
+                                                   if time != '1S'],
+                                                  exact = cascade_exact)
+
+    for time in time_int:
+        if time != '1S':
+            data_resamp = resample_interval(data, time, resampler, qc_rules)
+
+            # Save to file
+            fname = save_resampled_data(data,data_resamp,time,
+                                        variable,input_h5_filename,
+                                        output_filetype,
+                                        output_path,
+                                        gui_mode=gui_mode,
+                                        gui_mainloop = gui_mainloop,
+                                        writer = writer)
+            if outputs is not None:
+                outputs.append(fname)
+
+    try:
+
+        return data_resamp
+    except:
+        return data
+
+def get_time_intervals(time_int='default'):
+    '''
+    Interprets the time_int input of timebase_resampler, returning a list of
+    the time resampling intervals
+    '''
     # define time resampling intervals unless specified in function input
     if time_int == 'default':
         time_int = ['5S','1Min', '5Min', '10Min', \
@@ -1161,77 +2189,87 @@ def timebase_resampler(
         time_int = list(compress(gui_time_options, time_int))
     elif type(time_int) == str:
         time_int = [time_int]
+    return time_int
 
-    # define MAD calculation
-    mad = lambda x: np.fabs(x - x.median()).median()
-
-    # define square root of the sum of squares calculation (root mean square numerator)
-    rmsn = lambda x: np.sqrt(np.sum(x**2))
+def resample_interval(data, time, resampler=None, qc_rules=None):
+    '''
+    Resamples the data to a single time interval, returning the median, MAD,
+    mean, standard deviation and count of each column, and the uncertainty of
+    the median and mean concentration. resampler is
+    atmoscripts.resample_stats unless given (see timebase_resampler).
+    The QC flags aren't resampled, but if qc_rules is given (see
+    cn_qc_rules), a qc_<rule> column counting the rows which failed each
+    rule is added (see atmoscripts.qc_flag_counts).
+    '''
+    if resampler is None:
+        resampler = atmoscripts.resample_stats
 
-    for time in time_int:
-        if time != '1S':
-            data_temp = data.resample(time,fill_method=None).apply(rmsn)
-            if 'cn_sigma' in data_temp:
-                data_resamp = pd.DataFrame(data_temp['cn_sigma'])
-                data_resamp.columns = ['cn_rmsn']
-            else:
-                data_resamp['cn_rmsn'] = 0 # if no processing has been done previously
-            del data_temp
-            for column in data.columns:
-                if column != 'cn_sigma':
-                    sub_cn = pd.DataFrame(data[column].copy())
-                    if column == 'Concentration':
-                        prefix = 'cn'
-                    else:
-                        prefix = column
-                    data_resamp[prefix+'_med'] = \
-                        sub_cn.resample(time,fill_method=None).median()
-                    data_resamp[prefix+'_mad'] = \
-                        sub_cn.resample(time,fill_method=None).apply(mad)
-                    data_resamp[prefix+'_avg'] = \
-                        sub_cn.resample(time,fill_method=None).mean()
-                    data_resamp[prefix+'_std'] = \
-                        sub_cn.resample(time,fill_method=None).std()
-                    data_resamp[prefix+'_count'] = \
-                        sub_cn.resample(time,fill_method=None).count()
-
-
-            # Calculate uncertainty:
-            data_resamp = uncertainty_calc_time_resample(
-                                        data_resamp,
-                                        'rmsn',
-                                        'cn_count',
-                                        'mad',
-                                        col_name = 'cn_med',
-                                        output_sigma_name='sigma_med'
-                                                    )
-            data_resamp = uncertainty_calc_time_resample(
-                                        data_resamp,
-                                        'rmsn',
-                                        'cn_count',
-                                        'std',
-                                        col_name = 'cn_avg',
-                                        output_sigma_name='sigma_avg'
-                                                    )
-
-            # Reorder columns based on name:
-            data_resamp.sort_index(axis=1)
-
-            # Remove temporary calculation
-            del data_resamp['cn_rmsn']
-            # Save to file
-            save_resampled_data(data,data_resamp,time,
-                                variable,input_h5_filename,
-                                output_filetype,
-                                output_path,
-                                gui_mode=gui_mode,
-                                gui_mainloop = gui_mainloop)
+    if 'cn_sigma' in data:
+        data_resamp = resampler(data[['cn_sigma']],
+                                time, ['rmsn'], ['cn'])
+    else:
+        data_resamp = resampler(data, time, [])
+        data_resamp['cn_rmsn'] = 0 # if no processing has been done previously
+
+    # Median, MAD, mean, std and count of each column
+    columns = [col for col in data.columns
+               if col not in ['cn_sigma', atmoscripts.QC_FLAG_COLUMN]]
+    prefixes = ['cn' if col == 'Concentration' else col
+                for col in columns]
+    data_resamp = pd.concat([data_resamp,
+                             resampler(data[columns], time,
+                                       names=prefixes)],
+                            axis=1)
+
+
+    # Calculate uncertainty:
+    data_resamp = uncertainty_calc_time_resample(
+                                data_resamp,
+                                'rmsn',
+                                'cn_count',
+                                'mad',
+                                col_name = 'cn_med',
+                                output_sigma_name='sigma_med'
+                                            )
+    data_resamp = uncertainty_calc_time_resample(
+                                data_resamp,
+                                'rmsn',
+                                'cn_count',
+                                'std',
+                                col_name = 'cn_avg',
+                                output_sigma_name='sigma_avg'
+                                            )
+
+    # Reorder columns based on name:
+    data_resamp.sort_index(axis=1)
+
+    # Remove temporary calculation
+    del data_resamp['cn_rmsn']
+
+    if qc_rules is not None and atmoscripts.QC_FLAG_COLUMN in data.columns:
+        # Rows failing each QC rule
+        counts = atmoscripts.qc_flag_counts(data[atmoscripts.QC_FLAG_COLUMN].values,
+                                            data.index, qc_rules, time)
+        data_resamp = pd.concat([data_resamp,
+                                 counts.reindex(data_resamp.index)], axis=1)
+    return data_resamp
+
+def _resample_chunk(data, time, carry, qc_rules = None):
+    '''
+    Resamples a chunk of data to a single time interval for follow_cn. The
+    rows of the last period may continue into the next chunk, so they are
+    held back in carry and resampled along with the next chunk. qc_rules are
+    passed to resample_interval.
+    '''
+    held = carry.pop(time, None)
+    if held is not None:
+        data = pd.concat([held, data])
 
-    try:
+    data_resamp = resample_interval(data, time, qc_rules = qc_rules)
 
-        return data_resamp
-    except:
-        return data
+    # Hold back the last period, which may not be complete
+    carry[time] = data[data.index >= data_resamp.index[-1]]
+    return data_resamp.iloc[:-1]
 
 def uncertainty_calc_time_resample(data,
                      abs_sigma,
@@ -1241,8 +2279,8 @@ def uncertainty_calc_time_resample(data,
                      output_sigma_name = 'cn_sigma'
                      ):
     '''
-    Propagates measurement uncertainty and adds statistical uncertainty:
-
+    Propagates measurement uncertainty and adds statistical uncertainty (see
+    atmoscripts.resample_sigma)
     '''
     # Find the rmsn column
     rmsn_cols = [col for col in data.columns if abs_sigma in col]
@@ -1261,11 +2299,9 @@ def uncertainty_calc_time_resample(data,
 
     for i in range(0, len(ss_root_names)):
         data[ss_root_names[i]+"_"+output_sigma_name] = \
-                    np.sqrt(
-                            (data[rmsn_cols[i]]/data[count_cols[i]])**2
-                            +
-                            (data[dev_cols[i]]/np.sqrt(data[count_cols[i]]))**2
-                            )
+                    atmoscripts.resample_sigma(data[rmsn_cols[i]],
+                                               data[count_cols[i]],
+                                               data[dev_cols[i]])
 
     return data
 
@@ -1274,21 +2310,29 @@ def uncertainty_calc(data,
                  abs_sigma,
                  sigma_divisor,
                  col_name = 'Concentration',
-                 output_sigma_name = 'cn_sigma'
+                 output_sigma_name = 'cn_sigma',
+                 sigma_dtype = None
                  ):
     '''
-    Calculates and propogates uncertainty for each calibration process
+    Calculates and propogates uncertainty for each calibration process (see
+    atmoscripts.propagate_sigma).
+    When the uncertainty is first calculated, the column is made with
+    sigma_dtype if it's given, e.g. float32 to halve its size along with
+    compact raw data. Later terms are calculated in float64 and stored at
+    the precision of the column.
     '''
     if 'cn_sigma' in data.columns:
-        data[output_sigma_name] = data[col_name] * \
-                            (
-                            (abs_sigma/sigma_divisor)**2
-                            +
-                            (data['cn_sigma']/data[col_name])**2
-                            )**0.5
+        atmoscripts.set_column(data, output_sigma_name,
+                            atmoscripts.propagate_sigma(data[col_name],
+                                                        abs_sigma,
+                                                        sigma_divisor,
+                                                        data['cn_sigma']))
     else: #Initialise
-        data['cn_sigma'] = data['Concentration'] * \
-                            ((abs_sigma/sigma_divisor)**2)**0.5
+        sigma = atmoscripts.propagate_sigma(data['Concentration'],
+                                            abs_sigma, sigma_divisor)
+        if sigma_dtype is not None:
+            sigma = sigma.astype(sigma_dtype)
+        data['cn_sigma'] = sigma
 
     return data
 
@@ -1298,7 +2342,12 @@ def save_resampled_data(data, data_resamp,time_int,
                         output_filetype = 'h5',
                         output_path = None,
                         gui_mode=False,
-                        gui_mainloop = None):
+                        gui_mainloop = None,
+                        writer = None):
+    '''
+    Saves the data resampled to time_int, returning the name of the file, or
+    the path of the parquet stage, that it's saved to.
+    '''
     if output_path is not None:
         os.chdir(output_path)
     if input_h5_filename is not None:
@@ -1310,16 +2359,25 @@ def save_resampled_data(data, data_resamp,time_int,
         outputfilename = 'undefinedData_'+ time_int +'.'+output_filetype
 
     if output_filetype in ['h5','hdf']:
-        data_resamp.to_hdf(outputfilename, key=variable)
+        atmoscripts.submit_write(writer, outputfilename, data_resamp.to_hdf,
+                                 os.path.abspath(outputfilename), key=variable)
+    elif output_filetype == 'parquet':
+        # Saved to the dataset in the current directory, with the time
+        # interval as the processing stage
+        atmoscripts.submit_write(writer, None, atmoscripts.df_to_parquet,
+                                 data_resamp, os.getcwd(), 'CPC', time_int)
+        return atmoscripts.parquet_stage_path(os.getcwd(), 'CPC', time_int)
     elif output_filetype in ['nc','netcdf']:
+        atmoscripts.wait_for_writes(writer)
         atmoscripts.df_to_netcdf(data_resamp,outputfilename,
                                  gui_mode=gui_mode,
                                  gui_mainloop = gui_mainloop,
                                  nc_path = output_path)
     else:
-        data_resamp.to_csv(outputfilename)
+        atmoscripts.submit_write(writer, outputfilename, data_resamp.to_csv,
+                                 os.path.abspath(outputfilename))
 
-    return
+    return os.path.abspath(outputfilename)
 
 def load_basic_csv(filename = None, path = None, file_FULLPATH=None):
     '''
@@ -14,7 +14,11 @@ import os
 import time
 import math
 import pickle
+import json
+import hashlib
 import re
+import concurrent.futures
+import tracemalloc
 from tkinter import simpledialog
 import tkinter as tk
 
@@ -32,47 +36,119 @@ def log_filter(data,
     a 3rd column containing a description of why the period is being
     removed) is ignored. Timestamps must be formatted as:
          yyyy-mm-dd HH:SS:MM
+
+    The periods are merged and applied to the data in one pass (see
+    merge_mask_periods). Periods loaded from file are cached, so a log used
+    for several instruments or files is only loaded once.
     '''
     if log_mask_df is None:
-        if os.path.exists(log_filename):
-            # if a full path is provided
-            log_mask = pd.read_csv(log_filename)
-        else:
-            assert raw_data_path is not None, 'No path provided for mask filter'
-            assert log_filename is not None, 'No filename provided for mask filter'
-            assert os.path.exists(log_filename), 'Specified mask filter file does \
-                                                    not exist'
-            # the filename and folder are provided separately.
-            os.chdir(raw_data_path)
-            # Load file
-            log_mask = pd.read_csv(log_filename)
-
-
-        # check whether there is a header or not
-        try: # check if the loaded header is actually a date
-            pd.to_datetime(log_mask.columns[0])
-            # if it is, reload the data using the header option
-            log_mask = pd.read_csv(log_filename,
-                                   header = None,
-                                   names = ['start','end', '']
-                                   )
-        except ValueError:
-            # rename first two columns
-            log_mask.columns = ['start','end','']
+        periods = load_mask_periods(raw_data_path, log_filename)
     else:
-        log_mask = log_mask_df
+        periods = merge_mask_periods(log_mask_df)
 
-    # Parse timestamps
-    log_mask.iloc[:,0] = pd.to_datetime(log_mask.iloc[:,0])
-    log_mask.iloc[:,1] = pd.to_datetime(log_mask.iloc[:,1])
-    # work through mask periods and set values to nan
-    for i in range(0,len(log_mask)):
-        data.loc[(data.index >= log_mask.iloc[i,0]) & \
-                 (data.index < log_mask.iloc[i,1])] \
-                 = np.nan
+    # set values within the mask periods to nan, other than the QC flags
+    if len(periods) > 0:
+        columns = [col for col in data.columns if col != QC_FLAG_COLUMN]
+        data.loc[in_mask_periods(data.index, periods), columns] = np.nan
 
     return data
 
+# Merged mask periods loaded by load_mask_periods, keyed by the file's path,
+# modification time and size
+_mask_period_cache = {}
+
+def load_mask_periods(raw_data_path = None, log_filename = None):
+    '''
+    Loads the logged events used by log_filter from file, returning the
+    merged periods (see merge_mask_periods). The result is cached until the
+    file changes, so the returned dataframe shouldn't be modified.
+    '''
+    if os.path.exists(log_filename):
+        fname = log_filename
+    else:
+        assert raw_data_path is not None, 'No path provided for mask filter'
+        fname = os.path.join(raw_data_path, log_filename)
+    fstat = os.stat(fname)
+    key = (os.path.abspath(fname), fstat.st_mtime, fstat.st_size)
+
+    if key not in _mask_period_cache:
+        _mask_period_cache[key] = merge_mask_periods(
+                                    load_log_mask(raw_data_path, log_filename))
+    return _mask_period_cache[key]
+
+def merge_mask_periods(log_mask):
+    '''
+    Takes a dataframe with the start and end of each mask period in the first
+    two columns, and returns a dataframe of the periods sorted by start time
+    with overlapping and adjoining periods merged. Periods with a missing or
+    non-increasing timestamp are dropped, as they don't mask anything.
+    '''
+    starts = pd.to_datetime(log_mask.iloc[:,0]).values.astype('datetime64[ns]')
+    ends = pd.to_datetime(log_mask.iloc[:,1]).values.astype('datetime64[ns]')
+
+    keep = ~np.isnat(starts) & ~np.isnat(ends) & (starts < ends)
+    order = np.argsort(starts[keep], kind='mergesort')
+    starts = starts[keep][order]
+    ends = ends[keep][order]
+    if len(starts) == 0:
+        return pd.DataFrame({'start': starts, 'end': ends})
+
+    # A new period begins wherever the start is after all previous ends
+    reach = np.maximum.accumulate(ends)
+    new = np.concatenate(([True], starts[1:] > reach[:-1]))
+    last = np.concatenate((np.flatnonzero(new)[1:] - 1, [len(starts) - 1]))
+
+    return pd.DataFrame({'start': starts[new], 'end': reach[last]})
+
+def in_mask_periods(index, periods):
+    '''
+    Returns a boolean array which is True where the timestamps in index fall
+    within (start <= t < end) one of the merged periods from
+    merge_mask_periods. The index doesn't need to be sorted.
+    '''
+    times = np.asarray(index.values).astype('datetime64[ns]')
+    starts = periods['start'].values
+    ends = periods['end'].values
+    if len(starts) == 0:
+        return np.zeros(len(times), dtype=bool)
+
+    # The last period starting at or before each timestamp
+    k = np.searchsorted(starts, times, side='right') - 1
+    return (k >= 0) & (times < ends[np.maximum(k, 0)])
+
+def load_log_mask(raw_data_path = None, log_filename = None):
+    '''
+    Loads the logged events used by log_filter from file, returning a
+    dataframe with the start and end of each period in the first two columns
+    '''
+    if os.path.exists(log_filename):
+        # if a full path is provided
+        log_mask = pd.read_csv(log_filename)
+    else:
+        assert raw_data_path is not None, 'No path provided for mask filter'
+        assert log_filename is not None, 'No filename provided for mask filter'
+        assert os.path.exists(os.path.join(raw_data_path, log_filename)), \
+            'Specified mask filter file does not exist'
+        # the filename and folder are provided separately.
+        os.chdir(raw_data_path)
+        # Load file
+        log_mask = pd.read_csv(log_filename)
+
+
+    # check whether there is a header or not
+    try: # check if the loaded header is actually a date
+        pd.to_datetime(log_mask.columns[0])
+        # if it is, reload the data using the header option
+        log_mask = pd.read_csv(log_filename,
+                               header = None,
+                               names = ['start','end', '']
+                               )
+    except ValueError:
+        # rename first two columns
+        log_mask.columns = ['start','end','']
+
+    return log_mask
+
 def find_variable_parameter(variable, parameter = 'units',
                             gui_mode= False, gui_mainloop = None):
     '''
@@ -634,6 +710,258 @@ def write_netcdf(data,
 
     return
 
+# Parquet datasets are partitioned into directories of
+#   instrument=<instrument>/stage=<stage>/day=<yyyymmdd>/
+# under the dataset path, with the time index stored as the timestamp column.
+# (The CCN data has its own date column, so the partition is named day.)
+PARQUET_TIME_COLUMN = 'timestamp'
+PARQUET_DAY_PARTITION = 'day'
+# Rows per parquet row group, i.e. an hour of 1 second data. Readers use the
+# row group statistics to skip the row groups outside the requested times.
+PARQUET_ROW_GROUP = 3600
+
+def parquet_stage_path(dataset_path, instrument, stage):
+    '''
+    Returns the directory holding the data of one processing stage of an
+    instrument in a parquet dataset
+    '''
+    return os.path.join(dataset_path, 'instrument=' + str(instrument),
+                        'stage=' + str(stage))
+
+def df_to_parquet(data, dataset_path, instrument, stage, append_dates = None):
+    '''
+    Writes timestamp indexed data to a parquet dataset partitioned by
+    instrument, processing stage and date. Each date's data replaces what was
+    previously saved for that date and stage.
+
+    To save data in consecutive chunks, pass the same (initially empty) set
+    as append_dates with each chunk: the dates written are added to it, and
+    further chunks of those dates are added alongside rather than replacing
+    them. Requires pyarrow.
+    '''
+    stage_path = parquet_stage_path(dataset_path, instrument, stage)
+    data = data.sort_index(kind='mergesort')
+    data = data.rename_axis(PARQUET_TIME_COLUMN)
+    dates = data.index.strftime('%Y%m%d')
+
+    for date in pd.unique(dates):
+        day = data[dates == date]
+        date_path = os.path.join(stage_path, PARQUET_DAY_PARTITION + '=' + date)
+        if append_dates is None or date not in append_dates:
+            if os.path.isdir(date_path):
+                for f in os.listdir(date_path):
+                    if f.endswith('.parquet'):
+                        os.remove(os.path.join(date_path, f))
+            else:
+                os.makedirs(date_path)
+        # Parts are named by the time of their first row, so they are read
+        # back in time order
+        fname = 'part_' + day.index[0].strftime('%H%M%S') + '.parquet'
+        day.to_parquet(os.path.join(date_path, fname), engine='pyarrow',
+                       row_group_size=PARQUET_ROW_GROUP)
+        if append_dates is not None:
+            append_dates.add(date)
+    return stage_path
+
+def read_parquet(dataset_path, instrument, stage,
+                 columns = None, start = None, end = None):
+    '''
+    Reads data saved by df_to_parquet, returning only the columns given (or
+    all of them), from start up to but not including end. The date partitions
+    and row groups outside of the time range aren't read at all. Columns
+    missing from some of the days (e.g. a supersaturation which is only seen
+    on some of them) are blank on those days. Requires pyarrow.
+    '''
+    import pyarrow
+    import pyarrow.dataset
+    import pyarrow.parquet
+
+    filters = []
+    if start is not None:
+        start = pd.Timestamp(start)
+        filters += [(PARQUET_DAY_PARTITION, '>=', int(start.strftime('%Y%m%d'))),
+                    (PARQUET_TIME_COLUMN, '>=', start)]
+    if end is not None:
+        end = pd.Timestamp(end)
+        filters += [(PARQUET_DAY_PARTITION, '<=', int(end.strftime('%Y%m%d'))),
+                    (PARQUET_TIME_COLUMN, '<', end)]
+
+    filters = filters if len(filters) > 0 else None
+
+    # pyarrow takes the schema of a dataset from one of its files, so merge
+    # the schemas of the days read
+    stage_path = parquet_stage_path(dataset_path, instrument, stage)
+    dataset = pyarrow.dataset.dataset(stage_path, format='parquet',
+                                      partitioning='hive')
+    fragments = dataset.get_fragments(
+            filter=pyarrow.parquet.filters_to_expression(filters)
+            if filters is not None else None)
+    schema = pyarrow.unify_schemas([dataset.schema] +
+                                   [f.physical_schema for f in fragments],
+                                   promote_options='permissive')
+
+    data = pd.read_parquet(stage_path,
+                           engine='pyarrow',
+                           columns=columns,
+                           filters=filters,
+                           schema=schema)
+
+    # Drop the partition column and index by time
+    if PARQUET_DAY_PARTITION in data.columns:
+        del data[PARQUET_DAY_PARTITION]
+    if PARQUET_TIME_COLUMN in data.columns:
+        data = data.set_index(PARQUET_TIME_COLUMN)
+    return data.sort_index(kind='mergesort')
+
+# Time span index of the processed files in a directory, kept alongside them
+# with the key of the data as a prefix, e.g. ccn_archive_index.jsonl
+ARCHIVE_INDEX = 'archive_index.jsonl'
+# HDF key of each instrument's data
+ARCHIVE_KEYS = {'CCN': 'ccn', 'CPC': 'cn'}
+# Time span indexes loaded by archive_index, keyed by directory, key and
+# filetype
+_archive_index_cache = {}
+
+def archive_index(data_path, key, filetype = 'h5'):
+    '''
+    Returns a dict with the time span of each hdf (or csv) file in data_path,
+    keyed by the absolute path of the file. Each record holds the path, size,
+    mtime, whether the file is an hdf table, and the first and last
+    timestamps of the file, which is assumed to be sorted by time.
+
+    The index is saved in data_path (see ARCHIVE_INDEX) and kept in memory,
+    and only the files which have been added or modified since are opened to
+    refresh it. Files without the key are recorded with no time span.
+    '''
+    data_path = os.path.abspath(data_path)
+    cache_key = (data_path, key, filetype)
+    index_filename = os.path.join(data_path, key + '_' + ARCHIVE_INDEX)
+    if cache_key not in _archive_index_cache:
+        _archive_index_cache[cache_key] = read_manifest(index_filename,
+                                                        legacy_filename=None)
+    index = _archive_index_cache[cache_key]
+
+    paths = [os.path.join(data_path, f) for f in os.listdir(data_path)
+             if f.endswith('.' + filetype)]
+    updated = []
+    for path in paths:
+        fstat = os.stat(path)
+        record = index.get(path)
+        if record is not None and record['size'] == fstat.st_size \
+                              and record['mtime'] == fstat.st_mtime:
+            continue
+        record = {'path': path,
+                  'size': fstat.st_size,
+                  'mtime': fstat.st_mtime,
+                  'table': False,
+                  'start': None,
+                  'end': None}
+        if filetype in ['h5', 'hdf']:
+            with pd.HDFStore(path, mode='r') as store:
+                if '/' + key in store.keys():
+                    storer = store.get_storer(key)
+                    record['table'] = storer.is_table
+                    if storer.is_table:
+                        nrows = storer.nrows
+                        times = store.select(key, start=0, stop=1).index.append(
+                                store.select(key, start=nrows-1, stop=nrows).index)
+                    else:
+                        times = store.select(key).index
+                    if len(times) > 0:
+                        record['start'] = str(times.min())
+                        record['end'] = str(times.max())
+        else:
+            times = pd.read_csv(path, usecols=[0], index_col=0,
+                                parse_dates=True).index
+            if len(times) > 0:
+                record['start'] = str(times.min())
+                record['end'] = str(times.max())
+        index[path] = record
+        updated.append(record)
+
+    # Forget files which have been removed
+    for path in set(index).difference(paths):
+        del index[path]
+
+    if len(updated) > 0:
+        write_manifest(updated, index_filename)
+    return index
+
+def archive_file_matches(path, stage = 'raw', resolution = None):
+    '''
+    Checks whether a processed file is from the processing stage, or of the
+    time resolution if it's given, using the names given by the processing:
+        CCN_raw_170323.h5 (or CCN_raw.h5) is the raw data,
+        CCN_raw_170323_QC_flowCal.h5 is from the flowCal stage and
+        CCN_raw_170323_1Min.h5 is resampled to 1 minute.
+    '''
+    base = os.path.basename(path).split('.')[0]
+    if resolution is not None:
+        return base.endswith('_' + resolution)
+    if stage == 'raw':
+        # Only labels of the period the file covers follow 'raw'
+        return re.search('_raw(_(\d+|wk\d+))*$', base) is not None
+    return ('_raw' in base) and base.endswith('_' + stage)
+
+def query(data_path, instrument, stage = 'raw', start = None, end = None,
+          columns = None, resolution = None, filetype = 'h5'):
+    '''
+    Returns the processed data of an instrument ('CCN' or 'CPC') in data_path
+    from start up to (but not including) end, for the processing stage (e.g.
+    'raw', 'QC' or 'ssSplit') or resampled time resolution (e.g. '1Min'), with
+    only the given columns if columns isn't None.
+
+    Only the files which overlap the time range are opened, using the index
+    from archive_index. Only the rows in the time range are read from hdf
+    tables and parquet datasets, while other files are read whole and sliced.
+    '''
+    if start is not None:
+        start = pd.Timestamp(start)
+    if end is not None:
+        end = pd.Timestamp(end)
+
+    if filetype == 'parquet':
+        return read_parquet(data_path, instrument,
+                            resolution if resolution is not None else stage,
+                            columns, start, end)
+
+    key = ARCHIVE_KEYS[instrument]
+    index = archive_index(data_path, key, filetype)
+    records = [record for path, record in sorted(index.items())
+               if record['start'] is not None
+               and archive_file_matches(path, stage, resolution)
+               and (start is None or pd.Timestamp(record['end']) >= start)
+               and (end is None or pd.Timestamp(record['start']) < end)]
+
+    frames = []
+    for record in records:
+        if record['table']:
+            where = []
+            if start is not None:
+                where.append('index >= start')
+            if end is not None:
+                where.append('index < end')
+            data = pd.read_hdf(record['path'], key,
+                               where=where if len(where) > 0 else None,
+                               columns=columns)
+        else:
+            if filetype in ['h5', 'hdf']:
+                data = pd.read_hdf(record['path'], key)
+            else:
+                data = pd.read_csv(record['path'], index_col=0,
+                                   parse_dates=True)
+            if start is not None:
+                data = data[data.index >= start]
+            if end is not None:
+                data = data[data.index < end]
+            if columns is not None:
+                data = data[columns]
+        frames.append(data)
+
+    if len(frames) == 0:
+        return pd.DataFrame(columns=columns)
+    return merge_timestamped(frames)
+
 #Because acsm 10 min data doesn't align to a continuous 10 min period (e.g. 8:10 sometimes, 9:01 others, etc)
 # we're going to average the 5 second data into 10 minute data, but utilising the start time of the acsm data.
 def variable_timebase_resample(data,
@@ -666,6 +994,473 @@ def variable_timebase_resample(data,
 
     return data_resamp
 
+def resample_periods(index, time):
+    '''
+    Returns the start of each period when resampling data with the timestamp
+    index to the time interval, as produced by DataFrame.resample, and the
+    number of the period each timestamp falls in (-1 for missing timestamps).
+    '''
+    labels = pd.Series(0, index=index).resample(time).count().index
+    codes = labels.searchsorted(index, side='right') - 1
+    return labels, codes
+
+def _period_order(codes, values):
+    # Order which sorts by period and then value, keeping the order of ties.
+    # Complex numbers sort by the real and then the imaginary part, which is
+    # quicker than lexsort, but an infinite imaginary part makes the real
+    # part nan, so lexsort is used when there are infinite values.
+    if np.isfinite(values).all():
+        return np.argsort(codes + 1j*values, kind='stable')
+    return np.lexsort((values, codes))
+
+def _sort_by_period(codes, values):
+    # Periods and values of the non-nan values with a timestamp, sorted by
+    # period and then value
+    valid = (codes >= 0) & ~np.isnan(values)
+    codes = codes[valid]
+    values = values[valid]
+    order = _period_order(codes, values)
+    return codes[order], values[order]
+
+def _segment_median(values, starts, n):
+    # Median of each period from the values sorted by period and value,
+    # where starts and n are the first index and number of values of each
+    if len(values) == 0:
+        return np.full(len(n), np.nan)
+    lo = np.take(values, starts + (n-1)//2, mode='clip')
+    hi = np.take(values, starts + n//2, mode='clip')
+    return np.where(n > 0, (lo + hi)/2, np.nan)
+
+def _segment_mad(values, codes, starts, n, med):
+    # Median absolute deviation of each period from the values sorted by
+    # period and value. The deviations of the values below the median and of
+    # those above it are each already sorted, so the middle deviations are
+    # selected from the two runs by a binary search on the number taken from
+    # below the median, done for all periods at once.
+    if len(values) == 0:
+        return np.full(len(n), np.nan)
+    below = np.bincount(codes[values < med[codes]], minlength=len(n))
+    above = n - below
+
+    def kth(k):
+        # k-th smallest (from 0) deviation in each period
+        lo = np.maximum(0, k + 1 - above)
+        hi = np.minimum(k + 1, below)
+        while np.any(lo < hi):
+            active = lo < hi
+            i = (lo + hi)//2
+            # i-th deviation below, and (k-i)-th above
+            dev_below = med - np.take(values, starts + below - 1 - i,
+                                      mode='clip')
+            dev_above = np.take(values, starts + below + k - i,
+                                mode='clip') - med
+            take_more = active & (dev_above > dev_below)
+            lo = np.where(take_more, i + 1, lo)
+            hi = np.where(active & ~take_more, i, hi)
+        j = k + 1 - lo
+        dev_below = np.where(lo > 0,
+                             med - np.take(values, starts + below - lo,
+                                           mode='clip'),
+                             -np.inf)
+        dev_above = np.where(j > 0,
+                             np.take(values, starts + below + j - 1,
+                                     mode='clip') - med,
+                             -np.inf)
+        return np.maximum(dev_below, dev_above)
+
+    return np.where(n > 0, (kth((n-1)//2) + kth(n//2))/2, np.nan)
+
+# Statistics calculated by resample_stats unless others are requested
+RESAMPLE_STATS = ['med', 'mad', 'avg', 'std', 'count']
+
+def resample_stats(data, time, stats = RESAMPLE_STATS, names = None,
+                   by = None):
+    '''
+    Resamples each column of data to the time interval, calculating any of
+    the statistics:
+        med   - median
+        mad   - median absolute deviation from the median
+        avg   - mean
+        std   - standard deviation
+        count - number of non-nan values
+        rmsn  - square root of the sum of squares (root mean square numerator)
+        min   - minimum
+        max   - maximum
+    ignoring nans, with the same time periods and results as calling
+    data.resample(time) for each statistic separately.
+
+    Each column is sorted by period and value once, for the median, MAD, min
+    and max, with the other statistics summed over the periods, rather than
+    grouping the data for every statistic.
+
+    The output columns are named name_stat in the order of the columns and
+    then of stats, where names defaults to the column names of data.
+
+    If by is given (an array or series of keys, one per row), the statistics
+    are calculated separately for each key in each period, as with grouping
+    by both, and only the periods and keys with data are returned, sorted by
+    period and then key. The key is returned as the first column, named by
+    the name of by (or 'key'), with each period start repeated once per key.
+    Rows with a nan key are ignored.
+    '''
+    if names is None:
+        names = list(data.columns)
+
+    labels, row_codes = resample_periods(data.index, time)
+    nbins = len(labels)
+
+    if by is not None:
+        # Number each (period, key) pair, so the same kernels group by both
+        key_codes, keys = pd.factorize(np.asarray(by), sort=True)
+        nkeys = max(len(keys), 1)
+        row_codes = np.where((row_codes >= 0) & (key_codes >= 0),
+                             row_codes*nkeys + key_codes, -1)
+        nbins = len(labels)*nkeys
+        occupied = np.flatnonzero(np.bincount(row_codes[row_codes >= 0],
+                                              minlength=nbins))
+
+    columns = {}
+    for column, name in zip(data.columns, names):
+        codes, values = _sort_by_period(row_codes,
+                                        data[column].values.astype(float))
+        n = np.bincount(codes, minlength=nbins)
+        starts = np.searchsorted(codes, np.arange(nbins))
+
+        results = {'count': n}
+        with np.errstate(invalid='ignore', divide='ignore'):
+            results['med'] = _segment_median(values, starts, n)
+            if 'mad' in stats:
+                results['mad'] = _segment_mad(values, codes, starts, n,
+                                              results['med'])
+            if len(values) > 0:
+                results['min'] = np.where(n > 0, np.take(values, starts,
+                                                         mode='clip'), np.nan)
+                results['max'] = np.where(n > 0, np.take(values, starts + n - 1,
+                                                         mode='clip'), np.nan)
+            else:
+                results['min'] = results['max'] = np.full(nbins, np.nan)
+            results['avg'] = np.bincount(codes, values, minlength=nbins) / n
+            if 'std' in stats:
+                dev = values - results['avg'][codes]
+                results['std'] = np.where(n > 1,
+                                          np.sqrt(np.bincount(codes, dev**2,
+                                                              minlength=nbins)
+                                                  / (n - 1)),
+                                          np.nan)
+            results['rmsn'] = np.sqrt(np.bincount(codes, values**2,
+                                                  minlength=nbins))
+
+        for stat in stats:
+            columns[name + '_' + stat] = results[stat]
+
+    if by is not None:
+        key_name = getattr(by, 'name', None) or 'key'
+        grouped = {key_name: keys[occupied % nkeys]}
+        grouped.update((name, values[occupied])
+                       for name, values in columns.items())
+        return pd.DataFrame(grouped, index=labels[occupied // nkeys],
+                            columns=list(grouped))
+
+    return pd.DataFrame(columns, index=labels, columns=list(columns))
+
+# Relative accuracy of the median and MAD estimated by cascade_resampler
+SKETCH_ACCURACY = 0.01
+
+def cascade_resampler(data, time_int, exact = None,
+                      accuracy = SKETCH_ACCURACY):
+    '''
+    Returns a function which resamples columns of data in the same way as
+    resample_stats (taking the same arguments, where the frame passed must
+    be made up of columns of data) for each of the time intervals in
+    time_int, but which only goes through the data once per column.
+
+    The statistics of each column are calculated at the shortest interval and
+    then added up into each longer interval in turn, so all intervals must
+    be multiples of the shortest. The count, mean, std, rmsn, min and max are
+    merged exactly (up to rounding), using the sums, sums of squares and the
+    sum of squared deviations from the mean of the shorter periods.
+
+    The median and MAD are exact for the shortest interval, but can't be
+    merged exactly, so for the others they are estimated from a sketch of the
+    distribution of each period: values are counted in logarithmically
+    spaced buckets, each standing in for values within a relative accuracy
+    of its representative value, and the bucket counts are added up for the
+    longer periods. The median estimate is then within accuracy * |median|
+    of the true median (within accuracy * the mean magnitude of the two
+    middle values when there is an even number of values), and the MAD
+    estimate within accuracy * (|median| + |x|) of the true MAD, where x is
+    the value whose deviation is the MAD. Values with a magnitude below
+    1e-300 are counted as zero.
+
+    exact is a list of the intervals where the median and MAD are calculated
+    exactly from data instead (with resample_stats), or True for all of them.
+    Each column is processed the first time it is asked for, and kept for
+    all intervals.
+    '''
+    time_int = list(time_int)
+    if exact is True:
+        exact = time_int
+    elif exact is None:
+        exact = []
+
+    # Shortest interval first, and the interval each is merged from
+    time_int.sort(key=pd.Timedelta)
+    finest = time_int[0]
+    merge_from = {}
+    for i, time in enumerate(time_int[1:]):
+        assert pd.Timedelta(time) % pd.Timedelta(finest) == pd.Timedelta(0), \
+            'All intervals must be multiples of the shortest, ' + finest
+        previous = time_int[i]
+        if pd.Timedelta(time) % pd.Timedelta(previous) == pd.Timedelta(0):
+            merge_from[time] = previous
+        else:
+            merge_from[time] = finest
+
+    # Bucket of the sketch: the sign of the value times (offset + the
+    # logarithm of its magnitude to the base gamma, rounded up), 0 for zero
+    gamma = (1 + accuracy)/(1 - accuracy)
+    offset = int(np.ceil(np.log(1e300)/np.log(gamma))) + 1
+    # Keys are stored with the period as period*width + key + kmax
+    kmax = offset + int(np.ceil(np.log(np.finfo(float).max)/np.log(gamma)))
+    width = 2*kmax + 1
+
+    def bucket(values):
+        magnitude = np.minimum(np.fabs(values), np.finfo(float).max)
+        keys = np.zeros(len(values), dtype=np.int64)
+        nonzero = magnitude >= 1e-300
+        keys[nonzero] = (np.sign(values[nonzero]) *
+                         (offset + np.ceil(np.log(magnitude[nonzero])
+                                           / np.log(gamma)))).astype(np.int64)
+        return keys
+
+    def bucket_value(keys):
+        return np.where(keys == 0, 0,
+                        np.sign(keys) * 2*gamma**(np.fabs(keys) - offset)
+                        / (gamma + 1))
+
+    # Periods of each interval, and the period of the interval it's merged
+    # into for each period of the interval it's merged from
+    labels = {}
+    merge_codes = {}
+    labels[finest], row_codes = resample_periods(data.index, finest)
+    for time in time_int[1:]:
+        shorter = labels[merge_from[time]]
+        td = pd.Timedelta(time)
+        if len(shorter) == 0:
+            labels[time] = shorter
+            merge_codes[time] = np.zeros(0, dtype=np.int64)
+            continue
+        # Periods start from midnight of the first day, as with resample
+        first = shorter[0].normalize()
+        first = first + ((shorter[0] - first)//td)*td
+        merge_codes[time] = np.asarray((shorter - first)//td, dtype=np.int64)
+        labels[time] = pd.date_range(first, periods=merge_codes[time][-1] + 1,
+                                     freq=time, name=data.index.name)
+
+    def column_stats(column):
+        # Statistics of a column at each interval
+        codes, values = _sort_by_period(row_codes,
+                                        data[column].values.astype(float))
+        nbins = len(labels[finest])
+        n = np.bincount(codes, minlength=nbins)
+        starts = np.searchsorted(codes, np.arange(nbins))
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            total = np.bincount(codes, values, minlength=nbins)
+            med = _segment_median(values, starts, n)
+            stats = {'n': n,
+                     'sum': total,
+                     'sumsq': np.bincount(codes, values**2, minlength=nbins),
+                     'm2': np.bincount(codes, (values - (total/n)[codes])**2,
+                                       minlength=nbins),
+                     'med': med,
+                     'mad': _segment_mad(values, codes, starts, n, med),
+                     'min': np.full(nbins, np.nan),
+                     'max': np.full(nbins, np.nan)}
+        if len(values) > 0:
+            stats['min'] = np.where(n > 0, np.take(values, starts, mode='clip'),
+                                    np.nan)
+            stats['max'] = np.where(n > 0, np.take(values, starts + n - 1,
+                                                   mode='clip'), np.nan)
+
+        # Sketch as (period, bucket, count), sorted by period then bucket.
+        # The values are already sorted, so equal keys are next to each other
+        keys = codes*width + bucket(values) + kmax
+        first = np.flatnonzero(np.diff(keys, prepend=-1))
+        counts = np.diff(np.concatenate((first, [len(keys)])))
+        keys = keys[first]
+        stats['sketch'] = (keys//width, keys % width - kmax, counts)
+        results = {finest: stats}
+
+        for time in time_int[1:]:
+            shorter = results[merge_from[time]]
+            code = merge_codes[time]
+            nbins = len(labels[time])
+            starts = np.searchsorted(code, np.arange(nbins))
+            if nbins == 0:
+                results[time] = shorter
+                continue
+
+            n = np.add.reduceat(shorter['n'], starts)
+            total = np.add.reduceat(shorter['sum'], starts)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                mean = total/n
+                spread = np.where(shorter['n'] > 0,
+                                  shorter['n']*(shorter['sum']/shorter['n']
+                                                - mean[code])**2,
+                                  0)
+            stats = {'n': n,
+                     'sum': total,
+                     'sumsq': np.add.reduceat(shorter['sumsq'], starts),
+                     'm2': np.add.reduceat(shorter['m2'] + spread, starts),
+                     'min': np.fmin.reduceat(shorter['min'], starts),
+                     'max': np.fmax.reduceat(shorter['max'], starts)}
+
+            # The keys of each shorter period are sorted, and a stable sort
+            # takes advantage of these runs
+            bins, keys, counts = shorter['sketch']
+            keys = code[bins]*width + keys + kmax
+            order = np.argsort(keys, kind='stable')
+            keys = keys[order]
+            first = np.flatnonzero(np.diff(keys, prepend=-1))
+            counts = np.add.reduceat(counts[order], first)
+            keys = keys[first]
+            stats['sketch'] = (keys//width, keys % width - kmax, counts)
+            results[time] = stats
+
+        return results
+
+    def sketch_median(bins, values, counts, n):
+        # Median of each period from the counts of values, sorted by period
+        # and then value
+        nbins = len(n)
+        if len(values) == 0:
+            return np.full(nbins, np.nan)
+        cumulative = np.cumsum(counts)
+        first = np.searchsorted(bins, np.arange(nbins))
+        before = np.where(first > 0,
+                          np.take(cumulative, first - 1, mode='clip'), 0)
+
+        def kth(k):
+            return np.take(values,
+                           np.searchsorted(cumulative, before + k + 1),
+                           mode='clip')
+
+        return np.where(n > 0, (kth((n-1)//2) + kth(n//2))/2, np.nan)
+
+    cache = {}
+
+    def resampler(frame, time, stats = RESAMPLE_STATS, names = None):
+        if names is None:
+            names = list(frame.columns)
+        if len(stats) == 0:
+            return pd.DataFrame(index=labels[time])
+
+        columns = {}
+        for column, name in zip(frame.columns, names):
+            if column not in cache:
+                cache[column] = column_stats(column)
+            col = cache[column][time]
+            n = col['n']
+
+            results = {'count': n, 'min': col['min'], 'max': col['max'],
+                       'rmsn': np.sqrt(col['sumsq'])}
+            with np.errstate(invalid='ignore', divide='ignore'):
+                results['avg'] = col['sum']/n
+                results['std'] = np.where(n > 1,
+                                          np.sqrt(col['m2']/(n - 1)), np.nan)
+
+                if time == finest:
+                    results['med'] = col['med']
+                    results['mad'] = col['mad']
+                elif time in exact:
+                    if ('med' in stats) or ('mad' in stats):
+                        exact_stats = resample_stats(data[[column]], time,
+                                                     ['med', 'mad'], ['c'])
+                        results['med'] = exact_stats['c_med'].values
+                        results['mad'] = exact_stats['c_mad'].values
+                elif ('med' in stats) or ('mad' in stats):
+                    bins, keys, counts = col['sketch']
+                    values = bucket_value(keys)
+                    results['med'] = sketch_median(bins, values, counts, n)
+                    if 'mad' in stats:
+                        dev = np.fabs(values - results['med'][bins])
+                        srt = _period_order(bins, dev)
+                        results['mad'] = sketch_median(bins[srt], dev[srt],
+                                                       counts[srt], n)
+
+            for stat in stats:
+                columns[name + '_' + stat] = results[stat]
+
+        return pd.DataFrame(columns, index=labels[time],
+                            columns=list(columns))
+
+    return resampler
+
+def merge_timestamped(frames):
+    '''
+    Concatenates timestamp indexed dataframes in the order given, sorts them
+    by timestamp and drops duplicate timestamps keeping the last occurrence,
+    i.e. rows from later frames replace rows from earlier ones.
+    '''
+    data = pd.concat(frames)
+    # A stable sort keeps the order of the input frames for equal timestamps
+    data = data.sort_index(kind='mergesort')
+    data = data[~data.index.duplicated(keep='last')]
+    return data
+
+def update_hdf_table(data, h5_filename, key):
+    '''
+    Merges new timestamp indexed data into an existing HDF table without
+    rewriting the whole file. Only the stored rows from the first new
+    timestamp onwards are read back, merged with the new data (new rows win
+    on duplicate timestamps) and written in place of that tail, so appending
+    later data touches no existing rows at all.
+
+    Columns of the new data which the table holds in a wider dtype (e.g. a
+    compact integer column stored as float32) are converted to it, where
+    that doesn't lose anything.
+
+    Returns False, leaving the file untouched, if there's no table to update
+    (missing key or fixed format store) or the new data doesn't fit the
+    stored table, so that the caller can fall back to a full rewrite.
+    '''
+    data = merge_timestamped([data])
+    if len(data) == 0:
+        return True
+
+    with pd.HDFStore(h5_filename) as store:
+        storer = store.get_storer(key) if key in store else None
+        if storer is None or not storer.is_table:
+            return False
+        nrows = storer.nrows
+
+        # Position of the first stored row the new data may overlap with.
+        # The table is kept sorted, so everything from there on is the tail.
+        t0 = data.index[0]
+        coords = store.select_as_coordinates(key, where='index >= t0')
+        first = coords[0] if len(coords) > 0 else nrows
+
+        if first < nrows:
+            tail = store.select(key, start=first, stop=nrows)
+            data = merge_timestamped([tail, data])
+
+        stored = store.select(key, start=0, stop=0).dtypes
+        for col, dtype in stored.items():
+            if col in data.columns and data[col].dtype != dtype and \
+               np.can_cast(data[col].dtype, dtype, casting='safe'):
+                data[col] = data[col].astype(dtype)
+
+        # Write the merged tail before dropping the old one, so a failed
+        # append doesn't lose anything
+        try:
+            store.append(key, data, format='table')
+        except (ValueError, TypeError):
+            return False
+        if first < nrows:
+            store.remove(key, start=first, stop=nrows)
+    return True
+
 def read_filelist_from_file(filelist_filename = 'files_loaded.txt'):
     try:
         with open(filelist_filename, 'rb') as f:
@@ -680,3 +1475,868 @@ def write_filelist_to_file(filelist, filelist_filename = 'files_loaded.txt'):
     with open(filelist_filename, 'wb') as f:
         pickle.dump(filelist, f)
     return
+
+# Index of the raw files that have been loaded, one json record per line
+FILE_MANIFEST = 'files_manifest.jsonl'
+
+def manifest_path(output_path):
+    '''
+    Returns the path of the manifest of the raw files loaded into the output
+    files in output_path
+    '''
+    return os.path.join(os.path.abspath(output_path), FILE_MANIFEST)
+
+def read_manifest(manifest_filename,
+                  legacy_filename = 'files_loaded.txt'):
+    '''
+    Reads the manifest of loaded raw files, returning a dict of records
+    keyed by the absolute path of each file. Each record holds the path,
+    size, mtime, content hash, number of rows and time span of the file when
+    it was last loaded. The manifest is only ever appended to, so later
+    records replace earlier ones for the same path, and a line cut short by
+    an interrupted write is ignored.
+
+    If there's no manifest yet, the files listed in the old pickled
+    files_loaded.txt are returned as records with just a path, which
+    check_manifest treats as loaded.
+    '''
+    manifest = {}
+    if os.path.isfile(manifest_filename):
+        with open(manifest_filename, 'r') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                manifest[record['path']] = record
+    elif legacy_filename is not None and os.path.isfile(legacy_filename):
+        for fname in read_filelist_from_file(legacy_filename):
+            if fname != '':
+                path = os.path.abspath(fname)
+                manifest[path] = {'path': path}
+    return manifest
+
+def write_manifest(records, manifest_filename):
+    '''
+    Appends records (see read_manifest) to the manifest
+    '''
+    with open(manifest_filename, 'a') as f:
+        for record in records:
+            f.write(json.dumps(record) + '\n')
+    return
+
+def file_hash(fname, prefix_size = None, blocksize = 2**20):
+    '''
+    Returns the sha1 hash of the contents of a file. If prefix_size is given,
+    the hash of the first prefix_size bytes is also returned, from the same
+    read of the file.
+    '''
+    h = hashlib.sha1()
+    prefix = None
+    pos = 0
+    with open(fname, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            if prefix_size is not None and pos < prefix_size <= pos + len(block):
+                h.update(block[:prefix_size - pos])
+                prefix = h.copy()
+                h.update(block[prefix_size - pos:])
+            else:
+                h.update(block)
+            pos += len(block)
+    if prefix_size is None:
+        return h.hexdigest()
+    if prefix_size == 0:
+        prefix = hashlib.sha1()
+    return h.hexdigest(), (prefix.hexdigest() if prefix is not None else None)
+
+def check_manifest(filelist, manifest):
+    '''
+    Compares a list of raw files against the manifest from read_manifest, and
+    returns a list of (filename, status, record) with the status of each file:
+        'unchanged' - same size and mtime as recorded (only stat is called),
+                      or only the mtime changed and the contents are the same
+        'moved'     - not in the manifest, but has the same contents as a
+                      file that is, e.g. it has been renamed or re-exported
+        'grown'     - data has been appended since it was loaded, e.g. it
+                      was still being written. Its first record['rows'] rows
+                      have been loaded before.
+        'changed'   - modified in some other way
+        'new'       - not in the manifest
+    Files which are 'new', 'changed' or 'grown' need to be loaded. The record
+    is the updated manifest record for the file, which still needs its rows
+    and time span filled in (see set_manifest_rows) for the files that are
+    loaded. Records which are the same as in the manifest are None.
+    '''
+    by_hash = {r['hash']: r for r in manifest.values() if r.get('hash')}
+    checked = []
+    for fname in filelist:
+        path = os.path.abspath(fname)
+        fstat = os.stat(fname)
+        prev = manifest.get(path)
+        if prev is not None and prev.get('size') == fstat.st_size \
+                            and prev.get('mtime') == fstat.st_mtime:
+            checked.append((fname, 'unchanged', None))
+            continue
+
+        record = {'path': path,
+                  'size': fstat.st_size,
+                  'mtime': fstat.st_mtime,
+                  'hash': None,
+                  'rows': None,
+                  'start': None,
+                  'end': None}
+        if prev is not None and prev.get('size') is not None \
+                            and prev['size'] < fstat.st_size:
+            record['hash'], prefix = file_hash(fname, prev['size'])
+        else:
+            record['hash'], prefix = file_hash(fname), None
+
+        if prev is not None and prev.get('hash') is None:
+            # Loaded before there was a manifest
+            status, previous = 'unchanged', None
+        elif prev is not None and record['hash'] == prev['hash']:
+            status, previous = 'unchanged', prev
+        elif prev is not None and prefix == prev['hash']:
+            status, previous = 'grown', prev
+        elif prev is not None:
+            status, previous = 'changed', None
+        elif record['hash'] in by_hash:
+            status, previous = 'moved', by_hash[record['hash']]
+        else:
+            status, previous = 'new', None
+
+        if previous is not None:
+            for key in ['rows', 'start', 'end']:
+                record[key] = previous.get(key)
+        checked.append((fname, status, record))
+    return checked
+
+def set_manifest_rows(record, rows, index):
+    '''
+    Fills in the number of rows loaded from a file and extends the time span
+    of its manifest record with the timestamps in index
+    '''
+    record['rows'] = rows
+    if len(index) > 0:
+        start, end = str(index.min()), str(index.max())
+        if record['start'] is None or start < record['start']:
+            record['start'] = start
+        if record['end'] is None or end > record['end']:
+            record['end'] = end
+    return record
+
+# Byte offset reached in each raw file followed in real-time mode, kept in the
+# output directory in the same format as the file manifest
+TAIL_STATE = 'tail_state.jsonl'
+
+def read_new_lines(fname, record):
+    '''
+    Returns the complete lines appended to a file since the byte offset in
+    record['offset'], and moves the offset past them. A last line which is
+    still being written (no newline yet) is left for the next read. If the
+    file has shrunk, e.g. it was replaced, it's read again from the start.
+    Only the new part of the file is read.
+    '''
+    size = os.path.getsize(fname)
+    if size < record['offset']:
+        record['offset'] = 0
+    if size == record['offset']:
+        return ''
+
+    with open(fname, 'rb') as f:
+        f.seek(record['offset'])
+        block = f.read(size - record['offset'])
+    end = block.rfind(b'\n') + 1
+    record['offset'] = record['offset'] + end
+    return block[:end].decode('utf-8', errors='replace')
+
+def tail_end_offset(fname, blocksize = 2**16):
+    '''
+    Returns the byte offset just after the last complete line of a file,
+    reading back from the end of the file one block at a time
+    '''
+    with open(fname, 'rb') as f:
+        pos = f.seek(0, os.SEEK_END)
+        while pos > 0:
+            start = max(0, pos - blocksize)
+            f.seek(start)
+            block = f.read(pos - start)
+            i = block.rfind(b'\n')
+            if i >= 0:
+                return start + i + 1
+            pos = start
+    return 0
+
+def live_output_filename(output_path, filename_base, stage, filetype):
+    '''
+    Returns the file that append_live_output saves a processing stage to:
+    <filename_base>_live_raw.<ext> for the raw data and
+    <filename_base>_live_raw_<stage>.<ext> for the other stages and time
+    resolutions, which query finds along with the batch processed files.
+    '''
+    if filetype in ['hdf', 'h5']:
+        filetype = 'h5'
+    name = filename_base + '_live_raw'
+    if stage != 'raw':
+        name = name + '_' + stage
+    return os.path.join(output_path, name + '.' + filetype)
+
+def append_live_output(data, output_path, filename_base, instrument, stage,
+                       filetype, written):
+    '''
+    Appends timestamp indexed data to the output of a processing stage in
+    real-time mode, adding to the output of earlier runs. Files are named by
+    live_output_filename, and in a parquet dataset the stage is saved as
+    live_<stage>. Hdf files are written as tables, so only the new rows are
+    written.
+
+    If the data has columns which aren't saved yet (e.g. a supersaturation
+    seen for the first time), the saved data is read back and written again
+    with the new columns, which are blank in the saved rows apart from the
+    counts of resample_stats, which are 0. Pass the same dict as written with
+    each call; it keeps the saved columns of each stage.
+    '''
+    assert filetype in ['hdf', 'h5', 'csv', 'parquet'], \
+        'Real-time output must be hdf, h5, csv or parquet'
+    if len(data) == 0:
+        return
+    key = ARCHIVE_KEYS[instrument]
+    fname = live_output_filename(output_path, filename_base, stage, filetype)
+    parquet_stage = 'live_' + stage
+
+    if stage not in written:
+        # Pick up what a previous run has saved
+        written[stage] = {'columns': None, 'dates': set()}
+        if filetype == 'parquet':
+            stage_path = parquet_stage_path(output_path, instrument, parquet_stage)
+            if os.path.isdir(stage_path):
+                days = sorted(d for d in os.listdir(stage_path)
+                              if d.startswith(PARQUET_DAY_PARTITION + '='))
+                written[stage]['dates'] = set(d.split('=')[1] for d in days)
+                parts = sorted(f for f in os.listdir(os.path.join(stage_path, days[-1]))
+                               if f.endswith('.parquet')) if days else []
+                if parts:
+                    written[stage]['columns'] = list(pd.read_parquet(
+                        os.path.join(stage_path, days[-1], parts[-1])).columns)
+        elif os.path.isfile(fname):
+            if filetype == 'csv':
+                written[stage]['columns'] = list(pd.read_csv(fname, index_col=0,
+                                                             nrows=0).columns)
+            else:
+                with pd.HDFStore(fname, mode='r') as store:
+                    if '/' + key in store.keys():
+                        written[stage]['columns'] = list(
+                                store.select(key, start=0, stop=0).columns)
+
+    columns = written[stage]['columns']
+    if columns is not None and set(data.columns).issubset(columns):
+        # Append in the saved column order
+        data = data.reindex(columns=columns)
+        if filetype == 'parquet':
+            df_to_parquet(data, output_path, instrument, parquet_stage,
+                          append_dates=written[stage]['dates'])
+        elif filetype == 'csv':
+            data.to_csv(fname, mode='a', header=False,
+                        date_format='%Y-%m-%d %H:%M:%S')
+        else:
+            data.to_hdf(fname, key=key, format='table', append=True)
+        return
+
+    if columns is not None:
+        # New columns, so write everything again
+        print('New columns in the ' + stage + ' output, rewriting it')
+        saved = read_live_output(output_path, filename_base, instrument,
+                                 stage, filetype)
+        columns = list(data.columns) + [col for col in columns
+                                        if col not in data.columns]
+        counts = [col for col in data.columns
+                  if col.endswith('_count') and col not in saved.columns]
+        data = pd.concat([saved, data]).reindex(columns=columns)
+        data[counts] = data[counts].fillna(0).astype(np.int64)
+
+    written[stage]['columns'] = list(data.columns)
+    if filetype == 'parquet':
+        df_to_parquet(data, output_path, instrument, parquet_stage)
+        written[stage]['dates'] = set(data.index.strftime('%Y%m%d'))
+    elif filetype == 'csv':
+        data.to_csv(fname, date_format='%Y-%m-%d %H:%M:%S')
+    else:
+        # Strings are given at least the width of the CCN date and time
+        # strings, so that later rows fit
+        min_itemsize = {col: max(8, int(data[col].astype(str).str.len().max()))
+                        for col in data.columns if data[col].dtype == object}
+        data.to_hdf(fname, key=key, format='table', append=False,
+                    min_itemsize=min_itemsize)
+    return
+
+def read_live_output(output_path, filename_base, instrument, stage, filetype,
+                     start = None):
+    '''
+    Reads the output of a processing stage saved by append_live_output, from
+    start onwards, returning None if nothing has been saved yet
+    '''
+    if start is not None:
+        start = pd.Timestamp(start)
+
+    if filetype == 'parquet':
+        if not os.path.isdir(parquet_stage_path(output_path, instrument,
+                                                'live_' + stage)):
+            return None
+        return read_parquet(output_path, instrument, 'live_' + stage,
+                            start=start)
+
+    fname = live_output_filename(output_path, filename_base, stage, filetype)
+    if not os.path.isfile(fname):
+        return None
+    if filetype == 'csv':
+        data = pd.read_csv(fname, index_col=0, parse_dates=True)
+        if start is not None:
+            data = data[data.index >= start]
+        return data
+    return pd.read_hdf(fname, ARCHIVE_KEYS[instrument],
+                       where='index >= start' if start is not None else None)
+
+def start_writer():
+    '''
+    Starts a background writer, which saves data in a separate thread while
+    the processing carries on. Writes are queued with submit_write and done
+    one at a time in the order they were queued. Returns the state of the
+    writer, which is passed to the other writer functions.
+    '''
+    return {'pool': concurrent.futures.ThreadPoolExecutor(max_workers=1),
+            'pending': [],
+            'names': []}
+
+def submit_write(writer, fname, func, *args, **kwargs):
+    '''
+    Queues func(*args, **kwargs), which writes the file fname, on the
+    background writer. If writer is None, it's called straight away. An error
+    from an earlier write is raised here, or by wait_for_writes.
+
+    The data given must not be changed until it's written, so pass a copy if
+    the processing goes on to modify it in place.
+    '''
+    if writer is None:
+        func(*args, **kwargs)
+        return
+
+    # Raise the errors of the writes which have finished
+    done = [f for f in writer['pending'] if f.done()]
+    writer['pending'] = [f for f in writer['pending'] if not f.done()]
+    for f in done:
+        f.result()
+
+    writer['pending'].append(writer['pool'].submit(func, *args, **kwargs))
+    if fname is not None:
+        writer['names'].append(os.path.abspath(fname))
+    return
+
+def queued_files(writer, ext = None):
+    '''
+    Returns the files queued on the writer since it was last waited for, with
+    the extension ext if it's given, in the order they were queued
+    '''
+    if writer is None:
+        return []
+    return [f for f in writer['names']
+            if (ext is None) or f.endswith('.' + ext)]
+
+def wait_for_writes(writer):
+    '''
+    Waits until everything queued on the writer has been written, raising the
+    first error from the writes
+    '''
+    if writer is None:
+        return
+    pending = writer['pending']
+    writer['pending'] = []
+    writer['names'] = []
+    for f in pending:
+        f.result()
+    return
+
+def stop_writer(writer):
+    '''
+    Stops the background writer once the queued writes have finished. Errors
+    from writes which haven't been waited for aren't raised.
+    '''
+    if writer is not None:
+        writer['pool'].shutdown(wait=True)
+    return
+
+def start_memory_report():
+    '''
+    Starts tracing the memory allocated while processing, so the memory each
+    processing stage allocates can be printed by report_memory. Returns the
+    state of the report, which is passed to the other report functions.
+    '''
+    tracemalloc.start()
+    return {'current': tracemalloc.get_traced_memory()[0]}
+
+def report_memory(report, stage):
+    '''
+    Prints the memory allocated since the last stage reported, both what is
+    still held and the peak along the way, in MB. Does nothing if report is
+    None.
+    '''
+    if report is None:
+        return
+    current, peak = tracemalloc.get_traced_memory()
+    print('%s: %.1f MB allocated, %.1f MB peak' %
+          (stage, (current - report['current'])/1e6,
+           (peak - report['current'])/1e6))
+    tracemalloc.reset_peak()
+    report['current'] = current
+    return
+
+def stop_memory_report(report):
+    '''
+    Stops tracing the memory allocated, if report is given
+    '''
+    if report is not None:
+        tracemalloc.stop()
+    return
+
+def column_store(data, columns = None):
+    '''
+    Returns the data with its numeric columns held in a single float block,
+    followed by the columns in columns that the processing goes on to add,
+    which are allocated up front and filled with nan. The processing stages
+    can then fill in columns and set rows to nan in place, rather than each
+    stage allocating new blocks of data, and the data can be written out
+    without pandas first consolidating it into a copy.
+
+    Integer columns become float, as they do anyway once any of their rows
+    are set to nan. The columns which float32 holds exactly (see
+    exact_float_dtype), e.g. those of compact raw data, are held in a second
+    float32 block rather than being widened. Other columns, and the QC flags
+    (see qc_flags), are kept as they are.
+    '''
+    if columns is None:
+        columns = []
+    columns = [col for col in columns if col not in data.columns]
+    numeric = [col for col in data.columns
+               if col != QC_FLAG_COLUMN and data[col].dtype.kind in 'iuf']
+    narrow = [col for col in numeric
+              if exact_float_dtype(data[col].dtype) == np.float32]
+    wide = [col for col in numeric if col not in narrow] + columns
+
+    blocks = []
+    for cols, dtype in [(wide, np.float64), (narrow, np.float32)]:
+        if len(cols) == 0:
+            continue
+        values = np.empty((len(cols), len(data.index)), dtype = dtype)
+        for i, col in enumerate(cols):
+            if col in data.columns:
+                values[i] = data[col].to_numpy(dtype = dtype, na_value = np.nan)
+            else:
+                values[i] = np.nan
+        blocks.append(pd.DataFrame(values.T, index = data.index,
+                                   columns = cols, copy = False))
+    if len(blocks) == 0:
+        store = pd.DataFrame(index = data.index)
+    elif len(blocks) == 1:
+        store = blocks[0]
+    else:
+        store = pd.concat(blocks, axis = 1)[numeric + columns]
+
+    for i, col in enumerate(data.columns):
+        if col not in numeric:
+            store.insert(i, col, data[col])
+    return store
+
+def exact_float_dtype(dtype):
+    '''
+    Returns the float dtype a numeric column is held as once it's converted
+    to float: float32 for float32 columns and integers of up to 16 bits,
+    which it holds exactly, and float64 for anything else.
+    '''
+    dtype = np.dtype(dtype)
+    if dtype == np.float32 or (dtype.kind in 'iu' and dtype.itemsize <= 2):
+        return np.dtype(np.float32)
+    return np.dtype(np.float64)
+
+def set_column(data, column, values):
+    '''
+    Sets a column of the data to values, which are calculated from the data
+    so they are in the same order. A float column (e.g. of column_store) is
+    written in place at its own precision, without allocating a new block,
+    and any other column is replaced. Returns the data.
+    '''
+    values = np.asarray(values)
+    if column in data.columns and data[column].dtype.kind == 'f' and \
+       values.dtype.kind == 'f':
+        data.loc[:, column] = values.astype(data[column].dtype, copy = False)
+    else:
+        data[column] = values
+    return data
+
+def nonzero_divisor(divisor):
+    '''
+    Returns the divisor of an uncertainty term as an array with its zeros
+    set to nan, so that the uncertainty of those rows is nan rather than
+    infinite. nan divisors stay nan.
+    '''
+    divisor = np.asarray(divisor, dtype = float)
+    return np.where(divisor == 0, np.nan, divisor)
+
+def propagate_sigma(values, abs_sigma, divisor, sigma = None):
+    '''
+    Returns the uncertainty of values from an uncertainty term abs_sigma /
+    divisor, e.g. the counting uncertainty 1/sqrt(N) or the fit residual of
+    a flow calibration over the flow rate, combined in quadrature with the
+    relative uncertainty sigma / values they already had, if sigma is given.
+    Rows with nan in any of the inputs are nan. The uncertainty is
+    calculated in float64, whatever the precision of the inputs.
+    '''
+    values = np.asarray(values, dtype = float)
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        relative = (abs_sigma/np.asarray(divisor, dtype = float))**2
+        if sigma is not None:
+            relative = relative + (np.asarray(sigma, dtype = float)/values)**2
+        return values * relative**0.5
+
+def resample_sigma(abs_sigma, count, deviation):
+    '''
+    Returns the uncertainty of the statistics of each resampling period:
+    the propagated uncertainty abs_sigma (e.g. the root mean square of the
+    uncertainties in the period) over count, combined in quadrature with
+    the standard error deviation / sqrt(count). Periods with nan in any of
+    the inputs are nan.
+    '''
+    count = np.asarray(count, dtype = float)
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        return np.sqrt((np.asarray(abs_sigma, dtype = float)/count)**2
+                       + (np.asarray(deviation, dtype = float)/np.sqrt(count))**2)
+
+# Column holding the bitmask of the QC rules each row failed (see qc_flags)
+QC_FLAG_COLUMN = 'qc_flags'
+
+def qc_flags(data, rules, masks = None):
+    '''
+    Evaluates QC rules on the data, returning a uint32 array with bit i set
+    on the rows which fail rules[i]. Each rule is a dict of:
+        name     - name of the rule
+        column   - column the rule tests
+        setpoint - optional column of setpoints, in which case the absolute
+                   deviation of the column from its setpoint is tested
+        min, max - optional limits, with the rows below min or above max
+                   failing the rule
+    Rules which can't be written as limits (e.g. the removal of the SS
+    transitions of the CCNC) have no column, and are given as a boolean array
+    in masks, keyed by the name of the rule. Nans don't fail a rule.
+    '''
+    assert len(rules) <= 32, 'Only 32 QC rules fit in the flags'
+    flags = np.zeros(len(data), dtype=np.uint32)
+    with np.errstate(invalid='ignore'):
+        for bit, rule in enumerate(rules):
+            if 'column' not in rule:
+                failed = np.asarray(masks[rule['name']], dtype=bool)
+            else:
+                values = data[rule['column']].values.astype(float)
+                if 'setpoint' in rule:
+                    values = np.abs(values -
+                                    data[rule['setpoint']].values.astype(float))
+                failed = np.zeros(len(data), dtype=bool)
+                if rule.get('min') is not None:
+                    failed |= values < rule['min']
+                if rule.get('max') is not None:
+                    failed |= values > rule['max']
+            flags |= failed.astype(np.uint32) << np.uint32(bit)
+    return flags
+
+def apply_qc_flags(data, flags):
+    '''
+    Sets the rows of the data which failed any QC rule to nan in one step,
+    and keeps the flags from qc_flags in the QC_FLAG_COLUMN column so that
+    it's known why each row was removed. The data is modified in place.
+    '''
+    rejected = flags != 0
+    if rejected.any():
+        columns = [col for col in data.columns if col != QC_FLAG_COLUMN]
+        data.loc[rejected, columns] = np.nan
+    data[QC_FLAG_COLUMN] = flags
+    return data
+
+def qc_flag_counts(flags, index, rules, time):
+    '''
+    Counts the rows failing each of the QC rules in each period when
+    resampling to the time interval, from the flags made by qc_flags for the
+    timestamps in index. The periods are the same as those of resample_stats.
+    Returns a dataframe with a column of counts named qc_<rule name> for each
+    rule. Rows failing several rules are counted for each of them.
+    '''
+    flags = np.asarray(flags)
+    if flags.dtype.kind == 'f':
+        # Rows blanked along with their flags count as passing
+        flags = np.nan_to_num(flags)
+    flags = flags.astype(np.uint32)
+
+    labels, codes = resample_periods(index, time)
+    counts = {}
+    for bit, rule in enumerate(rules):
+        failed = (((flags >> np.uint32(bit)) & 1) == 1) & (codes >= 0)
+        counts['qc_' + rule['name']] = np.bincount(codes[failed],
+                                                   minlength=len(labels))
+    return pd.DataFrame(counts, index=labels)
+
+# Column of a stage diff flagging the rows which the stage set to nan
+STAGE_DIFF_BLANKED = '_blanked'
+
+def persisted_stages(persist_stages, stages):
+    '''
+    Interprets the persist_stages input of LoadAndProcess, which is 'all',
+    'none' (or None) or a list of the processing stages to save, returning
+    the list of stages to save in processing order
+    '''
+    if persist_stages is None or persist_stages == 'none':
+        return []
+    if persist_stages == 'all':
+        return list(stages)
+    if type(persist_stages) == str:
+        persist_stages = [persist_stages]
+    unknown = [s for s in persist_stages if s not in stages]
+    assert len(unknown) == 0, 'Unknown processing stages: ' + str(unknown)
+    return [s for s in stages if s in persist_stages]
+
+def stage_snapshot(data, columns):
+    '''
+    Returns what stage_diff needs of the data from before processing steps
+    which only set rows to nan, add columns, and change the given columns:
+    the names of all the columns and a copy of the given ones. This is much
+    smaller than a copy of the data.
+    '''
+    changed = [col for col in columns if col in data.columns]
+    return {'columns': list(data.columns), 'data': data[changed].copy()}
+
+def stage_diff(before, after):
+    '''
+    Returns the changes a processing step made to the data, as a dataframe
+    with the column STAGE_DIFF_BLANKED set to 1 on the rows which were set to
+    nan, and the columns which were added or changed. Columns the step left
+    alone aren't included, so the diff is much smaller than the data.
+    apply_stage_diff makes the data after the step from the data before it
+    and the diff.
+
+    before is the data from before the step, or a snapshot of it from
+    stage_snapshot, in which case only the columns kept in the snapshot are
+    compared and the others are taken to be unchanged.
+
+    The step must keep the rows of the data and add any columns after the
+    existing ones, as all the steps before splitting by supersaturation do.
+    The QC flags (see qc_flags) aren't blanked along with the rest of a row,
+    so they're left out when finding the blanked rows.
+    '''
+    if isinstance(before, dict):
+        columns = before['columns']
+        before = before['data']
+    else:
+        columns = list(before.columns)
+    if (not after.index.equals(before.index)) or \
+       (list(after.columns[:len(columns)]) != columns):
+        raise ValueError("The processing step changed the rows or the order "
+                         "of the columns, so it can't be saved as a diff")
+
+    blanked = after.drop(columns=QC_FLAG_COLUMN, errors='ignore') \
+                   .isnull().all(axis=1).values
+    diff = pd.DataFrame({STAGE_DIFF_BLANKED: blanked.astype(np.int8)},
+                        index=after.index)
+
+    for col in after.columns:
+        if col in columns and col not in before.columns:
+            continue
+        if col in before.columns:
+            a = before[col].values[~blanked]
+            b = after[col].values[~blanked]
+            if a.dtype.kind in 'biuf' and b.dtype.kind in 'biuf':
+                same = np.array_equal(a.astype(float), b.astype(float),
+                                      equal_nan=True)
+            else:
+                same = (a.dtype == b.dtype) and \
+                       pd.Series(a).equals(pd.Series(b))
+            if same:
+                continue
+        diff[col] = after[col]
+    return diff
+
+def apply_stage_diff(data, diff):
+    '''
+    Applies the changes saved by stage_diff to the data from before the
+    processing step, returning the data after it. The data is modified in
+    place.
+    '''
+    diff = diff.reindex(data.index)
+    blanked = (diff[STAGE_DIFF_BLANKED] == 1).values
+    if blanked.any():
+        columns = [col for col in data.columns if col != QC_FLAG_COLUMN]
+        data.loc[blanked, columns] = np.nan
+    for col in diff.columns:
+        if col != STAGE_DIFF_BLANKED:
+            data[col] = diff[col]
+    return data
+
+# Processing stages completed for each raw file by LoadAndProcess, kept in the
+# output directory in the same format as the file manifest
+CHECKPOINTS = 'checkpoints.jsonl'
+
+def _checkpoint_default(obj):
+    '''
+    Converts the checkpoint parameters which json can't, hashing the contents
+    of data frames rather than using their abbreviated repr
+    '''
+    if isinstance(obj, (pd.DataFrame, pd.Series)):
+        return hashlib.sha1(pd.util.hash_pandas_object(obj).values).hexdigest()
+    return str(obj)
+
+def checkpoint_file(path = None, fname = None):
+    '''
+    Returns the hash of the contents of a parameter file, such as a flow
+    calibration or mask period file, so that checkpoints made with it aren't
+    used once it has been edited. The file is found as in load_mask_periods.
+    '''
+    if fname is None:
+        return None
+    if not os.path.exists(fname) and path is not None:
+        fname = os.path.join(path, fname)
+    if not os.path.isfile(fname):
+        return fname
+    return file_hash(fname)
+
+def checkpoint_params(settings, stage_params):
+    '''
+    Returns a hash of the settings of a run and the parameters of the stages
+    in stage_params, a list of (stage, parameters) in processing order. The
+    checkpoint of a stage is made with the parameters of every stage up to
+    it, as they all went into its output.
+    '''
+    text = json.dumps([settings, stage_params], sort_keys = True,
+                      default = _checkpoint_default)
+    return hashlib.sha1(text.encode()).hexdigest()
+
+def read_checkpoints(output_path):
+    '''
+    Reads the checkpoints in output_path, returning a dict of records keyed by
+    (raw file path, stage). Each record holds the size and mtime of the raw
+    file, the hash of the parameters (see checkpoint_params), and the output
+    of the stage with its size and mtime and the time span of its data. As
+    with the file manifest, later records replace earlier ones and a line cut
+    short by an interrupted write is ignored.
+    '''
+    checkpoints = {}
+    fname = os.path.join(output_path, CHECKPOINTS)
+    if os.path.isfile(fname):
+        with open(fname, 'r') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                checkpoints[(record['path'], record['stage'])] = record
+    return checkpoints
+
+def submit_checkpoint(writer, checkpoint, stage, output = None, data = None):
+    '''
+    Queues a record of stage being completed on the writer (see submit_write),
+    so that it's only written once the output of the stage has been.
+    checkpoint holds the 'path' of the raw file, the 'output_path', and the
+    'settings' and 'stage_params' of the run (see checkpoint_params), or is
+    None if nothing is recorded. output is the file or parquet dataset the
+    stage was saved to, a list of them (e.g. the files of each resampling
+    interval), or None if it wasn't saved. The record lists the
+    stages which were run up to this one, which load_stage replays.
+    '''
+    if checkpoint is None:
+        return
+    stages = [s for s, params in checkpoint['stage_params']]
+    params = checkpoint_params(checkpoint['settings'],
+                               checkpoint['stage_params'][:stages.index(stage)+1])
+    fstat = os.stat(checkpoint['path'])
+    record = {'path': os.path.abspath(checkpoint['path']),
+              'size': fstat.st_size,
+              'mtime': fstat.st_mtime,
+              'stage': stage,
+              'stages': stages[:stages.index(stage)+1],
+              'params': params,
+              'output': None,
+              'start': None,
+              'end': None}
+    if isinstance(output, list):
+        record['output'] = [os.path.abspath(f) for f in output]
+    elif output is not None:
+        record['output'] = os.path.abspath(output)
+    if data is not None and len(data.index) > 0:
+        record['start'] = str(data.index.min())
+        record['end'] = str(data.index.max())
+    submit_write(writer, None, write_checkpoint, record,
+                 checkpoint['output_path'])
+    return
+
+def write_checkpoint(record, output_path):
+    '''
+    Appends a checkpoint record, adding the size and mtime of the output file
+    (or files) so that it isn't used if the file is overwritten later. The
+    record is synced to disk, as checkpoints are there for when the
+    processing is cut short.
+    '''
+    if isinstance(record['output'], list):
+        if all(os.path.isfile(f) for f in record['output']):
+            ostats = [os.stat(f) for f in record['output']]
+            record['output_size'] = [ostat.st_size for ostat in ostats]
+            record['output_mtime'] = [ostat.st_mtime for ostat in ostats]
+    elif record['output'] is not None and os.path.isfile(record['output']):
+        ostat = os.stat(record['output'])
+        record['output_size'] = ostat.st_size
+        record['output_mtime'] = ostat.st_mtime
+    with open(os.path.join(output_path, CHECKPOINTS), 'a') as f:
+        f.write(json.dumps(record) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+    return
+
+def resume_checkpoint(checkpoints, fname, settings, stage_params):
+    '''
+    Finds where the processing of the raw file fname can be resumed from,
+    given the checkpoints from read_checkpoints and the settings and
+    stage_params the processing will be run with. Returns the record of the
+    last stage which, along with every stage before it, was completed with
+    the same raw file and parameters, and whose output is still as it was
+    saved. Returns None if the file has to be processed from the start.
+    '''
+    path = os.path.abspath(fname)
+    fstat = os.stat(fname)
+    resume = None
+    for i, (stage, params) in enumerate(stage_params):
+        record = checkpoints.get((path, stage))
+        if record is None or record['size'] != fstat.st_size \
+                          or record['mtime'] != fstat.st_mtime \
+                          or record['params'] != checkpoint_params(
+                                            settings, stage_params[:i+1]):
+            break
+        if record['output'] is None:
+            # Completed, but not saved, so it can only be passed through
+            continue
+        outputs = record['output']
+        sizes = record.get('output_size')
+        mtimes = record.get('output_mtime')
+        if not isinstance(outputs, list):
+            outputs, sizes, mtimes = [outputs], [sizes], [mtimes]
+        if not all(os.path.exists(f) for f in outputs):
+            break
+        if 'output_size' in record:
+            ostats = [os.stat(f) for f in outputs]
+            if [ostat.st_size for ostat in ostats] != sizes \
+                        or [ostat.st_mtime for ostat in ostats] != mtimes:
+                break
+        resume = record
+    return resume
+
+def resumed_stages(resumed, stage_params):
+    '''
+    Returns the stages in stage_params up to and including that of the
+    checkpoint record resumed (see resume_checkpoint), which don't need to be
+    run again
+    '''
+    if resumed is None:
+        return []
+    stages = [s for s, params in stage_params]
+    return stages[:stages.index(resumed['stage'])+1]
@@ -0,0 +1,125 @@
+'''
+Tests of the size distribution mode fitting
+'''
+import os
+import sys
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import Aero_SizeDist
+
+
+class TestWarmStart(unittest.TestCase):
+
+    def setUp(self):
+        self.x = np.arange(40)
+        self.y = Aero_SizeDist.gaussian(self.x, 1000, 18, 6) \
+            + np.random.default_rng(0).normal(0, 10, 40)
+
+    def test_warm_start_from_previous_fit(self):
+        cold = Aero_SizeDist._curve_fit_mode(self.x, self.y)[0]
+        warm = Aero_SizeDist._curve_fit_mode(self.x, self.y, [900, 17, 5])[0]
+        np.testing.assert_allclose(warm, [cold[0], cold[1], abs(cold[2])],
+                                   rtol=1e-5)
+
+    def test_unusable_previous_fit_starts_cold(self):
+        # A zero width would make the lower and upper bounds equal
+        cold = Aero_SizeDist._curve_fit_mode(self.x, self.y)
+        for p0 in [[900, 17, 0], [900, 17, np.nan], [np.inf, 17, 5]]:
+            warm = Aero_SizeDist._curve_fit_mode(self.x, self.y, p0)
+            np.testing.assert_array_equal(warm[0], cold[0])
+            self.assertEqual(warm[2], cold[2])
+
+
+def multimodal_spectra(centres, seed = 0):
+    '''
+    Size distributions of 107 bins, each the sum of three gaussian modes
+    centred on the given bins, with a little noise
+    '''
+    x = np.arange(107)
+    z = np.array([Aero_SizeDist.gaussian(x, 1000, c0, 8)
+                  + Aero_SizeDist.gaussian(x, 600, c1, 8)
+                  + Aero_SizeDist.gaussian(x, 300, c2, 6)
+                  for c0, c1, c2 in centres])
+    return z + np.random.default_rng(seed).normal(0, 1, z.shape)
+
+
+class TestBatchFit(unittest.TestCase):
+
+    def setUp(self):
+        self.centres = [(10, 60, 95), (16, 66, 97), (22, 70, 95), (13, 63, 96)]
+        self.z = multimodal_spectra(self.centres)
+        self.size_arr = np.logspace(1, np.log10(500), 107)
+
+    def serial_fit(self, HR_fit):
+        fits = []
+        for dist_arr in self.z:
+            fit = Aero_SizeDist._mode_max_from_dist_fit_worker(
+                dist_arr, self.size_arr, plot=False, HR_fit=HR_fit)
+            fits.append(list(fit) + [np.nan] * (4 - len(fit)))
+        return np.array(fits, dtype=float)
+
+    def test_batch_matches_curve_fit(self):
+        known = self.size_arr[np.array(self.centres)]
+        for HR_fit in [True, False]:
+            with self.subTest(HR_fit=HR_fit):
+                batch = Aero_SizeDist._mode_max_from_dist_fit_batch(
+                    self.z, self.size_arr, HR_fit=HR_fit)
+                serial = self.serial_fit(HR_fit)
+                # Only the first three modes are returned without HR_fit
+                n = 4 if HR_fit else 3
+                np.testing.assert_allclose(batch[:, :n], serial[:, :n],
+                                           rtol=1e-3)
+                np.testing.assert_allclose(batch[:, :3], known, rtol=0.01)
+                # The fourth mode is only used when the first mode is missing
+                self.assertTrue(np.isnan(batch[:, 3]).all())
+
+
+class TestParallelFit(unittest.TestCase):
+
+    def setUp(self):
+        self.centres = [(10 + i % 12, 60 + i % 10, 95 + i % 3)
+                        for i in range(12)]
+        self.z = multimodal_spectra(self.centres)
+        # curve_fit raises a ValueError for this row, which should only
+        # leave the row itself as nan
+        self.bad_row = 5
+        self.z[self.bad_row, 30] = np.inf
+        self.size_arr = np.logspace(1, np.log10(500), 107)
+
+    def serial_fit(self, HR_fit):
+        fits = np.full((len(self.z), 4), np.nan)
+        for i, dist_arr in enumerate(self.z):
+            if i == self.bad_row:
+                continue
+            fit = Aero_SizeDist._mode_max_from_dist_fit_worker(
+                dist_arr, self.size_arr, plot=False, HR_fit=HR_fit)
+            fits[i, :len(fit)] = fit
+        return fits
+
+    def test_parallel_matches_serial(self):
+        for batch in [True, False]:
+            for HR_fit in [True, False]:
+                with self.subTest(batch=batch, HR_fit=HR_fit):
+                    calls = []
+                    parallel = Aero_SizeDist._mode_max_from_dist_fit_parallel(
+                        self.z, self.size_arr, HR_fit, batch, 2,
+                        progress=lambda done, total: calls.append((done, total)))
+                    if batch:
+                        serial = Aero_SizeDist._mode_max_from_dist_fit_batch(
+                            self.z, self.size_arr, HR_fit=HR_fit)
+                    else:
+                        serial = self.serial_fit(HR_fit)
+                        self.assertTrue(np.isnan(parallel[self.bad_row]).all())
+                    np.testing.assert_array_equal(parallel, serial)
+
+                    # 12 rows in blocks of 2, one call per block
+                    self.assertEqual(len(calls), 6)
+                    self.assertEqual([c[0] for c in calls], list(range(2, 13, 2)))
+                    self.assertTrue(all(c[1] == 12 for c in calls))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,198 @@
+'''
+Tests of the shared processing functions in atmoscripts
+'''
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import atmoscripts
+
+
+def mad(x):
+    # MAD as calculated before resample_stats
+    return np.fabs(x - x.median()).median()
+
+
+def random_series(n=5000, seed=0):
+    '''
+    Two columns of one second data with nans, repeated values, a gap of a few
+    periods and, in the second column, infinite values
+    '''
+    rng = np.random.default_rng(seed)
+    index = pd.date_range('2017-03-23 00:00:07', periods=n, freq='1s', name='timestamp')
+    index = index[(index < '2017-03-23 00:20') | (index > '2017-03-23 00:35')]
+    data = pd.DataFrame({'a': np.round(rng.normal(100, 30, len(index)), 1),
+                         'b': rng.integers(0, 20, len(index)).astype(float)},
+                        index=index)
+    data.loc[rng.random(len(index)) < 0.05, 'a'] = np.nan
+    data.iloc[::97, 1] = np.inf
+    data.iloc[::401, 1] = -np.inf
+    return data
+
+
+class TestResampleStats(unittest.TestCase):
+
+    def assertMatchesPandas(self, data, time):
+        stats = ['med', 'mad', 'avg', 'std', 'count', 'rmsn', 'min', 'max']
+        result = atmoscripts.resample_stats(data, time, stats)
+        for column in data:
+            resampled = data[column].resample(time)
+            with np.errstate(invalid='ignore'):
+                expected = pd.DataFrame({
+                    'med': resampled.median(),
+                    'mad': resampled.apply(mad),
+                    'avg': resampled.mean(),
+                    'std': resampled.std(),
+                    'count': resampled.count(),
+                    'rmsn': np.sqrt((data[column]**2).resample(time).sum()),
+                    'min': resampled.min(),
+                    'max': resampled.max()})
+            for stat in stats:
+                name = column + '_' + stat
+                np.testing.assert_array_equal(result.index, expected.index)
+                if stat in ['avg', 'std', 'rmsn']:
+                    np.testing.assert_allclose(result[name], expected[stat],
+                                               rtol=1e-12, err_msg=name)
+                else:
+                    np.testing.assert_array_equal(result[name], expected[stat],
+                                                  err_msg=name)
+
+    def test_matches_pandas(self):
+        data = random_series()
+        for time in ['10s', '1min', '7min', '1h']:
+            self.assertMatchesPandas(data, time)
+
+    def test_infinite_values(self):
+        # The infinite values sort to the ends of their periods rather than
+        # scrambling the order of the periods
+        data = random_series()[['b']]
+        self.assertMatchesPandas(data, '1min')
+        result = atmoscripts.resample_stats(data, '1min', ['min', 'max'])
+        self.assertTrue(np.isneginf(result['b_min']).any())
+        self.assertTrue(np.isposinf(result['b_max']).any())
+
+
+class TestParquet(unittest.TestCase):
+
+    def test_chunks_append_to_days(self):
+        data = pd.DataFrame({'a': np.arange(48.)},
+                            index=pd.date_range('2017-03-23', periods=48,
+                                                freq='1h', name='timestamp'))
+        with tempfile.TemporaryDirectory() as path:
+            # The middle chunk is added to both days
+            written = set()
+            for chunk in [data.iloc[:10], data.iloc[10:30], data.iloc[30:]]:
+                atmoscripts.df_to_parquet(chunk, path, 'CCN', 'QC',
+                                          append_dates=written)
+            result = atmoscripts.read_parquet(path, 'CCN', 'QC')
+            pd.testing.assert_frame_equal(data, result, check_freq=False)
+
+            # Without append_dates, a day's data replaces what was saved
+            later = data.iloc[40:] + 100
+            atmoscripts.df_to_parquet(later, path, 'CCN', 'QC')
+            result = atmoscripts.read_parquet(path, 'CCN', 'QC')
+            pd.testing.assert_frame_equal(pd.concat([data.iloc[:24], later]),
+                                          result, check_freq=False)
+
+    def test_columns_of_later_days(self):
+        data = pd.DataFrame({'a': np.arange(48.), 'b': np.nan},
+                            index=pd.date_range('2017-03-23', periods=48,
+                                                freq='1h', name='timestamp'))
+        data.iloc[24:, 1] = 1.0
+        with tempfile.TemporaryDirectory() as path:
+            atmoscripts.df_to_parquet(data.iloc[:24][['a']], path, 'CCN', 'QC')
+            atmoscripts.df_to_parquet(data.iloc[24:], path, 'CCN', 'QC')
+            result = atmoscripts.read_parquet(path, 'CCN', 'QC')
+            pd.testing.assert_frame_equal(data, result, check_freq=False)
+
+
+class TestQuery(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        # Two days of hourly data in an hdf table and a fixed format file,
+        # along with the files of another stage and a time resolution
+        self.data = pd.DataFrame({'a': np.arange(48.), 'b': np.arange(48.)*2},
+                                 index=pd.date_range('2017-03-23', periods=48,
+                                                     freq='1h', name='timestamp'))
+        self.data.iloc[:24].to_hdf(self.fname('CCN_raw_170323_QC.h5'),
+                                   key='ccn', format='table')
+        self.data.iloc[24:].to_hdf(self.fname('CCN_raw_170324_QC.h5'), key='ccn',
+                                   format='fixed')
+        self.data.to_hdf(self.fname('CCN_raw_170323_QC_flowCal.h5'), key='ccn',
+                         format='fixed')
+        self.data.to_hdf(self.fname('CCN_raw_170323_1h.h5'), key='ccn',
+                         format='fixed')
+        atmoscripts.df_to_parquet(self.data, self.path, 'CCN', 'QC')
+
+    def tearDown(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def fname(self, name):
+        return os.path.join(self.path, name)
+
+    def test_time_range_across_files(self):
+        ranges = [(None, None),
+                  ('2017-03-23 23:00', '2017-03-24 00:00'),
+                  ('2017-03-24 00:00', None),
+                  (None, '2017-03-24 00:00'),
+                  ('2017-03-23 12:00', '2017-03-24 12:00'),
+                  ('2017-03-23 23:30', '2017-03-23 23:45')]
+        for filetype in ['h5', 'parquet']:
+            for start, end in ranges:
+                for columns in [None, ['b']]:
+                    with self.subTest(filetype=filetype, start=start, end=end,
+                                      columns=columns):
+                        expected = self.data
+                        if start is not None:
+                            expected = expected[expected.index >= start]
+                        if end is not None:
+                            expected = expected[expected.index < end]
+                        if columns is not None:
+                            expected = expected[columns]
+                        result = atmoscripts.query(self.path, 'CCN', 'QC',
+                                                   start, end, columns,
+                                                   filetype=filetype)
+                        if len(expected) == 0:
+                            # No files are read for a gap between them
+                            self.assertEqual(len(result), 0)
+                        else:
+                            pd.testing.assert_frame_equal(expected, result,
+                                                          check_freq=False)
+
+    def test_resolution(self):
+        result = atmoscripts.query(self.path, 'CCN', resolution='1h',
+                                   start='2017-03-24')
+        pd.testing.assert_frame_equal(self.data.iloc[24:], result,
+                                      check_freq=False)
+
+    def test_only_files_in_range_are_read(self):
+        with mock.patch.object(atmoscripts.pd, 'read_hdf',
+                               wraps=pd.read_hdf) as read:
+            atmoscripts.query(self.path, 'CCN', 'QC', start='2017-03-24')
+        self.assertEqual([c.args[0] for c in read.call_args_list],
+                         [self.fname('CCN_raw_170324_QC.h5')])
+
+    def test_index_follows_changed_files(self):
+        atmoscripts.query(self.path, 'CCN', 'QC')
+        self.assertTrue(os.path.isfile(self.fname('ccn_' + atmoscripts.ARCHIVE_INDEX)))
+
+        # A day added to the table is found, as is a removed file
+        later = pd.DataFrame({'a': [1., 2.], 'b': [3., 4.]},
+                             index=pd.to_datetime(['2017-03-26 00:00', '2017-03-26 01:00']))
+        later.to_hdf(self.fname('CCN_raw_170323_QC.h5'), key='ccn',
+                     format='table', append=True)
+        os.remove(self.fname('CCN_raw_170324_QC.h5'))
+        result = atmoscripts.query(self.path, 'CCN', 'QC', start='2017-03-24')
+        pd.testing.assert_frame_equal(later, result, check_names=False)
+
+
+if __name__ == '__main__':
+    unittest.main()
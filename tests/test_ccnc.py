@@ -0,0 +1,531 @@
+'''
+Tests of the CCNC processing, run on small synthetic raw files
+'''
+import io
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import atmoscripts
+from Instruments import CCNC
+
+
+def ccn_columns(t0, rows, rng):
+    '''
+    Returns a dict of the raw CCNC columns of rows one second apart starting
+    at t0, alternating between 0.2 and 0.4 % SS every ten minutes. A few rows
+    fail the T3 and concentration checks of DataQC.
+    '''
+    times = t0 + pd.to_timedelta(np.arange(rows), 's')
+    columns = {'Time': times.strftime('%H:%M:%S'),
+               'Current SS': np.where((np.arange(rows)//600) % 2, 0.2, 0.4),
+               'Temps Stabilized': np.ones(rows, int),
+               'Delta T': np.full(rows, 5.0)}
+    defaults = [25, 25, 27, 27, 30, 30, 25, 25, 25, 25, 30, 30, 25, 50,
+                500, 800, 100, 0, 1, 1]
+    for name, value in zip(CCNC.CCN_COLNAMES[4:24], defaults):
+        columns[name] = np.round(value + rng.normal(0, 0.02, rows), 2)
+    columns['overflow'] = np.zeros(rows, int)
+    columns['T3 Read'][::700] += 3
+    columns['Bin #'] = np.full(rows, 3)
+    for name in CCNC.CCN_COLNAMES[25:45]:
+        columns[name] = rng.integers(0, 10, rows)
+    columns['CCN Number Conc'] = np.round(rng.uniform(50, 800, rows), 2)
+    columns['CCN Number Conc'][::911] = 5
+    for name in ['Valve Set', 'Alarm Code', 'Alarm Sum']:
+        columns[name] = np.zeros(rows, int)
+    return columns
+
+
+def write_ccn_csv(path, start='2017-03-23', days=2, rows=3000, seed=0):
+    '''
+    Writes days of raw CCNC csv files to path, with the rows of ccn_columns
+    starting at midnight
+    '''
+    rng = np.random.default_rng(seed)
+    for day in range(days):
+        t0 = pd.Timestamp(start) + pd.Timedelta(days=day)
+        data = pd.DataFrame(ccn_columns(t0, rows, rng))[CCNC.CCN_COLNAMES]
+
+        fname = os.path.join(path, 'CCN 100 data %s000000.csv' % t0.strftime('%y%m%d'))
+        with open(fname, 'w') as f:
+            f.writelines(['Version, 1\n', 'Date, %s\n' % t0.strftime('%m/%d/%y'),
+                          'x\n', 'x\n', 'x\n', 'Time,cols\n'])
+            data.to_csv(f, header=False, index=False)
+
+
+def processing_kwargs(path, **kwargs):
+    '''
+    Arguments of LoadAndProcess running every stage on the files in path
+    '''
+    flows = pd.DataFrame({'flow rate': [480., 490., 500., 495.]},
+                         index=pd.to_datetime(['2017-03-22', '2017-03-23',
+                                               '2017-03-24', '2017-03-25']))
+    mask = pd.DataFrame({'Start': [pd.Timestamp('2017-03-23 00:10')],
+                         'End': [pd.Timestamp('2017-03-23 00:20')]})
+    processing = dict(ccn_raw_path=path,
+                      ccn_output_path=path,
+                      ccn_output_filetype='h5',
+                      concat_file_frequency='daily',
+                      QC=True,
+                      flow_cal_df=flows,
+                      mask_period_timestamp_df=mask,
+                      output_time_resolution=['1min', '1h'])
+    processing.update(kwargs)
+    return processing
+
+
+def read_outputs(path):
+    '''
+    Reads each h5 file in path
+    '''
+    return {f: pd.read_hdf(os.path.join(path, f))
+            for f in sorted(os.listdir(path)) if f.endswith('.h5')}
+
+
+class CCNTestCase(unittest.TestCase):
+    '''
+    Gives each test a temporary directory, and restores the working directory
+    which the processing changes
+    '''
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def raw_dir(self, name, **kwargs):
+        path = os.path.join(self.tmp, name)
+        os.makedirs(path)
+        write_ccn_csv(path, **kwargs)
+        return path
+
+    def assertOutputsEqual(self, expected, result):
+        self.assertEqual(sorted(expected), sorted(result))
+        for f in expected:
+            pd.testing.assert_frame_equal(expected[f], result[f], obj=f)
+
+
+class TestStream(CCNTestCase):
+
+    def test_chunked_matches_whole_file(self):
+        whole = self.raw_dir('whole')
+        CCNC.LoadAndProcess(**processing_kwargs(whole, background_writes=False))
+
+        for background_writes in [True, False]:
+            with self.subTest(background_writes=background_writes):
+                chunked = self.raw_dir('chunked_%s' % background_writes)
+                CCNC.LoadAndProcess(**processing_kwargs(
+                        chunked, stream_chunk='15min',
+                        background_writes=background_writes))
+                self.assertOutputsEqual(read_outputs(whole),
+                                        read_outputs(chunked))
+
+
+class TestParallelRead(CCNTestCase):
+
+    def test_workers_match_serial(self):
+        path = self.raw_dir('raw', days=3, rows=1000)
+        filelist = sorted(os.path.join(path, f) for f in os.listdir(path))
+        for compact in [False, True]:
+            with self.subTest(compact=compact):
+                kwargs = dict(skip_rows=[0, 10, 0], compact=compact)
+                serial = CCNC.read_ccn_csv_files(filelist, **kwargs)
+                parallel = CCNC.read_ccn_csv_files(filelist, workers=2, **kwargs)
+                self.assertEqual(len(parallel), 3)
+                for expected, result in zip(serial, parallel):
+                    pd.testing.assert_frame_equal(expected, result)
+
+
+class TestParquet(CCNTestCase):
+
+    def test_parquet_matches_h5(self):
+        h5 = self.raw_dir('h5', rows=1500)
+        CCNC.LoadAndProcess(**processing_kwargs(h5))
+        # The output of each stage over both days. The 0.2 % SS is masked on
+        # the first day, so only the second day has its columns.
+        expected = {}
+        for f, data in read_outputs(h5).items():
+            stage = f[:-3].split('_')[-1]
+            if not stage.isdigit():
+                expected[stage] = pd.concat([expected.get(stage), data])
+
+        # In chunks, each chunk is added to its day's partition
+        for stream_chunk in [None, '15min']:
+            with self.subTest(stream_chunk=stream_chunk):
+                path = self.raw_dir('parquet_%s' % stream_chunk, rows=1500)
+                CCNC.LoadAndProcess(**processing_kwargs(
+                        path, ccn_output_filetype='parquet',
+                        stream_chunk=stream_chunk))
+                for stage, data in expected.items():
+                    result = CCNC.query(path, stage, filetype='parquet')
+                    pd.testing.assert_frame_equal(data, result, obj=stage,
+                                                  check_freq=False)
+
+
+class TestQuery(CCNTestCase):
+
+    def test_time_range_across_daily_files(self):
+        path = self.raw_dir('raw', rows=1500)
+        CCNC.LoadAndProcess(**processing_kwargs(path))
+        outputs = read_outputs(path)
+
+        # The last rows of the first day's file and the first of the second's
+        columns = ['CCN Number Conc', atmoscripts.QC_FLAG_COLUMN]
+        start = pd.Timestamp('2017-03-23 00:24:58')
+        end = pd.Timestamp('2017-03-24 00:00:02')
+        qc = pd.concat([outputs['CCN_raw_170323_QC.h5'],
+                        outputs['CCN_raw_170324_QC.h5']])
+        expected = qc[(qc.index >= start) & (qc.index < end)][columns]
+        self.assertEqual(len(expected), 4)
+        result = CCNC.query(path, 'QC', start, end, columns)
+        pd.testing.assert_frame_equal(expected, result)
+
+        result = CCNC.query(path, resolution='1min', start='2017-03-24')
+        pd.testing.assert_frame_equal(outputs['CCN_raw_170324_1min.h5'], result,
+                                      check_freq=False)
+
+
+class TestLongLayout(CCNTestCase):
+
+    def test_long_pivots_to_wide(self):
+        wide_path = self.raw_dir('wide', rows=1500)
+        CCNC.LoadAndProcess(**processing_kwargs(wide_path))
+        long_path = self.raw_dir('long', rows=1500)
+        CCNC.LoadAndProcess(**processing_kwargs(long_path, ss_layout='long'))
+        wide = read_outputs(wide_path)
+        long = read_outputs(long_path)
+
+        split = [f for f in wide if f.endswith('_ssSplit.h5')]
+        self.assertEqual(len(split), 2)
+        for f in split:
+            pivoted = long[f].pivot(columns='ss', values='ccn')
+            pivoted.columns = ['ccn_' + str(ss) for ss in pivoted.columns]
+            ccn_cols = [c for c in wide[f] if c != 'ccn_sigma']
+            pd.testing.assert_frame_equal(pivoted[ccn_cols], wide[f][ccn_cols],
+                                          obj=f)
+            pd.testing.assert_series_equal(long[f]['ccn_sigma'],
+                                           wide[f]['ccn_sigma'], obj=f)
+
+        # The resampled statistics of each SS
+        resampled = [f for f in wide if f.endswith(('_1min.h5', '_1h.h5'))]
+        self.assertEqual(len(resampled), 4)
+        for f in resampled:
+            for stat in ['med', 'mad', 'avg', 'std', 'count']:
+                pivoted = long[f].pivot(columns='ss', values='ccn_' + stat)
+                pivoted.columns = ['ccn_%s_%s' % (ss, stat)
+                                   for ss in pivoted.columns]
+                expected = wide[f][pivoted.columns]
+                # The long layout has no rows for intervals without data
+                pivoted = pivoted.reindex(expected.index)
+                if stat == 'count':
+                    pivoted = pivoted.fillna(0).astype(expected.dtypes)
+                pd.testing.assert_frame_equal(pivoted, expected,
+                                              obj=f + ' ' + stat)
+
+
+class TestManifest(CCNTestCase):
+
+    def test_manifest_written_to_output_path(self):
+        raw = self.raw_dir('raw', days=1, rows=600)
+        out = os.path.join(self.tmp, 'out')
+        os.makedirs(out)
+        CCNC.Load_to_HDF(raw, out)
+        self.assertTrue(os.path.isfile(atmoscripts.manifest_path(out)))
+        self.assertFalse(os.path.isfile(atmoscripts.manifest_path(raw)))
+
+
+class TestCascade(CCNTestCase):
+
+    def test_cascade_exact_matches_direct_resampling(self):
+        direct = self.raw_dir('direct')
+        CCNC.LoadAndProcess(**processing_kwargs(direct))
+
+        cascade = self.raw_dir('cascade')
+        CCNC.LoadAndProcess(**processing_kwargs(cascade, cascade_resample=True,
+                                                cascade_exact=['1h']))
+
+        expected = read_outputs(direct)
+        result = read_outputs(cascade)
+        self.assertEqual(sorted(expected), sorted(result))
+        for f in expected:
+            # The other statistics are merged, so only equal up to rounding
+            pd.testing.assert_frame_equal(expected[f], result[f], obj=f,
+                                          check_exact=False, rtol=1e-12)
+
+
+class TestStageDiff(CCNTestCase):
+
+    def assertStagesRebuilt(self, **kwargs):
+        full = self.raw_dir('full', days=1, rows=1500)
+        CCNC.LoadAndProcess(**processing_kwargs(full, background_writes=False,
+                                                **kwargs))
+        stages = [f[:-3].split('_')[-1] for f in sorted(os.listdir(full))
+                  if f.startswith('CCN_raw_170323_') and not f.endswith('1h.h5')]
+        self.assertGreater(len(stages), 0)
+
+        # The diffs are written in place of the stages as they run, so also
+        # in the background while the next stage works on the data
+        for background_writes in [True, False]:
+            with self.subTest(background_writes=background_writes):
+                diff = self.raw_dir('diff_%s' % background_writes,
+                                    days=1, rows=1500)
+                CCNC.LoadAndProcess(**processing_kwargs(
+                        diff, stage_format='diff',
+                        background_writes=background_writes, **kwargs))
+                for stage in stages:
+                    expected = pd.read_hdf(os.path.join(
+                            full, [f for f in os.listdir(full)
+                                   if f.endswith('_' + stage + '.h5')][0]))
+                    result = CCNC.load_stage(diff, stage, 'CCN_raw_170323.h5')
+                    pd.testing.assert_frame_equal(expected, result, obj=stage)
+
+    def test_diffs_rebuild_every_stage(self):
+        self.assertStagesRebuilt(output_time_resolution=['1h'])
+
+    def test_diffs_rebuild_stages_which_ran(self):
+        self.assertStagesRebuilt(QC=False, flow_cal_df=None,
+                                 output_time_resolution=['1h'])
+
+
+class TestResume(CCNTestCase):
+
+    def test_resume_after_split_matches_uncut_run(self):
+        for stage_format, background_writes in [('full', True), ('full', False),
+                                                ('diff', True), ('diff', False)]:
+            with self.subTest(stage_format=stage_format,
+                              background_writes=background_writes):
+                name = '%s_%s' % (stage_format, background_writes)
+                processing = dict(stage_format=stage_format, resume=True,
+                                  background_writes=background_writes)
+                uncut = self.raw_dir('uncut_' + name, days=1)
+                CCNC.LoadAndProcess(**processing_kwargs(uncut, **processing))
+
+                # Cut short while resampling, after every stage was saved
+                cut = self.raw_dir('cut_' + name, days=1)
+                with mock.patch.object(CCNC, 'timebase_resampler',
+                                       side_effect=KeyboardInterrupt):
+                    with self.assertRaises(KeyboardInterrupt):
+                        CCNC.LoadAndProcess(**processing_kwargs(cut, **processing))
+                with mock.patch.object(CCNC, 'ss_split',
+                                       wraps=CCNC.ss_split) as split:
+                    CCNC.LoadAndProcess(**processing_kwargs(cut, **processing))
+                self.assertEqual(split.call_count,
+                                 1 if stage_format == 'diff' else 0)
+
+                self.assertOutputsEqual(read_outputs(uncut), read_outputs(cut))
+
+    def test_removed_resampled_output_is_made_again(self):
+        path = self.raw_dir('raw', days=1)
+        CCNC.LoadAndProcess(**processing_kwargs(path, resume=True))
+        expected = read_outputs(path)
+
+        os.remove(os.path.join(path, 'CCN_raw_170323_1h.h5'))
+        CCNC.LoadAndProcess(**processing_kwargs(path, resume=True))
+        self.assertOutputsEqual(expected, read_outputs(path))
+
+
+def DataQC_loop(CCNC_data, FlowRatio=10.0, T1diffLim=0.25, T2diffLim=0.25,
+                T3diffLim=0.15, NafionTdiffLim=0.3, OPCT1diffLim=1,
+                ss_carry=None, ss_settle_time=CCNC.SS_SETTLE_TIME):
+    '''
+    DataQC as it was before the QC rules were declared, setting the rows
+    failing each check to nan in turn. The OPC temperature limit is taken
+    from OPCT1diffLim, where it used to be fixed at its default of 1.
+    '''
+    CCNC_data = CCNC.ss_transition_removal(CCNC_data.copy(), ss_carry,
+                                           ss_settle_time)
+    with np.errstate(invalid='ignore'):
+        CCNC_data.loc[CCNC_data['Alarm Code'] > 0] = np.nan
+        CCNC_data.loc[CCNC_data['CCN Number Conc'] < 10] = np.nan
+        CCNC_data.loc[CCNC_data['CCN Number Conc'] > 5000] = np.nan
+        CCNC_data['Flow Ratio'] = \
+                        CCNC_data['Sheath Flow'] / CCNC_data['Sample Flow']
+        CCNC_data.loc[CCNC_data['Flow Ratio'] > (FlowRatio + 2)] = np.nan
+        CCNC_data.loc[CCNC_data['Flow Ratio'] < (FlowRatio - 2)] = np.nan
+        CCNC_data.loc[CCNC_data['Current SS'] < 0] = np.nan
+        CCNC_data.loc[CCNC_data['Laser Current'] > 120] = np.nan
+        CCNC_data.loc[CCNC_data['Laser Current'] < 80] = np.nan
+        for read, setpt, lim in [('T1 Read', 'T1 Set', T1diffLim),
+                                 ('T2 Read', 'T2 Set', T2diffLim),
+                                 ('T3 Read', 'T3 Set', T3diffLim),
+                                 ('T Nafion', 'Nafion Set', NafionTdiffLim),
+                                 ('T OPC', 'OPC Set', OPCT1diffLim)]:
+            CCNC_data.loc[abs(CCNC_data[setpt] - CCNC_data[read]) > lim] = np.nan
+    return CCNC_data
+
+
+def qc_test_data(rows=4000, seed=2):
+    '''
+    Raw CCNC data where some rows fail each of the QC rules, some of them
+    several at once
+    '''
+    rng = np.random.default_rng(seed)
+    columns = ccn_columns(pd.Timestamp('2017-03-23'), rows, rng)
+    columns['Alarm Code'][rng.choice(rows, 20)] = 1
+    columns['CCN Number Conc'][rng.choice(rows, 20)] = 6000
+    columns['Sheath Flow'][rng.choice(rows, 20)] = 300
+    columns['Sample Flow'][rng.choice(rows, 20)] = 35
+    columns['Current SS'][rng.choice(rows, 20)] = -0.1
+    columns['Laser Current'][rng.choice(rows, 20)] = 130
+    columns['Laser Current'][rng.choice(rows, 20)] = 70
+    for name in ['T1 Read', 'T2 Read', 'T Nafion', 'T OPC']:
+        columns[name][rng.choice(rows, 20)] += 2
+    columns['T OPC'][rng.choice(rows, 20)] += 0.6
+    columns['CCN Number Conc'][rng.choice(rows, 20)] = np.nan
+    data = pd.DataFrame(columns)[CCNC.CCN_COLNAMES[1:]]
+    data.index = pd.Timestamp('2017-03-23') + pd.to_timedelta(np.arange(rows), 's')
+    return data
+
+
+class TestDataQC(unittest.TestCase):
+
+    def test_matches_loop(self):
+        for kwargs in [{}, {'OPCT1diffLim': 0.5, 'ss_settle_time': 1}]:
+            with self.subTest(**kwargs):
+                expected = DataQC_loop(qc_test_data(), **kwargs)
+                result = CCNC.DataQC(qc_test_data(), **kwargs)
+
+                flags = result.pop(atmoscripts.QC_FLAG_COLUMN).values
+                pd.testing.assert_frame_equal(expected, result)
+                # The rows with flags are the ones removed
+                np.testing.assert_array_equal(flags != 0,
+                                              expected.isnull().all(axis=1).values)
+
+
+class TestQCCounts(CCNTestCase):
+
+    def test_counts_of_rows_failing_each_rule(self):
+        plain = self.raw_dir('plain', days=1)
+        CCNC.LoadAndProcess(**processing_kwargs(plain))
+        counted = self.raw_dir('counted', days=1)
+        CCNC.LoadAndProcess(**processing_kwargs(counted, qc_counts=True))
+
+        qc = pd.read_hdf(os.path.join(counted, 'CCN_raw_170323_QC.h5'))
+        flags = qc[atmoscripts.QC_FLAG_COLUMN].values
+        for f in ['CCN_raw_170323_1min.h5', 'CCN_raw_170323_1h.h5']:
+            expected = pd.read_hdf(os.path.join(plain, f))
+            result = pd.read_hdf(os.path.join(counted, f))
+            # The statistics are as they were without the counts
+            pd.testing.assert_frame_equal(expected, result[expected.columns])
+            for bit, rule in enumerate(CCNC.ccn_qc_rules()):
+                self.assertEqual(result['qc_' + rule['name']].sum(),
+                                 ((flags >> bit) & 1).sum(), rule['name'])
+        self.assertGreater(result['qc_ss_transition'].sum(), 0)
+
+
+class TestFollow(CCNTestCase):
+
+    def test_polls_and_restarts_match_batch(self):
+        resolution = ['1min', '10min']
+        batch = self.raw_dir('batch', days=1)
+        fname = os.listdir(batch)[0]
+        with open(os.path.join(batch, fname)) as f:
+            text = f.read()
+        CCNC.LoadAndProcess(**processing_kwargs(
+                batch, output_time_resolution=resolution, qc_counts=True))
+
+        # The raw file is written in pieces ending part way through a row
+        header = len(''.join(text.splitlines(True)[:6]))
+        cuts = [header + int((len(text) - header)*p)
+                for p in [0.1, 0.3, 0.55, 0.8, 1]]
+        raw = os.path.join(self.tmp, 'raw', fname)
+        os.makedirs(os.path.dirname(raw))
+        with open(raw, 'w') as f:
+            f.write(text[:cuts[0]])
+        pieces = iter(zip(cuts[:-1], cuts[1:]))
+
+        def grow(seconds=0):
+            start, end = next(pieces)
+            with open(raw, 'a') as f:
+                f.write(text[start:end])
+
+        out = os.path.join(self.tmp, 'out')
+        os.makedirs(out)
+        kwargs = processing_kwargs(batch)
+        following = dict(ccn_output_path=out, ccn_output_filetype='h5',
+                         from_start=True, poll_interval=0, QC=True,
+                         qc_counts=True,
+                         flow_cal_df=kwargs['flow_cal_df'],
+                         mask_period_timestamp_df=kwargs['mask_period_timestamp_df'],
+                         output_time_resolution=resolution)
+        # The file grows between polls, and following is restarted from the
+        # saved offsets. The 0.2 % SS is masked until the restart, when its
+        # columns are added to the output.
+        with mock.patch.object(CCNC.systime, 'sleep', grow):
+            CCNC.follow_ccn(os.path.dirname(raw), max_polls=3, **following)
+        for i in range(2):
+            grow()
+            CCNC.follow_ccn(os.path.dirname(raw), max_polls=1, **following)
+
+        # The last period of each resampling interval is held back until it
+        # is complete
+        for stage, f, held in [('ssSplit', 'CCN_raw_170323_QC_flowCal_ssCal_logFilt_ssSplit.h5', 0),
+                               ('1min', 'CCN_raw_170323_1min.h5', 1),
+                               ('10min', 'CCN_raw_170323_10min.h5', 1)]:
+            expected = pd.read_hdf(os.path.join(batch, f))
+            result = atmoscripts.read_live_output(out, 'CCN', 'CCN', stage, 'h5')
+            pd.testing.assert_frame_equal(expected.iloc[:len(expected) - held],
+                                          result, check_freq=False, obj=stage)
+
+    def test_unsupported_options(self):
+        with self.assertRaisesRegex(AssertionError, 'stage_format, resume'):
+            CCNC.LoadAndProcess(self.tmp, follow=True, stage_format='diff',
+                                resume=True)
+
+
+class TestCompact(CCNTestCase):
+
+    def parse(self, data, date, cut=0):
+        text = data[CCNC.CCN_COLNAMES].to_csv(header=False, index=False)
+        return CCNC._parse_ccn_rows(io.StringIO(text[:len(text)-cut]),
+                                    date, compact=True)
+
+    def test_int_values_round_trip(self):
+        rng = np.random.default_rng(0)
+        plain = pd.DataFrame(ccn_columns(pd.Timestamp('2017-03-23'), 100, rng))
+        later = pd.DataFrame(ccn_columns(pd.Timestamp('2017-03-24'), 100, rng))
+        alarms = pd.DataFrame(ccn_columns(pd.Timestamp('2017-03-25'), 100, rng))
+        alarms['Alarm Code'] = 300
+        alarms.loc[5, 'Alarm Sum'] = 70000
+
+        results = [self.parse(plain, '03/23/17'),
+                   self.parse(alarms, '03/25/17'),
+                   # The last row is partly written, without its alarm columns
+                   self.parse(later, '03/24/17', cut=5)]
+        for col, dtype in CCNC.CCN_COMPACT_INTS.items():
+            self.assertEqual(results[0][col].dtype, dtype, col)
+        self.assertEqual(results[1]['Alarm Code'].dtype, np.int16)
+        self.assertEqual(results[1]['Alarm Sum'].dtype, np.float32)
+        self.assertEqual(results[2]['Alarm Sum'].dtype, np.float32)
+        for data, result in zip([plain, alarms, later], results):
+            for col in CCNC.CCN_COMPACT_INTS:
+                np.testing.assert_array_equal(result[col].values[:-1],
+                                              data[col].values[:-1], col)
+        self.assertEqual(results[1]['Alarm Sum'].iloc[5], 70000)
+        self.assertTrue(np.isnan(results[2]['Alarm Sum'].iloc[-1]))
+
+        # The table is rewritten once to hold the missing value, and small
+        # integers are appended to it from then on
+        fname = os.path.join(self.tmp, 'raw.h5')
+        results[0].to_hdf(fname, key='ccn', format='table')
+        self.assertFalse(atmoscripts.update_hdf_table(results[2], fname, 'ccn'))
+        pd.concat([results[0], results[2]]).to_hdf(fname, key='ccn', format='table')
+        self.assertTrue(atmoscripts.update_hdf_table(results[1], fname, 'ccn'))
+        stored = pd.read_hdf(fname, 'ccn')
+        self.assertEqual(stored['Alarm Sum'].dtype, np.float32)
+        expected = pd.concat([results[0], results[2], results[1]])
+        pd.testing.assert_frame_equal(stored, expected.astype(stored.dtypes))
+
+
+if __name__ == '__main__':
+    unittest.main()
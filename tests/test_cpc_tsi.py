@@ -0,0 +1,270 @@
+'''
+Tests of the CPC processing, run on small synthetic raw files
+'''
+import glob
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import atmoscripts
+from Instruments import CPC_TSI
+
+
+def write_cpc_csv(fname, start='2017-03-23 22:00', samples=240, length=60, seed=1):
+    '''
+    Writes a raw CPC csv export of samples of length one second
+    concentrations, starting at start
+    '''
+    rng = np.random.default_rng(seed)
+    columns = ['Sample #', 'Start Date', 'Start Time', 'Sample Length',
+               'Averaging Interval (secs)', 'Title', 'Instrument ID',
+               'Instrument Errors', 'Mean', 'Min', 'Max', 'Std Dev'] \
+        + [str(i) for i in range(1, length + 1)]
+    with open(fname, 'w') as f:
+        f.writelines(['Sample File,C:\\x.s3772\n', 'Model,3772\n', '\n',
+                      ','.join(columns) + '\n'])
+        for i in range(samples):
+            t = pd.Timestamp(start) + pd.Timedelta(seconds=length*i)
+            conc = ['%.2f' % v for v in rng.uniform(100, 1000, length)]
+            f.write(','.join([str(i + 1), t.strftime('%m/%d/%y'),
+                              t.strftime('%H:%M:%S'), str(length), '1', 't',
+                              'id', '0', '1', '1', '1', '1'] + conc) + '\n')
+
+
+class CPCTestCase(unittest.TestCase):
+    '''
+    Gives each test a temporary directory, and restores the working directory
+    which the processing changes
+    '''
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def make_dir(self, name):
+        path = os.path.join(self.tmp, name)
+        os.makedirs(path)
+        return path
+
+
+class TestManifest(CPCTestCase):
+
+    def test_filelist_checked_against_manifest_in_output_path(self):
+        raw = self.make_dir('raw')
+        out = self.make_dir('out')
+        fname = os.path.join(raw, 'cpc.csv')
+        write_cpc_csv(fname)
+
+        with mock.patch.object(CPC_TSI, 'read_cpc_csv',
+                               wraps=CPC_TSI.read_cpc_csv) as read:
+            for i in range(2):
+                CPC_TSI.Load_to_HDF(input_path=raw, output_path=out,
+                                    input_filelist=[fname],
+                                    output_file_frequency='daily')
+        # The file is only loaded the first time
+        self.assertEqual(read.call_count, 1)
+        self.assertTrue(os.path.isfile(atmoscripts.manifest_path(out)))
+        self.assertFalse(os.path.isfile(atmoscripts.manifest_path(raw)))
+
+
+class TestParallelRead(CPCTestCase):
+
+    def test_workers_match_serial(self):
+        raw = self.make_dir('raw')
+        # Each file is on its own day, so each daily hdf file is written once
+        filelist = []
+        for i, start in enumerate(['2017-03-23 01:00', '2017-03-24 05:00',
+                                   '2017-03-25 10:00']):
+            fname = os.path.join(raw, 'cpc%d.csv' % i)
+            write_cpc_csv(fname, start=start, samples=180, seed=i)
+            filelist.append(fname)
+
+        outputs = {}
+        for workers in [None, 2]:
+            out = self.make_dir('out_%s' % workers)
+            with mock.patch.object(CPC_TSI, 'read_cpc_csv_parallel',
+                                   wraps=CPC_TSI.read_cpc_csv_parallel) as read:
+                CPC_TSI.Load_to_HDF(input_path=raw, output_path=out,
+                                    input_filelist=list(filelist),
+                                    output_file_frequency='daily',
+                                    workers=workers)
+            self.assertEqual(read.call_count, 0 if workers is None else 1)
+            outputs[workers] = {f: pd.read_hdf(os.path.join(out, f))
+                                for f in sorted(os.listdir(out))
+                                if f.endswith('.h5')}
+
+        self.assertEqual(len(outputs[None]), 3)
+        self.assertEqual(sorted(outputs[None]), sorted(outputs[2]))
+        for f in outputs[None]:
+            pd.testing.assert_frame_equal(outputs[None][f], outputs[2][f],
+                                          obj=f)
+
+
+class TestStageDiff(CPCTestCase):
+
+    def test_diffs_rebuild_stages_which_ran(self):
+        mask = pd.DataFrame({'Start': [pd.Timestamp('2017-03-23 23:10')],
+                             'End': [pd.Timestamp('2017-03-23 23:20')]})
+        outputs = {}
+        for stage_format, background_writes in [('full', False), ('diff', True),
+                                                ('diff', False)]:
+            path = self.make_dir('%s_%s' % (stage_format, background_writes))
+            fname = os.path.join(path, 'cpc.csv')
+            write_cpc_csv(fname)
+            # Reloading clears the h5 files of the working directory
+            os.chdir(path)
+            # No flow calibration, so only the log filter is run
+            CPC_TSI.LoadAndProcess(path, path,
+                                   cn_output_filetype='h5',
+                                   force_reload_from_source=True,
+                                   input_filelist=[fname],
+                                   concat_file_frequency='daily',
+                                   output_time_resolution=['1h'],
+                                   mask_period_timestamp_df=mask,
+                                   stage_format=stage_format,
+                                   background_writes=background_writes)
+            outputs[stage_format, background_writes] = path
+
+        expected = pd.read_hdf(os.path.join(outputs['full', False],
+                                            'CN_raw_20170323_logFilt.h5'))
+        for background_writes in [True, False]:
+            with self.subTest(background_writes=background_writes):
+                result = CPC_TSI.load_stage(outputs['diff', background_writes],
+                                            'logFilt', 'CN_raw_20170323.h5')
+                pd.testing.assert_frame_equal(expected, result)
+
+
+class TestQC(CPCTestCase):
+
+    def test_counts_of_rows_failing_each_rule(self):
+        path = self.make_dir('raw')
+        fname = os.path.join(path, 'cpc.csv')
+        write_cpc_csv(fname)
+        os.chdir(path)
+        CPC_TSI.LoadAndProcess(path, path,
+                               cn_output_filetype='h5',
+                               force_reload_from_source=True,
+                               input_filelist=[fname],
+                               concat_file_frequency='daily',
+                               output_time_resolution=['1h'],
+                               QC=True,
+                               CN_conc_max=900,
+                               qc_counts=True)
+
+        raw = pd.read_hdf(os.path.join(path, 'CN_raw_20170323.h5'))
+        qc = pd.read_hdf(os.path.join(path, 'CN_raw_20170323_QC.h5'))
+        result = pd.read_hdf(os.path.join(path, 'CN_raw_20170323_1h.h5'))
+        high = (raw['Concentration'] > 900).values
+        np.testing.assert_array_equal(qc['Concentration'].isnull().values, high)
+        self.assertEqual(result['qc_conc_high'].sum(), high.sum())
+        self.assertEqual(result['qc_conc_negative'].sum(), 0)
+        np.testing.assert_array_equal(result['cn_count'] + result['qc_conc_high'],
+                                      [3600, 3600])
+
+
+class TestQuery(CPCTestCase):
+
+    def test_time_range_across_daily_files(self):
+        path = self.make_dir('raw')
+        fname = os.path.join(path, 'cpc.csv')
+        write_cpc_csv(fname)
+        os.chdir(path)
+        CPC_TSI.LoadAndProcess(path, path,
+                               cn_output_filetype='h5',
+                               force_reload_from_source=True,
+                               input_filelist=[fname],
+                               concat_file_frequency='daily',
+                               output_time_resolution=['1h'],
+                               QC=True)
+
+        # The last rows of the first day's file and the first of the second's
+        qc = pd.concat([pd.read_hdf(os.path.join(path, f)) for f in
+                        ['CN_raw_20170323_QC.h5', 'CN_raw_20170324_QC.h5']])
+        start = pd.Timestamp('2017-03-23 23:59:58')
+        end = pd.Timestamp('2017-03-24 00:00:02')
+        expected = qc[(qc.index >= start) & (qc.index < end)][['Concentration']]
+        self.assertEqual(len(expected), 4)
+        result = CPC_TSI.query(path, 'QC', start, end, ['Concentration'])
+        pd.testing.assert_frame_equal(expected, result)
+
+        result = CPC_TSI.query(path, resolution='1h', end='2017-03-24')
+        expected = pd.read_hdf(os.path.join(path, 'CN_raw_20170323_1h.h5'))
+        pd.testing.assert_frame_equal(expected, result, check_freq=False)
+
+
+class TestFollow(CPCTestCase):
+
+    def test_polls_and_restarts_match_batch(self):
+        flows = pd.DataFrame({'flow rate': [980., 990., 1000., 995.]},
+                             index=pd.to_datetime(['2017-03-22', '2017-03-23',
+                                                   '2017-03-24', '2017-03-25']))
+        mask = pd.DataFrame({'Start': [pd.Timestamp('2017-03-23 23:10')],
+                             'End': [pd.Timestamp('2017-03-23 23:20')]})
+        processing = dict(output_time_resolution=['5min'], QC=True,
+                          CN_conc_max=900, qc_counts=True,
+                          mask_period_timestamp_df=mask)
+
+        batch = self.make_dir('batch')
+        fname = os.path.join(batch, 'cpc.csv')
+        write_cpc_csv(fname)
+        os.chdir(batch)
+        CPC_TSI.LoadAndProcess(batch, batch,
+                               cn_output_filetype='h5',
+                               force_reload_from_source=True,
+                               input_filelist=[fname],
+                               concat_file_frequency='daily',
+                               flow_cal_df=flows.copy(),
+                               **processing)
+        expected = pd.concat([pd.read_hdf(f) for f in
+                              sorted(glob.glob(os.path.join(batch, '*_5min.h5')))])
+
+        # The file is exported in pieces ending part way through a sample
+        with open(fname) as f:
+            text = f.read()
+        cuts = [int(len(text)*p) for p in [0.2, 0.45, 0.7, 1]]
+        raw = os.path.join(self.make_dir('raw'), 'cpc.csv')
+        with open(raw, 'w') as f:
+            f.write(text[:cuts[0]])
+        pieces = iter(zip(cuts[:-1], cuts[1:]))
+
+        def grow(seconds=0):
+            start, end = next(pieces)
+            with open(raw, 'a') as f:
+                f.write(text[start:end])
+
+        out = self.make_dir('out')
+        following = dict(cn_output_path=out, cn_output_filetype='h5',
+                         from_start=True, poll_interval=0,
+                         flow_cal_df=flows.copy(), **processing)
+        # The file grows between polls, and following is restarted from the
+        # saved offsets, carrying on with the periods left incomplete
+        with mock.patch.object(CPC_TSI.systime, 'sleep', grow):
+            CPC_TSI.follow_cn(os.path.dirname(raw), max_polls=2, **following)
+        for i in range(2):
+            grow()
+            CPC_TSI.follow_cn(os.path.dirname(raw), max_polls=1, **following)
+
+        result = atmoscripts.read_live_output(out, 'CN', 'CPC', '5min', 'h5')
+        # The last period is held back until it is complete
+        pd.testing.assert_frame_equal(expected.iloc[:-1], result,
+                                      check_freq=False)
+        self.assertGreater(result['qc_conc_high'].sum(), 0)
+
+    def test_unsupported_options(self):
+        with self.assertRaisesRegex(AssertionError, 'cascade_resample'):
+            CPC_TSI.LoadAndProcess(self.tmp, follow=True,
+                                   cascade_resample=True)
+
+
+if __name__ == '__main__':
+    unittest.main()
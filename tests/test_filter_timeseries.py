@@ -0,0 +1,101 @@
+'''
+Tests of the timeseries filters
+'''
+import os
+import sys
+import unittest
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import Filter_Timeseries
+
+
+def linearFit_filt_loop(y, span):
+    '''
+    The linearFit_filt outlier test as it was written before
+    _linearFit_filt_column, fitting each window in turn
+    '''
+    mad = lambda x: np.median(np.abs(x - np.median(x)))
+    y = np.array(y, dtype=float)
+    x = np.arange(len(y))
+    span = int(span)
+    w1 = np.ones(span//2)
+    w2 = np.ones(span - span//2 - 1)/2
+    w3 = np.zeros(1)
+    f = None
+    for i in range(len(y)):
+        weights = np.concatenate((w1, w2, w3), axis=0)
+        ysub = y[i-span:i].copy()
+        xsub = x[i-span:i].copy()
+
+        if np.isfinite(y[i-1]):
+            if np.isfinite(ysub).sum() > 10:
+                idx = np.isfinite(ysub)
+                ysub = ysub[idx]
+                xsub = xsub[idx]
+                weights = weights[idx]
+
+                f = np.poly1d(np.polyfit(xsub, ysub, 1, w=weights))
+                res = ysub - f(xsub)
+                med_val = np.median(res[0:-1])
+                mad_val = mad(res[0:-1])
+                if ~(med_val - 4*mad_val < res[-1] < med_val + 4*mad_val):
+                    y[i-1] = np.nan
+
+            elif (f is not None) and \
+                    (np.isfinite(y[i-int(1.5*span):i-int(0.5*span)]).sum() > 20):
+                # Reuse the last fit and its residual stats
+                idx = np.isfinite(ysub)
+                res = ysub[idx] - f(xsub)[idx]
+                if ~(med_val - 4*mad_val < res[-1] < med_val + 4*mad_val):
+                    y[i-1] = np.nan
+    return y
+
+
+class TestLinearFitFilt(unittest.TestCase):
+
+    def assertSameMask(self, y, span):
+        expected = linearFit_filt_loop(y, span)
+        result = Filter_Timeseries._linearFit_filt_column(y, span)
+        np.testing.assert_array_equal(np.isnan(result), np.isnan(expected))
+        np.testing.assert_array_equal(result[~np.isnan(result)],
+                                      y[~np.isnan(result)])
+
+    def series(self, n=3000, seed=0):
+        rng = np.random.default_rng(seed)
+        y = 100 + np.cumsum(rng.normal(0, 1, n)) + rng.normal(0, 2, n)
+        spikes = rng.choice(n, n//50, replace=False)
+        y[spikes] += rng.choice([-1, 1], len(spikes))*rng.uniform(20, 60, len(spikes))
+        y[rng.random(n) < 0.05] = np.nan
+        return y
+
+    def test_matches_loop(self):
+        for seed in range(3):
+            for span in [20, 41]:
+                self.assertSameMask(self.series(seed=seed), span)
+
+    def test_sparse_window_reuses_last_fit(self):
+        # After a dense stretch, only every fourth point is left. The window
+        # ending at point 540 has too few points for a fit, but there were
+        # enough 1.5 to 0.5 spans back, so the spike there is only caught by
+        # reusing the last fit.
+        span = 40
+        rng = np.random.default_rng(3)
+        y = 100 + 0.1*np.arange(1000) + rng.normal(0, 1, 1000)
+        y[500:700] = np.where(np.arange(200) % 4 == 0, y[500:700], np.nan)
+        y[540] += 50
+        self.assertSameMask(y, span)
+        self.assertTrue(np.isnan(Filter_Timeseries._linearFit_filt_column(y, span)[540]))
+
+    def test_linearFit_filt(self):
+        df = pd.DataFrame({'a': self.series(), 'b': self.series(seed=1)})
+        df = Filter_Timeseries.linearFit_filt(df, ['a', 'b'], 1, 'sec', 20, 'sec')
+        for col in ['a', 'b']:
+            np.testing.assert_array_equal(np.isnan(df[col + '_filt']),
+                                          np.isnan(linearFit_filt_loop(df[col], 20)))
+
+
+if __name__ == '__main__':
+    unittest.main()